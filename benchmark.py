@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+
+"""
+This script measures the cost of collecting and serializing the device tree.
+It generates a synthetic sysfs tree of a configurable shape, points diskinfo
+at it, and reports wall time, read/write syscalls, filesystem calls and peak
+memory for a full collection, for each topology layer, and for each output
+format.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import diskinfo
+
+# Functions of the os module diskinfo opens, stats, resolves and lists files with, directly or through os.path
+# and glob. /proc/self/io only counts the reads and writes that follow.
+PATH_CALLS = ('open', 'stat', 'lstat', 'readlink', 'scandir', 'listdir')
+LAYERS = ('Hba', 'Phy', 'Port', 'Expander', 'EndDevice', 'Target', 'Device', 'BlockDevice')
+COLLECTORS = ('collect_hbas', 'collect_phys', 'collect_ports', 'collect_expanders', 'collect_end_devices',
+              'collect_targets', 'collect_target_devices', 'collect_block_devices')
+
+
+#
+# Synthetic sysfs trees
+#
+class SysfsBuilder(object):
+    """
+    Build a synthetic sysfs tree laid out like the kernel's, with relative
+    symlinks so the tree can be moved or archived.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.sys = os.path.join(root, 'sys')
+        self.disk_count = 0
+        self.slow_files = set()
+
+    def write(self, path, value):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb' if isinstance(value, bytes) else 'w') as attrfile:
+            attrfile.write(value if isinstance(value, bytes) else value + '\n')
+
+    def attributes(self, path, values):
+        for name, value in values.items():
+            self.write(os.path.join(path, name), value)
+
+    def link(self, path, target):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.symlink(os.path.relpath(target, os.path.dirname(path)), path)
+
+    def host(self, number):
+        path = os.path.join(self.sys, 'devices/pci0000:00/0000:00:{:02x}.0/host{}'.format(number + 1, number))
+        self.link(os.path.join(self.sys, 'bus/scsi/devices/host{}'.format(number)), path)
+        self.attributes(os.path.join(path, 'scsi_host/host{}'.format(number)), {
+            'board_name': 'SAS9300-8e', 'can_queue': '9856', 'host_busy': '0',
+            'host_sas_address': '0x500605b0{:08x}'.format(number), 'proc_name': 'mpt3sas', 'state': 'running',
+            'unique_id': str(number), 'version_fw': '16.00.01.00', 'version_product': 'SAS3008'})
+        os.makedirs(os.path.join(path, 'sas_host/host{}'.format(number)))
+        return path
+
+    def phy(self, parent, name, connected):
+        path = os.path.join(parent, name)
+        self.attributes(os.path.join(path, 'sas_phy', name), {
+            'device_type': 'end device' if connected else 'none', 'enable': '1',
+            'initiator_port_protocols': 'smp, stp, ssp', 'invalid_dword_count': '0',
+            'loss_of_dword_sync_count': '0', 'maximum_linkrate': '12.0 Gbit', 'maximum_linkrate_hw': '12.0 Gbit',
+            'minimum_linkrate': '3.0 Gbit', 'minimum_linkrate_hw': '3.0 Gbit',
+            'negotiated_linkrate': '12.0 Gbit' if connected else 'Unknown', 'phy_identifier': name.split(':')[-1],
+            'phy_reset_problem_count': '0', 'running_disparity_error_count': '0',
+            'sas_address': '0x500605b000000000', 'target_port_protocols': 'none'})
+        return path
+
+    def port(self, parent, name, phys):
+        path = os.path.join(parent, name)
+        self.write(os.path.join(path, 'sas_port', name, 'num_phys'), str(len(phys)))
+        for phy in phys:
+            self.link(os.path.join(phy, 'port'), path)
+            self.link(os.path.join(path, os.path.basename(phy)), phy)
+        return path
+
+    def expander(self, port, name, host):
+        path = os.path.join(port, name)
+        self.attributes(os.path.join(path, 'sas_expander', name), {
+            'vendor_id': 'LSI', 'product_id': 'SAS3x40', 'product_rev': '0601', 'component_vendor_id': 'LSI',
+            'component_id': '560', 'component_revision_id': '3', 'level': '0'})
+        self.attributes(os.path.join(path, 'sas_device', name), {
+            'device_type': 'edge expander', 'sas_address': '0x500304800000{:04x}'.format(host),
+            'phy_identifier': '0', 'initiator_port_protocols': 'smp', 'target_port_protocols': 'smp'})
+        return path
+
+    def disk(self, port, end_device, host, target, bay, slow):
+        """
+        Create an end device with one LUN and its block device below port
+        """
+        number = self.disk_count
+        self.disk_count += 1
+        sas_address = '0x5000c500{:08x}'.format(number)
+        path = os.path.join(port, end_device)
+        self.attributes(os.path.join(path, 'sas_device', end_device), {
+            'bay_identifier': str(bay), 'device_type': 'end device', 'enclosure_identifier': '0x500304800000003f',
+            'initiator_port_protocols': 'none', 'phy_identifier': str(bay), 'sas_address': sas_address,
+            'scsi_target_id': str(target), 'target_port_protocols': 'ssp'})
+        self.attributes(os.path.join(path, 'sas_end_device', end_device), {
+            'i_t_nexus_loss_timeout': '2000', 'initiator_response_timeout': '2000', 'ready_led_meaning': '0',
+            'tlr_enabled': '0', 'tlr_supported': '0'})
+
+        lun = '{}:0:{}:0'.format(host, target)
+        device = os.path.join(path, 'target{}:0:{}'.format(host, target), lun)
+        self.link(os.path.join(self.sys, 'bus/scsi/devices', lun), device)
+        serial = 'ZC{:06d}'.format(number).encode('ascii')
+        naa = bytes.fromhex('5000c500{:08x}'.format(number))
+        self.attributes(device, {
+            'device_blocked': '0', 'device_busy': '0', 'eh_timeout': '10', 'iocounterbits': '32',
+            'iodone_cnt': '0x1a2b', 'ioerr_cnt': '0x0', 'iorequest_cnt': '0x1a2b', 'model': 'ST8000NM0075    ',
+            'queue_depth': '254', 'queue_type': 'simple', 'rev': 'E004', 'sas_address': sas_address,
+            'scsi_level': '7', 'state': 'running', 'timeout': '30', 'type': '0', 'vendor': 'SEAGATE ',
+            'wwid': 'naa.5000c500{:08x}'.format(number),
+            'inquiry': bytes([0, 0, 6, 0x12, 0x8b, 0, 0x10, 2]) + b'SEAGATE ST8000NM0075    E004',
+            'vpd_pg80': bytes([0, 0x80, 0, len(serial)]) + serial,
+            'vpd_pg83': bytes([0, 0x83, 0, 12, 1, 3, 0, 8]) + naa})
+
+        name = 'sd' + self.disk_letters(number)
+        block = os.path.join(device, 'block', name)
+        self.attributes(block, {
+            'alignment_offset': '0', 'badblocks': '', 'capability': '50', 'dev': '8:{}'.format(number * 16),
+            'discard_alignment': '0', 'ext_range': '256', 'range': '16', 'removable': '0', 'ro': '0',
+            'size': '15628053168',
+            'stat': '  182946        0 12950738   141232    24866    18223  3362608   125856        0   134732   267088'})
+        self.link(os.path.join(self.sys, 'block', name), block)
+        self.link(os.path.join(self.sys, 'dev/block/8:{}'.format(number * 16)), block)
+        for attribute in slow:
+            for directory in (device, block):
+                if os.path.exists(os.path.join(directory, attribute)):
+                    self.slow_files.add(os.path.join(directory, attribute))
+
+    @staticmethod
+    def disk_letters(number):
+        letters = ''
+        number += 1
+        while number:
+            number, remainder = divmod(number - 1, 26)
+            letters = chr(ord('a') + remainder) + letters
+        return letters
+
+    def build(self, hbas, phys, expanders, disks, direct, slow=()):
+        """
+        Create hbas HBAs with phys phys each. Each of the first expanders phys
+        of an HBA leads to an expander with disks disks behind it, and the
+        next direct phys each lead to one directly attached disk. The
+        remaining phys are left unconnected.
+
+        :param slow: Attribute names whose files to add to slow_files for every disk
+        :return: Number of disks created
+        """
+        self.attributes(os.path.join(self.sys, 'devices/virtual/dmi/id'), {
+            'board_name': 'X11DPH-T', 'board_serial': 'OM1234567890', 'board_vendor': 'Supermicro',
+            'chassis_vendor': 'Supermicro', 'product_name': 'SSG-6049P',
+            'product_uuid': '00000000-0000-0000-0000-ac1f6b000000', 'sys_vendor': 'Supermicro'})
+        for host in range(hbas):
+            host_path = self.host(host)
+            target = 0
+            for number in range(phys):
+                phy_name = 'phy-{}:{}'.format(host, number)
+                connected = number < expanders + direct
+                phy = self.phy(host_path, phy_name, connected)
+                if not connected:
+                    continue
+                port = self.port(host_path, 'port-{}:{}'.format(host, number), [phy])
+                if number >= expanders:
+                    self.disk(port, 'end_device-{}:{}'.format(host, number), host, target, number, slow)
+                    target += 1
+                    continue
+                expander_name = 'expander-{}:{}'.format(host, number)
+                expander = self.expander(port, expander_name, host)
+                for bay in range(disks):
+                    ephy = self.phy(expander, 'phy-{}:{}:{}'.format(host, number, bay), True)
+                    eport = self.port(expander, 'port-{}:{}:{}'.format(host, number, bay), [ephy])
+                    self.disk(eport, 'end_device-{}:{}:{}'.format(host, number, bay), host, target, bay, slow)
+                    target += 1
+        return self.disk_count
+
+
+#
+# Measurements
+#
+def read_syscalls():
+    """
+    Return the read and write syscalls made by this process so far, or None
+    where /proc/self/io is unavailable
+    """
+    try:
+        with open('/proc/self/io') as iofile:
+            counters = dict(line.split(': ') for line in iofile.read().splitlines() if ': ' in line)
+        return int(counters['syscr']) + int(counters['syscw'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+class PathCallCounter(object):
+    """
+    Count the calls made to the PATH_CALLS functions of the os module, by any
+    thread, while installed. Each of them makes one syscall.
+    """
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._saved = []
+
+    def _wrap(self, name):
+        original = getattr(os, name)
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.count += 1
+            return original(*args, **kwargs)
+        self._saved.append((name, original))
+        setattr(os, name, counted)
+
+    def __enter__(self):
+        for name in PATH_CALLS:
+            self._wrap(name)
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, original in reversed(self._saved):
+            setattr(os, name, original)
+        self._saved = []
+
+
+def measure(func, repeat):
+    """
+    Run func repeat times and return the median wall time, the read and
+    write syscalls of one run, the path calls of one further run and the
+    peak memory traced during a last run
+    """
+    times = []
+    syscalls = None
+    for _ in range(repeat):
+        before = read_syscalls()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+        after = read_syscalls()
+        if before is not None and after is not None:
+            syscalls = after - before
+    with PathCallCounter() as path_calls:
+        func()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), syscalls, path_calls.count, peak
+
+
+class LayerTimer(object):
+    """
+    Accumulate the time spent in each collect_* function and in each node
+    class's dump() while installed
+    """
+    def __init__(self):
+        self.seconds = {}
+        self._saved = []
+
+    def _wrap(self, owner, name, key):
+        original = getattr(owner, name)
+        seconds = self.seconds
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                seconds[key] = seconds.get(key, 0.0) + time.perf_counter() - start
+
+        self._saved.append((owner, name, owner.__dict__[name] if isinstance(owner, type) else original))
+        setattr(owner, name, timed)
+
+    def __enter__(self):
+        for name in COLLECTORS:
+            self._wrap(diskinfo, name, name)
+        for layer in LAYERS:
+            cls = getattr(diskinfo, layer)
+            if 'dump' not in cls.__dict__:
+                cls.dump = diskinfo.SysfsNode.dump
+            self._wrap(cls, 'dump', layer + '.dump')
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, name, original in reversed(self._saved):
+            if isinstance(owner, type) and original is diskinfo.SysfsNode.dump:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, original)
+
+
+def slow_reads(files, delay):
+    """
+    Make diskinfo's reads of files take an extra delay seconds, standing in
+    for attributes of a struggling device
+    """
+    read_file = diskinfo.read_file
+
+    def slow_read_file(path):
+        if path in files:
+            time.sleep(delay)
+        return read_file(path)
+
+    diskinfo.read_file = slow_read_file
+    return read_file
+
+
+def cached_walk(sysroot):
+    """
+    Walk the tree with a fresh listing cache, as a run of diskinfo.py does
+    """
+    diskinfo.configure_sysfs_cache(True)
+    try:
+        return [item for hba in diskinfo.collect_hbas(sysroot) for item in diskinfo.walk_hba(hba)]
+    finally:
+        diskinfo.configure_sysfs_cache(False)
+
+
+def run(args):
+    results = []
+    root = args.tree or tempfile.mkdtemp(prefix='diskinfo-bench-')
+    try:
+        if not args.tree:
+            builder = SysfsBuilder(root)
+            count = builder.build(args.hbas, args.phys, args.expanders, args.disks, args.direct,
+                                  slow=args.slow)
+            slow_files = builder.slow_files
+            logging.info('Generated %d disks in %s', count, root)
+        else:
+            slow_files = set()
+        sysroot = os.path.join(root, 'sys')
+        # Paths read by diskinfo are canonical, so register the canonical
+        # forms of the slow attribute files
+        slow_files = set(os.path.realpath(path) for path in slow_files)
+        original_read_file = slow_reads(slow_files, args.slow_delay) if slow_files else None
+        try:
+            tree = diskinfo.collect_tree(jobs=args.jobs, sysroot=sysroot)
+            results.append(('collect (jobs={})'.format(args.jobs),)
+                           + measure(lambda: diskinfo.collect_tree(jobs=args.jobs, sysroot=sysroot), args.repeat))
+            results.append(('walk only',) + measure(
+                lambda: [item for hba in diskinfo.collect_hbas(sysroot) for item in diskinfo.walk_hba(hba)], args.repeat))
+            results.append(('walk only, cached',) + measure(lambda: cached_walk(sysroot), args.repeat))
+            results.append(('walk only, bottom-up',) + measure(
+                lambda: [item for hba in diskinfo.discover_hbas(sysroot) for item in diskinfo.walk_hba(hba)],
+                args.repeat))
+            results.append(('serialize json',) + measure(
+                lambda: json.dumps(tree, indent=2, sort_keys=True, default=diskinfo.json_default), args.repeat))
+            results.append(('format stream',) + measure(
+                lambda: diskinfo.write_json_stream(io.StringIO(), jobs=args.jobs, sysroot=sysroot), args.repeat))
+            results.append(('format ndjson',) + measure(
+                lambda: diskinfo.write_ndjson(io.StringIO(), jobs=args.jobs, sysroot=sysroot), args.repeat))
+            results.append(('serialize binary',) + measure(
+                lambda: diskinfo.write_snapshot(io.BytesIO(), tree), args.repeat))
+            with LayerTimer() as layers:
+                diskinfo.collect_tree(sysroot=sysroot)
+        finally:
+            if original_read_file is not None:
+                diskinfo.read_file = original_read_file
+    finally:
+        if not args.tree and not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    return tree, results, layers.seconds
+
+
+def report(tree, results, layers):
+    print('Tree: {} hosts, {} phys, {} ports, {} expanders, {} end devices, {} targets, {} LUNs, '
+          '{} block devices'.format(tree['hostcount'], tree['phycount'], tree['portcount'], tree['expandercount'],
+                                    tree['devicecount'], tree['targetcount'], tree['luncount'],
+                                    tree['blockdevcount']))
+    print('')
+    print('{:<24} {:>12} {:>12} {:>12} {:>14}'.format(
+        'Benchmark', 'Wall (ms)', 'Read/write', 'Path calls', 'Peak mem (KiB)'))
+    for name, seconds, syscalls, path_calls, peak in results:
+        print('{:<24} {:>12.2f} {:>12} {:>12} {:>14}'.format(
+            name, seconds * 1000, '-' if syscalls is None else syscalls, path_calls, peak // 1024))
+    print('')
+    print('{:<24} {:>12}'.format('Layer (serial run)', 'Wall (ms)'))
+    for name in COLLECTORS + tuple(layer + '.dump' for layer in LAYERS):
+        if name in layers:
+            print('{:<24} {:>12.2f}'.format(name, layers[name] * 1000))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark diskinfo against a synthetic sysfs tree.')
+    parser.add_argument('--hbas', type=int, default=4, help='Number of HBAs (default: %(default)s)')
+    parser.add_argument('--phys', type=int, default=8, help='Phys per HBA (default: %(default)s)')
+    parser.add_argument('--expanders', type=int, default=0,
+                        help='Phys per HBA leading to an expander (default: %(default)s)')
+    parser.add_argument('--disks', type=int, default=24, help='Disks per expander (default: %(default)s)')
+    parser.add_argument('--direct', type=int, default=8,
+                        help='Phys per HBA, after the expanders, with a directly attached disk '
+                             '(default: %(default)s)')
+    parser.add_argument('--slow', action='append', default=[], metavar='ATTRIBUTE',
+                        help='Make reads of this disk attribute slow, e.g. vpd_pg83. May be repeated')
+    parser.add_argument('--slow-delay', type=float, default=0.01, metavar='SECONDS',
+                        help='Extra time each slow read takes (default: %(default)s)')
+    parser.add_argument('--jobs', type=int, default=1, help='Threads to collect with (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark (default: %(default)s)')
+    parser.add_argument('--tree', metavar='PATH', help='Benchmark the tree at PATH/sys instead, e.g. an extracted diskinfo.py --capture')
+    parser.add_argument('--keep', action='store_true', help='Do not delete the generated tree')
+    args = parser.parse_args(argv)
+    if args.expanders + args.direct > args.phys:
+        parser.error('--expanders plus --direct must not exceed --phys')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.ERROR)
+    report(*run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,150 +1,424 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 """
 This script walks the /sys/bus/scsi directory tree to search for ports and devices connected to those ports.
 If a device is found to be connected to a port its serial number, device name, and aliases will be collected.
 """
+import argparse
+import fnmatch
 import glob
+import io
 import json
 import logging
+import mmap
 import os
 import platform
+import queue
 import re
-# import sys
+import selectors
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Where sysfs is mounted, unless another root is given with --sysroot
+DEFAULT_SYSROOT = '/sys'
+# Exit status when the reader of the output goes away early, as the shell reports a process killed by SIGPIPE
+BROKEN_PIPE_STATUS = 128 + 13
+
+# Fields of Device, EndDevice and BlockDevice timing the reads of their attributes. A SCSI device the kernel's
+# error handler is busy with answers slowly. They differ between runs, so are only output when asked for.
+READ_LATENCY_FIELDS = ('read_latency_us', 'slow_reads')
+# Seconds from which an attribute read counts as slow, unless set with --slow-read
+DEFAULT_SLOW_READ = 0.1
 
 # Hba -> Phy -> Port -> Expander -> Phy -> Port -> EndDevice -> Target -> Device -> BlockDevice
 # /sys/class/scsi_host/host0/device/phy-0:0/sas_phy/phy-0:0/device/port/end_device-0:0/target0:0:0/0:0:0:0/block/sda
 
 
-class Hba(dict):
-    def __init__(self, path, **kwargs):
-        self._device_path = get_canonical_path(path)
+class SysfsNode(object):
+    """
+    Base class for nodes backed by a sysfs attribute directory. The first
+    attribute read from a directory reads every attribute the class knows
+    about in that directory in one pass, and later properties, repr() and
+    dump() are served from that snapshot instead of reopening the files.
+
+    The nodes below a node are collected on first access to children. What
+    was read is kept until refresh() is called or, if the node was created
+    with a ttl, until ttl seconds after it was created or last refreshed.
+    Nodes collected below a node share its ttl.
+
+    Nodes are created from the sysfs path of their device directory, which
+    is resolved to its canonical path unless canonical is set.
+    """
+    # Attribute files read from data_path
+    ATTRIBUTES = ()
+    # Keys of dump(), each read through the property of the same name
+    FIELDS = ()
+    # Fields that change while the system runs, such as states and counters.
+    # All other fields are static and may be cached between runs.
+    DYNAMIC_FIELDS = ()
+    # Fields that differ between runs of an unchanged system, only dumped
+    # when asked for by name
+    OPTIONAL_FIELDS = ()
+    # Attribute files named differently from the field they back
+    FIELD_FILES = {}
+    __slots__ = ('sysroot', 'ttl', '_snapshots', '_partial', '_children', '_loaded', '_slowest_read', '_slow_reads')
+
+    def __init__(self, *args, **kwargs):
+        # The sysfs root the node was found under, passed on to its children
+        self.sysroot = kwargs.pop('sysroot', DEFAULT_SYSROOT)
+        self.ttl = kwargs.pop('ttl', None)
+        self._snapshots = {}
+        self._partial = set()
+        self._children = None
+        self._loaded = time.monotonic()
+        self._slowest_read = None
+        self._slow_reads = 0
+        super(SysfsNode, self).__init__(*args, **kwargs)
+
+    def refresh(self):
+        """
+        Forget the attributes and children read so far, so that they are
+        read again when next accessed
+        """
+        self._snapshots = {}
+        self._partial = set()
+        self._children = None
+        self._loaded = time.monotonic()
+        self._slowest_read = None
+        self._slow_reads = 0
+
+    def _expire(self):
+        if time.monotonic() - self._loaded > self.ttl:
+            self.refresh()
+
+    @property
+    def children(self):
+        """
+        The nodes directly below this one in the topology
+
+        :rtype: list
+        """
+        if self.ttl is not None:
+            self._expire()
+        if self._children is None:
+            self._children = collect_children(self)
+        return self._children
+
+    @children.setter
+    def children(self, nodes):
+        self._children = nodes
+
+    @property
+    def children_known(self):
+        """
+        Whether the nodes below this one were collected or set already
+        """
+        return self._children is not None
+
+    @classmethod
+    def static_fields(cls):
+        return tuple(field for field in cls.FIELDS if field not in cls.DYNAMIC_FIELDS)
+
+    def attribute_dirs(self):
+        """
+        Return (path, attribute files) for every attribute directory of the node
+        """
+        return ((self.data_path, self.ATTRIBUTES),)
+
+    def _read(self, item, path=None, items=None):
+        if self.ttl is not None:
+            self._expire()
+        if path is None:
+            path, items = self.data_path, self.ATTRIBUTES
+        snapshot = self._snapshots.get(path)
+        if snapshot is None:
+            snapshot = self._snapshots[path] = read_sysfs_attributes(path, items, self._observe_read)
+        elif item not in snapshot and path in self._partial:
+            # Only some attributes were prefetched, read this one on its own
+            started = time.monotonic()
+            snapshot[item] = get_sysfs_data(path, item)
+            self._observe_read(path, item, time.monotonic() - started)
+        if item not in snapshot:
+            logging.warning('Unable to read %s from %s. No such attribute', item, path)
+            return None
+        return snapshot[item]
+
+    def prefetch(self, fields):
+        """
+        Read the attribute files behind fields in one pass per attribute
+        directory, without reading any other attribute of the node.
+        """
+        if self.ttl is not None:
+            self._expire()
+        files = set(self.FIELD_FILES.get(field, field) for field in fields)
+        # Read latencies are those of the node's attributes, all of which are read for them
+        timed = any(field in READ_LATENCY_FIELDS for field in fields)
+        for path, items in self.attribute_dirs():
+            snapshot = self._snapshots.get(path)
+            if snapshot is not None and path not in self._partial:
+                continue
+            wanted = tuple(item for item in items
+                           if (timed or item in files) and (snapshot is None or item not in snapshot))
+            if not wanted:
+                continue
+            data = read_sysfs_attributes(path, wanted, self._observe_read)
+            for item in wanted:
+                if item not in data:
+                    logging.warning('Unable to read %s from %s. No such attribute', item, path)
+                    data[item] = None
+            if snapshot is None:
+                self._snapshots[path] = data
+                self._partial.add(path)
+            else:
+                snapshot.update(data)
+
+    def _observe_read(self, path, item, seconds):
+        if self._slowest_read is None or seconds > self._slowest_read:
+            self._slowest_read = seconds
+        if seconds >= slow_read_threshold:
+            self._slow_reads += 1
+            logging.warning('Reading %s from %s took %d ms', item, path, seconds * 1000)
+
+    @property
+    def read_latency_us(self):
+        """ The longest any attribute read from the node took, in microseconds """
+        if self._slowest_read is None:
+            return None
+        return int(self._slowest_read * 1000000)
+
+    @property
+    def slow_reads(self):
+        """ How many attribute reads from the node took longer than slow_read_threshold """
+        if self._slowest_read is None:
+            return None
+        return self._slow_reads
+
+    def _values(self, fields):
+        values = [None if field in READ_LATENCY_FIELDS else getattr(self, field) for field in fields]
+        # Read latencies are only complete once every other field has been read
+        for index, field in enumerate(fields):
+            if field in READ_LATENCY_FIELDS:
+                values[index] = getattr(self, field)
+        return values
+
+    def record(self, fields=None):
+        """
+        Return the node's fields as a Record
+
+        :param fields: Fields to record, all of FIELDS by default. Attributes
+            behind other fields are not read.
+        :type fields: tuple
+        :rtype: Record
+        """
+        if fields is None:
+            fields = self.FIELDS
+        else:
+            self.prefetch(fields)
+        return Record(self.__class__, self.device_path, fields, tuple(self._values(fields)))
+
+    def dump(self, fields=None):
+        """
+        Return the node's fields as a dict
+
+        :param fields: Fields to dump, all of FIELDS by default. Attributes
+            behind other fields are not read.
+        :type fields: tuple
+        :rtype: dict
+        """
+        if fields is None:
+            fields = self.FIELDS
+        else:
+            self.prefetch(fields)
+        return dict(zip(fields, self._values(fields)))
+
+
+class Record(object):
+    """
+    The fields of a node as read at one point in time. Records of one layer
+    share a single table of field names and hold their values in a tuple in
+    the same order, which takes a fraction of the memory of a dict per node.
+    """
+    __slots__ = ('kind', 'path', 'fields', 'values')
+
+    def __init__(self, kind, path, fields, values):
+        # The node's class and canonical device path
+        self.kind = kind
+        self.path = path
+        self.fields = fields
+        self.values = values
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(self.__class__.__name__, self.kind.__name__, self.path)
+
+    def get(self, field, default=None):
+        try:
+            return self.values[self.fields.index(field)]
+        except ValueError:
+            return default
+
+    def as_dict(self):
+        return dict(zip(self.fields, self.values))
+
+
+class Hba(SysfsNode):
+    ATTRIBUTES = (
+        'active_mode', 'board_assembly', 'board_name', 'board_tracer', 'BRM_status', 'can_queue',
+        'cmd_per_lun', 'eh_deadline', 'fw_queue_depth', 'host_busy', 'host_sas_address',
+        'ioc_reset_count', 'io_delay', 'logging_level', 'proc_name', 'prot_capabilities',
+        'prot_guard_type', 'reply_queue_count', 'sg_prot_tablesize', 'sg_tablesize', 'state',
+        'supported_mode', 'unchecked_isa_dma', 'unique_id', 'use_blk_mq', 'version_bios',
+        'version_fw', 'version_mpi', 'version_nvdata_default', 'version_nvdata_persistent',
+        'version_product')
+    FIELDS = (
+        'active_mode', 'board_assembly', 'board_name', 'board_tracer', 'brm_status', 'can_queue',
+        'cmd_per_lun', 'eh_deadline', 'fw_queue_depth', 'host_busy', 'host_sas_address',
+        'ioc_reset_count', 'io_delay', 'logging_level', 'proc_name', 'prot_capabilities',
+        'prot_guard_type', 'reply_queue_count', 'sg_prot_tablesize', 'sg_tablesize', 'state',
+        'supported_mode', 'unchecked_isa_dma', 'unique_id', 'use_blk_mq', 'version_bios',
+        'version_fw', 'version_mpi', 'version_nvdata_default', 'version_nvdata_persistent',
+        'version_product')
+    DYNAMIC_FIELDS = ('host_busy', 'ioc_reset_count', 'state')
+    FIELD_FILES = {'brm_status': 'BRM_status'}
+    __slots__ = ('_device_path', '_data_path')
+
+    def __init__(self, path, canonical=False, **kwargs):
+        self._device_path = path if canonical else get_canonical_path(path)
         self._data_path = os.path.join(self.device_path, 'scsi_host/', os.path.basename(self.device_path))
         super(Hba, self).__init__(**kwargs)
 
     @property
     def active_mode(self):
-        return get_sysfs_data(self.data_path, 'active_mode')
+        return self._read('active_mode')
 
     @property
     def board_assembly(self):
-        return get_sysfs_data(self.data_path, 'board_assembly')
+        return self._read('board_assembly')
 
     @property
     def board_name(self):
-        return get_sysfs_data(self.data_path, 'board_name')
+        return self._read('board_name')
 
     @property
     def board_tracer(self):
-        return get_sysfs_data(self.data_path, 'board_tracer')
+        return self._read('board_tracer')
 
     @property
     def brm_status(self):
-        return get_sysfs_data(self.data_path, 'BRM_status')
+        return self._read('BRM_status')
 
     @property
     def can_queue(self):
-        return get_sysfs_data(self.data_path, 'can_queue')
+        return self._read('can_queue')
 
     @property
     def cmd_per_lun(self):
-        return get_sysfs_data(self.data_path, 'cmd_per_lun')
+        return self._read('cmd_per_lun')
 
     @property
     def eh_deadline(self):
-        return get_sysfs_data(self.data_path, 'eh_deadline')
+        return self._read('eh_deadline')
 
     @property
     def fw_queue_depth(self):
-        return get_sysfs_data(self.data_path, 'fw_queue_depth')
+        return self._read('fw_queue_depth')
 
     @property
     def host_busy(self):
-        return get_sysfs_data(self.data_path, 'host_busy')
+        return self._read('host_busy')
 
     @property
     def host_sas_address(self):
-        return get_sysfs_data(self.data_path, 'host_sas_address')
+        return self._read('host_sas_address')
 
     @property
     def ioc_reset_count(self):
-        return get_sysfs_data(self.data_path, 'ioc_reset_count')
+        return self._read('ioc_reset_count')
 
     @property
     def io_delay(self):
-        return get_sysfs_data(self.data_path, 'io_delay')
+        return self._read('io_delay')
 
     @property
     def logging_level(self):
-        return get_sysfs_data(self.data_path, 'logging_level')
+        return self._read('logging_level')
 
     @property
     def proc_name(self):
-        return get_sysfs_data(self.data_path, 'proc_name')
+        return self._read('proc_name')
 
     @property
     def prot_capabilities(self):
-        return get_sysfs_data(self.data_path, 'prot_capabilities')
+        return self._read('prot_capabilities')
 
     @property
     def prot_guard_type(self):
-        return get_sysfs_data(self.data_path, 'prot_guard_type')
+        return self._read('prot_guard_type')
 
     @property
     def reply_queue_count(self):
-        return get_sysfs_data(self.data_path, 'reply_queue_count')
+        return self._read('reply_queue_count')
 
     @property
     def sg_prot_tablesize(self):
-        return get_sysfs_data(self.data_path, 'sg_prot_tablesize')
+        return self._read('sg_prot_tablesize')
 
     @property
     def sg_tablesize(self):
-        return get_sysfs_data(self.data_path, 'sg_tablesize')
+        return self._read('sg_tablesize')
 
     @property
     def state(self):
-        return get_sysfs_data(self.data_path, 'state')
+        return self._read('state')
 
     @property
     def supported_mode(self):
-        return get_sysfs_data(self.data_path, 'supported_mode')
+        return self._read('supported_mode')
 
     @property
     def unchecked_isa_dma(self):
-        return get_sysfs_data(self.data_path, 'unchecked_isa_dma')
+        return self._read('unchecked_isa_dma')
 
     @property
     def unique_id(self):
-        return get_sysfs_data(self.data_path, 'unique_id')
+        return self._read('unique_id')
 
     @property
     def use_blk_mq(self):
-        return get_sysfs_data(self.data_path, 'use_blk_mq')
+        return self._read('use_blk_mq')
 
     @property
     def version_bios(self):
-        return get_sysfs_data(self.data_path, 'version_bios')
+        return self._read('version_bios')
 
     @property
     def version_fw(self):
-        return get_sysfs_data(self.data_path, 'version_fw')
+        return self._read('version_fw')
 
     @property
     def version_mpi(self):
-        return get_sysfs_data(self.data_path, 'version_mpi')
+        return self._read('version_mpi')
 
     @property
     def version_nvdata_default(self):
-        return get_sysfs_data(self.data_path, 'version_nvdata_default')
+        return self._read('version_nvdata_default')
 
     @property
     def version_nvdata_persistent(self):
-        return get_sysfs_data(self.data_path, 'version_nvdata_persistent')
+        return self._read('version_nvdata_persistent')
 
     @property
     def version_product(self):
-        return get_sysfs_data(self.data_path, 'version_product')
+        return self._read('version_product')
 
     @property
     def data_path(self):
@@ -169,110 +443,92 @@ class Hba(dict):
     @property
     def is_sas(self):
         try:
-            return os.path.exists(os.path.join(self.device_path, 'sas_host'))
+            return sysfs_exists(os.path.join(self.device_path, 'sas_host'))
         except OSError as e:
             logging.warning('Unable to determine if Host is SAS. %s', e)
             return False
 
-    def dump(self):
-        return {'active_mode': self.active_mode,
-             'board_assembly': self.board_assembly,
-             'board_name': self.board_name,
-             'board_tracer': self.board_tracer,
-             'brm_status': self.brm_status,
-             'can_queue': self.can_queue,
-             'cmd_per_lun': self.cmd_per_lun,
-             'eh_deadline': self.eh_deadline,
-             'fw_queue_depth': self.fw_queue_depth,
-             'host_busy': self.host_busy,
-             'host_sas_address': self.host_sas_address,
-             'ioc_reset_count': self.ioc_reset_count,
-             'io_delay': self.io_delay,
-             'logging_level': self.logging_level,
-             'proc_name': self.proc_name,
-             'prot_capabilities': self.prot_capabilities,
-             'prot_guard_type': self.prot_guard_type,
-             'reply_queue_count': self.reply_queue_count,
-             'sg_prot_tablesize': self.sg_prot_tablesize,
-             'sg_tablesize': self.sg_tablesize,
-             'state': self.state,
-             'supported_mode': self.supported_mode,
-             'unchecked_isa_dma': self.unchecked_isa_dma,
-             'unique_id': self.unique_id,
-             'use_blk_mq': self.use_blk_mq,
-             'version_bios': self.version_bios,
-             'version_fw': self.version_fw,
-             'version_mpi': self.version_mpi,
-             'version_nvdata_default': self.version_nvdata_default,
-             'version_nvdata_persistent': self.version_nvdata_persistent,
-             'version_product': self.version_product}
-
-
-class Phy(dict):
-    def __init__(self, path, **kwargs):
-        self._device_path = get_canonical_path(path)
+
+class Phy(SysfsNode):
+    ATTRIBUTES = (
+        'device_type', 'enable', 'initiator_port_protocols', 'invalid_dword_count',
+        'loss_of_dword_sync_count', 'maximum_linkrate', 'maximum_linkrate_hw', 'minimum_linkrate',
+        'minimum_linkrate_hw', 'negotiated_linkrate', 'phy_identifier', 'phy_reset_problem_count',
+        'running_disparity_error_count', 'sas_address', 'target_port_protocols')
+    FIELDS = (
+        'device_type', 'enable', 'initiator_port_protocols', 'invalid_dword_count',
+        'loss_of_dword_sync_count', 'maximum_linkrate', 'maximum_linkrate_hw', 'minimum_linkrate',
+        'minimum_linkrate_hw', 'negotiated_linkrate', 'phy_identifier', 'phy_reset_problem_count',
+        'running_disparity_error_count', 'sas_address', 'target_port_protocols')
+    DYNAMIC_FIELDS = (
+        'device_type', 'enable', 'invalid_dword_count', 'loss_of_dword_sync_count', 'negotiated_linkrate',
+        'phy_reset_problem_count', 'running_disparity_error_count')
+    __slots__ = ('_device_path', '_data_path')
+
+    def __init__(self, path, canonical=False, **kwargs):
+        self._device_path = path if canonical else get_canonical_path(path)
         self._data_path = os.path.join(self.device_path, 'sas_phy/', os.path.basename(self.device_path))
         super(Phy, self).__init__(**kwargs)
 
     @property
     def device_type(self):
-        return get_sysfs_data(self.data_path, 'device_type')
+        return self._read('device_type')
 
     @property
     def enable(self):
-        return get_sysfs_data(self.data_path, 'enable')
+        return self._read('enable')
 
     @property
     def initiator_port_protocols(self):
-        return get_sysfs_data(self.data_path, 'initiator_port_protocols')
+        return self._read('initiator_port_protocols')
 
     @property
     def invalid_dword_count(self):
-        return get_sysfs_data(self.data_path, 'invalid_dword_count')
+        return self._read('invalid_dword_count')
 
     @property
     def loss_of_dword_sync_count(self):
-        return get_sysfs_data(self.data_path, 'loss_of_dword_sync_count')
+        return self._read('loss_of_dword_sync_count')
 
     @property
     def maximum_linkrate(self):
-        return get_sysfs_data(self.data_path, 'maximum_linkrate')
+        return self._read('maximum_linkrate')
 
     @property
     def maximum_linkrate_hw(self):
-        return get_sysfs_data(self.data_path, 'maximum_linkrate_hw')
+        return self._read('maximum_linkrate_hw')
 
     @property
     def minimum_linkrate(self):
-        return get_sysfs_data(self.data_path, 'minimum_linkrate')
+        return self._read('minimum_linkrate')
 
     @property
     def minimum_linkrate_hw(self):
-        return get_sysfs_data(self.data_path, 'minimum_linkrate_hw')
+        return self._read('minimum_linkrate_hw')
 
     @property
     def negotiated_linkrate(self):
-        return get_sysfs_data(self.data_path, 'negotiated_linkrate')
+        return self._read('negotiated_linkrate')
 
     @property
     def phy_identifier(self):
-        return get_sysfs_data(self.data_path, 'phy_identifier')
+        return self._read('phy_identifier')
 
     @property
     def phy_reset_problem_count(self):
-        return get_sysfs_data(self.data_path, 'phy_reset_problem_count')
+        return self._read('phy_reset_problem_count')
 
     @property
     def running_disparity_error_count(self):
-        return get_sysfs_data(self.data_path, 'running_disparity_error_count')
+        return self._read('running_disparity_error_count')
 
     @property
     def sas_address(self):
-        return get_sysfs_data(self.data_path, 'sas_address')
+        return self._read('sas_address')
 
     @property
     def target_port_protocols(self):
-        return get_sysfs_data(self.data_path, 'target_port_protocols')
+        return self._read('target_port_protocols')
 
     @property
     def data_path(self):
@@ -297,42 +553,29 @@ class Phy(dict):
     @property
     def is_sas(self):
         try:
-            return os.path.exists(os.path.join(self.device_path, 'sas_phy'))
+            return sysfs_exists(os.path.join(self.device_path, 'sas_phy'))
         except OSError as e:
             logging.warning('Unable to determine if Phy is SAS. %s', e)
             return False
 
-    def dump(self):
-        return {'device_type': self.device_type,
-             'enable': self.enable,
-             'initiator_port_protocols': self.initiator_port_protocols,
-             'invalid_dword_count': self.invalid_dword_count,
-             'loss_of_dword_sync_count': self.loss_of_dword_sync_count,
-             'maximum_linkrate': self.maximum_linkrate,
-             'maximum_linkrate_hw': self.maximum_linkrate_hw,
-             'minimum_linkrate': self.minimum_linkrate,
-             'minimum_linkrate_hw': self.minimum_linkrate_hw,
-             'negotiated_linkrate': self.negotiated_linkrate,
-             'phy_identifier': self.phy_identifier,
-             'phy_reset_problem_count': self.phy_reset_problem_count,
-             'running_disparity_error_count': self.running_disparity_error_count,
-             'sas_address': self.sas_address,
-             'target_port_protocols': self.target_port_protocols}
-
-
-class Port(dict):
-    def __init__(self, path, **kwargs):
-        self._device_path = get_canonical_path(path)
+
+class Port(SysfsNode):
+    ATTRIBUTES = ('num_phys',)
+    FIELDS = ('num_phys',)
+    __slots__ = ('_device_path', '_data_path')
+
+    def __init__(self, path, canonical=False, **kwargs):
+        self._device_path = path if canonical else get_canonical_path(path)
         self._data_path = os.path.join(self.device_path, 'sas_port/', os.path.basename(self.device_path))
         super(Port, self).__init__(**kwargs)
 
     @property
     def expanders(self):
-        return sorted(glob.glob(os.path.join(self.device_path, 'expander-*')))
+        return list_sysfs(self.device_path, 'expander-*')
 
     @property
     def num_phys(self):
-        return get_sysfs_data(self.data_path, 'num_phys')
+        return self._read('num_phys')
 
     @property
     def data_path(self):
@@ -363,73 +606,196 @@ class Port(dict):
     @property
     def is_sas(self):
         try:
-            return os.path.exists(os.path.join(self.device_path, 'sas_port'))
+            return sysfs_exists(os.path.join(self.device_path, 'sas_port'))
         except OSError as e:
             logging.warning('Unable to determine if Port is SAS. %s', e)
             return False
 
-    def dump(self):
-        return {'num_phys': self.num_phys}
+
+class Expander(SysfsNode):
+    ATTRIBUTES = (
+        'bay_identifier', 'device_type', 'enclosure_identifier', 'initiator_port_protocols',
+        'phy_identifier', 'sas_address', 'target_port_protocols')
+    EXPANDER_ATTRIBUTES = (
+        'component_id', 'component_revision_id', 'component_vendor_id', 'level', 'product_id',
+        'product_rev', 'vendor_id')
+    FIELDS = (
+        'bay_identifier', 'component_id', 'component_revision_id', 'component_vendor_id', 'device_type',
+        'enclosure_identifier', 'initiator_port_protocols', 'level', 'phy_identifier', 'product_id',
+        'product_rev', 'sas_address', 'target_port_protocols', 'vendor_id')
+    __slots__ = ('_device_path', '_data_path', '_expander_data_path')
+
+    def __init__(self, path, canonical=False, **kwargs):
+        self._device_path = path if canonical else get_canonical_path(path)
+        self._data_path = os.path.join(self.device_path, 'sas_device/', os.path.basename(self.device_path))
+        self._expander_data_path = os.path.join(self.device_path, 'sas_expander/',
+                                                os.path.basename(self.device_path))
+        super(Expander, self).__init__(**kwargs)
+
+    @property
+    def bay_identifier(self):
+        return self._read('bay_identifier')
+
+    @property
+    def component_id(self):
+        return self._read('component_id', self.expander_data_path, self.EXPANDER_ATTRIBUTES)
+
+    @property
+    def component_revision_id(self):
+        return self._read('component_revision_id', self.expander_data_path, self.EXPANDER_ATTRIBUTES)
+
+    @property
+    def component_vendor_id(self):
+        return self._read('component_vendor_id', self.expander_data_path, self.EXPANDER_ATTRIBUTES)
+
+    @property
+    def device_type(self):
+        return self._read('device_type')
+
+    @property
+    def enclosure_identifier(self):
+        return self._read('enclosure_identifier')
+
+    @property
+    def initiator_port_protocols(self):
+        return self._read('initiator_port_protocols')
+
+    @property
+    def level(self):
+        return self._read('level', self.expander_data_path, self.EXPANDER_ATTRIBUTES)
+
+    @property
+    def phy_identifier(self):
+        return self._read('phy_identifier')
+
+    @property
+    def product_id(self):
+        return self._read('product_id', self.expander_data_path, self.EXPANDER_ATTRIBUTES)
+
+    @property
+    def product_rev(self):
+        return self._read('product_rev', self.expander_data_path, self.EXPANDER_ATTRIBUTES)
+
+    @property
+    def sas_address(self):
+        return self._read('sas_address')
+
+    @property
+    def target_port_protocols(self):
+        return self._read('target_port_protocols')
+
+    @property
+    def vendor_id(self):
+        return self._read('vendor_id', self.expander_data_path, self.EXPANDER_ATTRIBUTES)
+
+    @property
+    def data_path(self):
+        return self._data_path
+
+    @data_path.setter
+    def data_path(self, value):
+        self._data_path = value
+
+    @property
+    def device_path(self):
+        return self._device_path
+
+    @device_path.setter
+    def device_path(self, value):
+        self._device_path = value
+
+    @property
+    def name(self):
+        return os.path.basename(self.device_path)
+
+    @property
+    def expander_data_path(self):
+        return self._expander_data_path
+
+    def attribute_dirs(self):
+        return ((self.data_path, self.ATTRIBUTES), (self.expander_data_path, self.EXPANDER_ATTRIBUTES))
+
+    @property
+    def is_sas(self):
+        try:
+            return sysfs_exists(os.path.join(self.device_path, 'sas_expander'))
+        except OSError as e:
+            logging.warning('Unable to determine if Expander is SAS. %s', e)
+            return False
 
 
-class EndDevice(dict):
-    def __init__(self, path, **kwargs):
-        self._device_path = get_canonical_path(path)
+class EndDevice(SysfsNode):
+    ATTRIBUTES = (
+        'bay_identifier', 'device_type', 'enclosure_identifier', 'initiator_port_protocols',
+        'phy_identifier', 'sas_address', 'scsi_target_id', 'target_port_protocols')
+    SAS_ATTRIBUTES = (
+        'i_t_nexus_loss_timeout', 'initiator_response_timeout', 'ready_led_meaning', 'tlr_enabled',
+        'tlr_supported')
+    FIELDS = (
+        'bay_identifier', 'device_type', 'enclosure_identifier', 'i_t_nexus_loss_timeout',
+        'initiator_port_protocols', 'initiator_response_timeout', 'phy_identifier',
+        'ready_led_meaning', 'sas_address', 'scsi_target_id', 'target_port_protocols', 'tlr_enabled',
+        'tlr_supported')
+    OPTIONAL_FIELDS = READ_LATENCY_FIELDS
+    __slots__ = ('_device_path', '_data_path', '_sas_data_path')
+
+    def __init__(self, path, canonical=False, **kwargs):
+        self._device_path = path if canonical else get_canonical_path(path)
         self._data_path = os.path.join(self.device_path, 'sas_device/', os.path.basename(self.device_path))
         self._sas_data_path = os.path.join(self.device_path, 'sas_end_device/', os.path.basename(self.device_path))
         super(EndDevice, self).__init__(**kwargs)
 
     @property
     def bay_identifier(self):
-        return get_sysfs_data(self.data_path, 'bay_identifier')
+        return self._read('bay_identifier')
 
     @property
     def device_type(self):
-        return get_sysfs_data(self.data_path, 'device_type')
+        return self._read('device_type')
 
     @property
     def enclosure_identifier(self):
-        return get_sysfs_data(self.data_path, 'enclosure_identifier')
+        return self._read('enclosure_identifier')
 
     @property
     def i_t_nexus_loss_timeout(self):
-        return get_sysfs_data(self.sas_data_path, 'i_t_nexus_loss_timeout')
+        return self._read('i_t_nexus_loss_timeout', self.sas_data_path, self.SAS_ATTRIBUTES)
 
     @property
     def initiator_port_protocols(self):
-        return get_sysfs_data(self.data_path, 'initiator_port_protocols')
+        return self._read('initiator_port_protocols')
 
     @property
     def initiator_response_timeout(self):
-        return get_sysfs_data(self.sas_data_path, 'initiator_response_timeout')
+        return self._read('initiator_response_timeout', self.sas_data_path, self.SAS_ATTRIBUTES)
 
     @property
     def phy_identifier(self):
-        return get_sysfs_data(self.data_path, 'phy_identifier')
+        return self._read('phy_identifier')
 
     @property
     def ready_led_meaning(self):
-        return get_sysfs_data(self.sas_data_path, 'ready_led_meaning')
+        return self._read('ready_led_meaning', self.sas_data_path, self.SAS_ATTRIBUTES)
 
     @property
     def sas_address(self):
-        return get_sysfs_data(self.data_path, 'sas_address')
+        return self._read('sas_address')
 
     @property
     def scsi_target_id(self):
-        return get_sysfs_data(self.data_path, 'scsi_target_id')
+        return self._read('scsi_target_id')
 
     @property
     def target_port_protocols(self):
-        return get_sysfs_data(self.data_path, 'target_port_protocols')
+        return self._read('target_port_protocols')
 
     @property
     def tlr_enabled(self):
-        return get_sysfs_data(self.sas_data_path, 'tlr_enabled')
+        return self._read('tlr_enabled', self.sas_data_path, self.SAS_ATTRIBUTES)
 
     @property
     def tlr_supported(self):
-        return get_sysfs_data(self.sas_data_path, 'tlr_supported')
+        return self._read('tlr_supported', self.sas_data_path, self.SAS_ATTRIBUTES)
 
     @property
     def data_path(self):
@@ -455,33 +821,25 @@ class EndDevice(dict):
     def sas_data_path(self):
         return self._sas_data_path
 
+    def attribute_dirs(self):
+        return ((self.data_path, self.ATTRIBUTES), (self.sas_data_path, self.SAS_ATTRIBUTES))
+
     @property
     def is_sas(self):
         try:
-            return os.path.exists(os.path.join(self.device_path, 'sas_device'))
+            return sysfs_exists(os.path.join(self.device_path, 'sas_device'))
         except OSError as e:
             logging.warning('Unable to determine if EndDevice is SAS. %s', e)
             return False
 
-    def dump(self):
-        return {'bay_identifier': self.bay_identifier,
-             'device_type': self.device_type,
-             'enclosure_identifier': self.enclosure_identifier,
-             'i_t_nexus_loss_timeout': self.i_t_nexus_loss_timeout,
-             'initiator_port_protocols': self.initiator_port_protocols,
-             'initiator_response_timeout': self.initiator_response_timeout,
-             'phy_identifier': self.phy_identifier,
-             'ready_led_meaning': self.ready_led_meaning,
-             'sas_address': self.sas_address,
-             'scsi_target_id': self.scsi_target_id,
-             'target_port_protocols': self.target_port_protocols,
-             'tlr_enabled': self.tlr_enabled,
-             'tlr_supported': self.tlr_supported}
-
-
-class Target(object):
-    def __init__(self, path, **kwargs):
-        self._device_path = get_canonical_path(path)
+
+class Target(SysfsNode):
+    ATTRIBUTES = ()
+    FIELDS = ()
+    __slots__ = ('_device_path',)
+
+    def __init__(self, path, canonical=False, **kwargs):
+        self._device_path = path if canonical else get_canonical_path(path)
         super(Target, self).__init__(**kwargs)
 
     @property
@@ -500,134 +858,162 @@ class Target(object):
     def name(self):
         return os.path.basename(self.device_path)
 
-    def dump(self):
-        return {}
-
 
-class Device(object):
-    def __init__(self, path, **kwargs):
-        self._device_path = get_canonical_path(path)
+class Device(SysfsNode):
+    ATTRIBUTES = (
+        'device_blocked', 'device_busy', 'dh_state', 'eh_timeout', 'evt_capacity_change_reported',
+        'evt_inquiry_change_reported', 'evt_lun_change_reported', 'evt_media_change',
+        'evt_mode_parameter_change_reported', 'evt_soft_threshold_reached', 'inquiry',
+        'iocounterbits', 'iodone_cnt', 'ioerr_cnt', 'iorequest_cnt', 'model', 'queue_depth',
+        'queue_ramp_up_period', 'queue_type', 'rev', 'sas_address', 'sas_device_handle',
+        'scsi_level', 'state', 'timeout', 'type', 'vendor', 'vpd_pg80', 'vpd_pg83', 'wwid')
+    FIELDS = (
+        'designators', 'device_blocked', 'device_busy', 'dh_state', 'eh_timeout', 'evt_capacity_change_reported',
+        'evt_inquiry_change_reported', 'evt_lun_change_reported', 'evt_media_change',
+        'evt_mode_parameter_change_reported', 'evt_soft_threshold_reached', 'inquiry',
+        'iocounterbits', 'iodone_cnt', 'ioerr_cnt', 'iorequest_cnt', 'model', 'queue_depth',
+        'queue_ramp_up_period', 'queue_type', 'rev', 'sas_address', 'sas_device_handle', 'scsi_level',
+        'serial', 'state', 'timeout', 'type', 'vendor', 'vpd_pg80', 'vpd_pg83', 'wwid')
+    DYNAMIC_FIELDS = (
+        'device_blocked', 'device_busy', 'dh_state', 'iodone_cnt', 'ioerr_cnt', 'iorequest_cnt', 'queue_depth',
+        'state')
+    OPTIONAL_FIELDS = READ_LATENCY_FIELDS
+    FIELD_FILES = {'designators': 'vpd_pg83', 'serial': 'vpd_pg80'}
+    __slots__ = ('_device_path',)
+
+    def __init__(self, path, canonical=False, **kwargs):
+        self._device_path = path if canonical else get_canonical_path(path)
         super(Device, self).__init__(**kwargs)
 
     @property
     def device_blocked(self):
-        return get_sysfs_data(self.data_path, 'device_blocked')
+        return self._read('device_blocked')
 
     @property
     def device_busy(self):
-        return get_sysfs_data(self.data_path, 'device_busy')
+        return self._read('device_busy')
 
     @property
     def dh_state(self):
-        return get_sysfs_data(self.data_path, 'dh_state')
+        return self._read('dh_state')
 
     @property
     def eh_timeout(self):
-        return get_sysfs_data(self.data_path, 'eh_timeout')
+        return self._read('eh_timeout')
 
     @property
     def evt_capacity_change_reported(self):
-        return get_sysfs_data(self.data_path, 'evt_capacity_change_reported')
+        return self._read('evt_capacity_change_reported')
 
     @property
     def evt_inquiry_change_reported(self):
-        return get_sysfs_data(self.data_path, 'evt_inquiry_change_reported')
+        return self._read('evt_inquiry_change_reported')
 
     @property
     def evt_lun_change_reported(self):
-        return get_sysfs_data(self.data_path, 'evt_lun_change_reported')
+        return self._read('evt_lun_change_reported')
 
     @property
     def evt_media_change(self):
-        return get_sysfs_data(self.data_path, 'evt_media_change')
+        return self._read('evt_media_change')
 
     @property
     def evt_mode_parameter_change_reported(self):
-        return get_sysfs_data(self.data_path, 'evt_mode_parameter_change_reported')
+        return self._read('evt_mode_parameter_change_reported')
 
     @property
     def evt_soft_threshold_reached(self):
-        return get_sysfs_data(self.data_path, 'evt_soft_threshold_reached')
+        return self._read('evt_soft_threshold_reached')
 
     @property
     def inquiry(self):
-        return get_sysfs_data(self.data_path, 'inquiry')
+        return self._read('inquiry')
 
     @property
     def iocounterbits(self):
-        return get_sysfs_data(self.data_path, 'iocounterbits')
+        return self._read('iocounterbits')
 
     @property
     def iodone_cnt(self):
-        return get_sysfs_data(self.data_path, 'iodone_cnt')
+        return self._read('iodone_cnt')
 
     @property
     def ioerr_cnt(self):
-        return get_sysfs_data(self.data_path, 'ioerr_cnt')
+        return self._read('ioerr_cnt')
 
     @property
     def iorequest_cnt(self):
-        return get_sysfs_data(self.data_path, 'iorequest_cnt')
+        return self._read('iorequest_cnt')
 
     @property
     def model(self):
-        return get_sysfs_data(self.data_path, 'model')
+        return self._read('model')
 
     @property
     def queue_depth(self):
-        return get_sysfs_data(self.data_path, 'queue_depth')
+        return self._read('queue_depth')
 
     @property
     def queue_ramp_up_period(self):
-        return get_sysfs_data(self.data_path, 'queue_ramp_up_period')
+        return self._read('queue_ramp_up_period')
 
     @property
     def queue_type(self):
-        return get_sysfs_data(self.data_path, 'queue_type')
+        return self._read('queue_type')
 
     @property
     def rev(self):
-        return get_sysfs_data(self.data_path, 'rev')
+        return self._read('rev')
 
     @property
     def sas_address(self):
-        return get_sysfs_data(self.data_path, 'sas_address')
+        return self._read('sas_address')
 
     @property
     def sas_device_handle(self):
-        return get_sysfs_data(self.data_path, 'sas_device_handle')
+        return self._read('sas_device_handle')
 
     @property
     def scsi_level(self):
-        return get_sysfs_data(self.data_path, 'scsi_level')
+        return self._read('scsi_level')
+
+    @property
+    def serial(self):
+        """ The unit serial number, from VPD page 0x80 """
+        return decode_vpd_pg80(self.vpd_pg80)
+
+    @property
+    def designators(self):
+        """ The identifiers of the logical unit and its ports, from VPD page 0x83 """
+        return decode_vpd_pg83(self.vpd_pg83)
 
     @property
     def state(self):
-        return get_sysfs_data(self.data_path, 'state')
+        return self._read('state')
 
     @property
     def timeout(self):
-        return get_sysfs_data(self.data_path, 'timeout')
+        return self._read('timeout')
 
     @property
     def type(self):
-        return get_sysfs_data(self.data_path, 'type')
+        return self._read('type')
 
     @property
     def vendor(self):
-        return get_sysfs_data(self.data_path, 'vendor')
+        return self._read('vendor')
 
     @property
     def vpd_pg80(self):
-        return get_sysfs_data(self.data_path, 'vpd_pg80')
+        return self._read('vpd_pg80')
 
     @property
     def vpd_pg83(self):
-        return get_sysfs_data(self.data_path, 'vpd_pg83')
+        return self._read('vpd_pg83')
 
     @property
     def wwid(self):
-        return get_sysfs_data(self.data_path, 'wwid')
+        return self._read('wwid')
 
     @property
     def data_path(self):
@@ -648,92 +1034,70 @@ class Device(object):
     @property
     def is_sas(self):
         try:
-            return os.path.exists(os.path.join(self.device_path, 'sas_address'))
+            return sysfs_exists(os.path.join(self.device_path, 'sas_address'))
         except OSError as e:
             logging.warning('Unable to determine if Device is SAS. %s', e)
             return False
 
-    def dump(self):
-        return {'device_blocked': self.device_blocked,
-                'device_busy': self.device_busy,
-                'dh_state': self.dh_state,
-                'eh_timeout': self.eh_timeout,
-                'evt_capacity_change_reported': self.evt_capacity_change_reported,
-                'evt_inquiry_change_reported': self.evt_inquiry_change_reported,
-                'evt_lun_change_reported': self.evt_lun_change_reported,
-                'evt_media_change': self.evt_media_change,
-                'evt_mode_parameter_change_reported': self.evt_mode_parameter_change_reported,
-                'evt_soft_threshold_reached': self.evt_soft_threshold_reached,
-                'inquiry': self.inquiry,
-                'iocounterbits': self.iocounterbits,
-                'iodone_cnt': self.iodone_cnt,
-                'ioerr_cnt': self.ioerr_cnt,
-                'iorequest_cnt': self.iorequest_cnt,
-                'model': self.model,
-                'queue_depth': self.queue_depth,
-                'queue_ramp_up_period': self.queue_ramp_up_period,
-                'queue_type': self.queue_type,
-                'rev': self.rev,
-                'sas_address': self.sas_address,
-                'sas_device_handle': self.sas_device_handle,
-                'scsi_level': self.scsi_level,
-                'state': self.state,
-                'timeout': self.timeout,
-                'type': self.type,
-                'vendor': self.vendor,
-                'vpd_pg80': self.vpd_pg80,
-                'vpd_pg83': self.vpd_pg83,
-                'wwid': self.wwid}
-
-
-class BlockDevice(object):
-    def __init__(self, path, **kwargs):
-        self._device_path = get_canonical_path(path)
+
+class BlockDevice(SysfsNode):
+    ATTRIBUTES = (
+        'alignment_offset', 'badblocks', 'capability', 'dev', 'discard_alignment', 'ext_range',
+        'range', 'removable', 'ro', 'size', 'stat')
+    FIELDS = (
+        'alignment_offset', 'badblocks', 'capability', 'dev', 'discard_alignment', 'ext_range',
+        'range', 'removable', 'ro', 'size', 'stat')
+    DYNAMIC_FIELDS = ('badblocks', 'ro', 'size', 'stat')
+    OPTIONAL_FIELDS = READ_LATENCY_FIELDS
+    __slots__ = ('_device_path',)
+
+    def __init__(self, path, canonical=False, **kwargs):
+        self._device_path = path if canonical else get_canonical_path(path)
         super(BlockDevice, self).__init__(**kwargs)
 
     @property
     def alignment_offset(self):
-        return get_sysfs_data(self.data_path, 'alignment_offset')
+        return self._read('alignment_offset')
 
     @property
     def badblocks(self):
-        return get_sysfs_data(self.data_path, 'badblocks')
+        return self._read('badblocks')
 
     @property
     def capability(self):
-        return get_sysfs_data(self.data_path, 'capability')
+        return self._read('capability')
 
     @property
     def dev(self):
-        return get_sysfs_data(self.data_path, 'dev')
+        return self._read('dev')
 
     @property
     def discard_alignment(self):
-        return get_sysfs_data(self.data_path, 'discard_alignment')
+        return self._read('discard_alignment')
 
     @property
     def ext_range(self):
-        return get_sysfs_data(self.data_path, 'ext_range')
+        return self._read('ext_range')
 
     @property
     def range(self):
-        return get_sysfs_data(self.data_path, 'range')
+        return self._read('range')
 
     @property
     def removable(self):
-        return get_sysfs_data(self.data_path, 'removable')
+        return self._read('removable')
 
     @property
     def ro(self):
-        return get_sysfs_data(self.data_path, 'ro')
+        return self._read('ro')
 
     @property
     def size(self):
-        return get_sysfs_data(self.data_path, 'size')
+        return self._read('size')
 
     @property
     def stat(self):
-        return get_sysfs_data(self.data_path, 'stat')
+        return self._read('stat')
 
     @property
     def data_path(self):
@@ -757,25 +1121,27 @@ class BlockDevice(object):
         #  devices. Currently this fails intentionally.
         return False
 
-    def dump(self):
-        return {'alignment_offset': self.alignment_offset,
-             'badblocks': self.badblocks,
-             'capability': self.capability,
-             'dev': self.dev,
-             'discard_alignment': self.discard_alignment,
-             'ext_range': self.ext_range,
-             'range': self.range,
-             'removable': self.removable,
-             'ro': self.ro,
-             'size': self.size,
-             'stat': self.stat}
-
-
-class Host(dict):
-    def __init__(self, *args, **kwargs):
-        self._device_path = get_canonical_path('/sys/devices/virtual/dmi')
+
+class Host(SysfsNode):
+    ATTRIBUTES = (
+        'bios_date', 'bios_vendor', 'bios_version', 'board_asset_tag', 'board_name',
+        'board_serial', 'board_vendor', 'board_version', 'chassis_asset_tag', 'chassis_serial',
+        'chassis_type', 'chassis_vendor', 'chassis_version', 'product_family', 'product_name',
+        'product_serial', 'product_sku', 'product_uuid', 'product_version', 'sys_vendor')
+    FIELDS = (
+        'bios_date', 'bios_vendor', 'bios_version', 'board_asset_tag', 'board_name',
+        'board_serial', 'board_vendor', 'board_version', 'chassis_asset_tag', 'chassis_serial',
+        'chassis_type', 'chassis_vendor', 'chassis_version', 'hostname', 'product_family', 'product_name',
+        'product_serial', 'product_sku', 'product_uuid', 'product_version', 'sys_vendor')
+    # Not read from sysfs, and cheap to get
+    DYNAMIC_FIELDS = ('hostname',)
+    __slots__ = ('_device_path', '_data_path', 'targets')
+
+    def __init__(self, **kwargs):
+        self._device_path = get_canonical_path(
+            os.path.join(kwargs.get('sysroot', DEFAULT_SYSROOT), 'devices/virtual/dmi'))
         self._data_path = os.path.join(self.device_path, 'id/')
-        super(Host, self).__init__(*args, **kwargs)
+        super(Host, self).__init__(**kwargs)
         self.targets = []
 
     def __repr__(self):
@@ -832,83 +1198,83 @@ class Host(dict):
 
     @property
     def bios_date(self):
-        return get_sysfs_data(self.data_path, 'bios_date')
+        return self._read('bios_date')
 
     @property
     def bios_vendor(self):
-        return get_sysfs_data(self.data_path, 'bios_vendor')
+        return self._read('bios_vendor')
 
     @property
     def bios_version(self):
-        return get_sysfs_data(self.data_path, 'bios_version')
+        return self._read('bios_version')
 
     @property
     def board_asset_tag(self):
-        return get_sysfs_data(self.data_path, 'board_asset_tag')
+        return self._read('board_asset_tag')
 
     @property
     def board_name(self):
-        return get_sysfs_data(self.data_path, 'board_name')
+        return self._read('board_name')
 
     @property
     def board_serial(self):
-        return get_sysfs_data(self.data_path, 'board_serial')
+        return self._read('board_serial')
 
     @property
     def board_vendor(self):
-        return get_sysfs_data(self.data_path, 'board_vendor')
+        return self._read('board_vendor')
 
     @property
     def board_version(self):
-        return get_sysfs_data(self.data_path, 'board_version')
+        return self._read('board_version')
 
     @property
     def chassis_asset_tag(self):
-        return get_sysfs_data(self.data_path, 'chassis_asset_tag')
+        return self._read('chassis_asset_tag')
 
     @property
     def chassis_serial(self):
-        return get_sysfs_data(self.data_path, 'chassis_serial')
+        return self._read('chassis_serial')
 
     @property
     def chassis_type(self):
-        return get_sysfs_data(self.data_path, 'chassis_type')
+        return self._read('chassis_type')
 
     @property
     def chassis_vendor(self):
-        return get_sysfs_data(self.data_path, 'chassis_vendor')
+        return self._read('chassis_vendor')
 
     @property
     def chassis_version(self):
-        return get_sysfs_data(self.data_path, 'chassis_version')
+        return self._read('chassis_version')
 
     @property
     def product_family(self):
-        return get_sysfs_data(self.data_path, 'product_family')
+        return self._read('product_family')
 
     @property
     def product_name(self):
-        return get_sysfs_data(self.data_path, 'product_name')
+        return self._read('product_name')
 
     @property
     def product_serial(self):
-        return get_sysfs_data(self.data_path, 'product_serial')
+        return self._read('product_serial')
 
     @property
     def product_sku(self):
-        return get_sysfs_data(self.data_path, 'product_sku')
+        return self._read('product_sku')
 
     @property
     def product_uuid(self):
-        return get_sysfs_data(self.data_path, 'product_uuid')
+        return self._read('product_uuid')
 
     @property
     def product_version(self):
-        return get_sysfs_data(self.data_path, 'product_version')
+        return self._read('product_version')
 
     @property
     def sys_vendor(self):
-        return get_sysfs_data(self.data_path, 'sys_vendor')
+        return self._read('sys_vendor')
 
     @property
     def data_path(self):
@@ -926,62 +1292,886 @@ class Host(dict):
     def device_path(self, value):
         self._device_path = value
 
-    def dump(self):
-        return {'bios_date': self.bios_date,
-             'bios_vendor': self.bios_vendor,
-             'bios_version': self.bios_version,
-             'board_asset_tag': self.board_asset_tag,
-             'board_name': self.board_name,
-             'board_serial': self.board_serial,
-             'board_vendor': self.board_vendor,
-             'board_version': self.board_version,
-             'chassis_asset_tag': self.chassis_asset_tag,
-             'chassis_serial': self.chassis_serial,
-             'chassis_type': self.chassis_type,
-             'chassis_vendor': self.chassis_vendor,
-             'chassis_version': self.chassis_version,
-             'product_family': self.product_family,
-             'product_name': self.product_name,
-             'product_serial': self.product_serial,
-             'product_sku': self.product_sku,
-             'product_uuid': self.product_uuid,
-             'product_version': self.product_version,
-             'sys_vendor': self.sys_vendor}
+
+#
+# Read deadlines
+#
+# A read from a SCSI device's sysfs attributes can block while the kernel's
+# error handler fights with the device. Reads that exceed their budget are
+# abandoned on a daemon thread and reported as TIMED_OUT instead of a value.
+TIMED_OUT = '<timed out>'
+
+
+class ReadDeadlines(object):
+
+    def __init__(self, timeout=None, attribute_timeouts=None, deadline=None):
+        """
+        :param timeout: Seconds any single read may take, None for no limit
+        :type timeout: float
+        :param attribute_timeouts: Per attribute overrides of timeout
+        :type attribute_timeouts: dict
+        :param deadline: Seconds the whole run may spend reading, None for no limit
+        :type deadline: float
+        """
+        self.timeout = timeout
+        self.attribute_timeouts = attribute_timeouts or {}
+        self.deadline = deadline
+        self.expires = None
+        self.restart()
+        self._tasks = queue.Queue()
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def restart(self):
+        """
+        Start counting the run-wide deadline from now
+        """
+        if self.deadline is not None:
+            self.expires = time.monotonic() + self.deadline
+
+    def budget(self, item):
+        """
+        Return the seconds a read of item may take, or None if it is unbounded
+        """
+        timeout = self.attribute_timeouts.get(item, self.timeout)
+        if self.expires is not None:
+            remaining = self.expires - time.monotonic()
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def call(self, item, func, *args):
+        """
+        Run func(*args) within the budget of item and return its result, or
+        TIMED_OUT if it did not finish in time. Exceptions raised by func are
+        re-raised in the caller.
+        """
+        timeout = self.budget(item)
+        if timeout is None:
+            return func(*args)
+        if timeout <= 0:
+            return TIMED_OUT
+
+        task = [threading.Event(), None, None]
+        with self._lock:
+            if self._idle:
+                self._idle -= 1
+            else:
+                worker = threading.Thread(target=self._work, name='sysfs-reader')
+                worker.daemon = True
+                worker.start()
+        self._tasks.put((task, func, args))
+
+        if not task[0].wait(timeout):
+            return TIMED_OUT
+        if task[2] is not None:
+            raise task[2]
+        return task[1]
+
+    def _work(self):
+        # Workers stuck in a read are simply left behind; call() starts a
+        # new one whenever none is idle.
+        while True:
+            task, func, args = self._tasks.get()
+            try:
+                task[1] = func(*args)
+            except Exception as e:
+                task[2] = e
+            task[0].set()
+            with self._lock:
+                self._idle += 1
+
+
+read_deadlines = None
+
+
+def configure_read_deadlines(timeout=None, attribute_timeouts=None, deadline=None):
+    """
+    Bound all subsequent get_sysfs_data() calls. Without any limits, reads
+    are done inline with no overhead.
+    """
+    global read_deadlines
+    if timeout is None and not attribute_timeouts and deadline is None:
+        read_deadlines = None
+    else:
+        read_deadlines = ReadDeadlines(timeout, attribute_timeouts, deadline)
+
+
+slow_read_threshold = DEFAULT_SLOW_READ
+
+
+def configure_slow_reads(threshold=DEFAULT_SLOW_READ):
+    """
+    Count attribute reads taking threshold seconds or longer as slow from now on
+    """
+    global slow_read_threshold
+    slow_read_threshold = threshold
+
+
+#
+# Capture
+#
+# While a capture is configured, every sysfs path the walker lists, checks or
+# resolves is recorded, along with the contents of every attribute file it
+# reads. The recorded paths, the directories above them and the symlinks
+# leading to them can then be archived, and the archive extracted elsewhere
+# and walked with --sysroot. The links of the captured nodes in the index
+# directories are archived too, so disks can be looked up and found bottom-up
+# in the replay as well.
+#
+CAPTURE_INDEX_DIRS = ('block', os.path.join('dev', 'block'), os.path.join('bus', 'scsi', 'devices'))
+
+
+class Capture(object):
+    def __init__(self, sysroot):
+        self.sysroot = os.path.realpath(sysroot)
+        self.paths = set()
+        self.files = {}
+
+    def add_path(self, path):
+        self.paths.add(path)
+
+    def add_paths(self, paths):
+        self.paths.update(paths)
+
+    def add_file(self, path, data):
+        self.files[path] = data
+
+    def index_links(self):
+        """
+        Return the symlinks in CAPTURE_INDEX_DIRS, and those of captured
+        ports to their phys, that lead to a captured node. Links to nodes
+        that were not walked are left out, so the replay holds no node
+        without its attributes.
+
+        :rtype: list
+        """
+        captured = set(os.path.realpath(path) for path in self.paths)
+        index_paths = [os.path.join(self.sysroot, directory) for directory in CAPTURE_INDEX_DIRS]
+        # The walk finds ports through their phys, bottom-up discovery finds phys through their ports
+        index_paths.extend(sorted(path for path in captured if os.path.basename(path).startswith('port-')))
+        links = []
+        for index_path in index_paths:
+            try:
+                names = os.listdir(index_path)
+            except (IOError, OSError) as e:
+                logging.debug('Not capturing %s. %s', index_path, e)
+                continue
+            for name in names:
+                link = os.path.join(index_path, name)
+                if os.path.islink(link) and os.path.realpath(link) in captured:
+                    links.append(link)
+        return links
+
+    def members(self):
+        """
+        Return the type and link target or contents of every path to archive,
+        by path relative to sysroot. Symlinks on the way to a recorded path
+        are archived as symlinks and followed.
+
+        :rtype: dict
+        """
+        files = dict((os.path.realpath(path), data) for path, data in self.files.items())
+        members = {}
+        pending = list(self.paths) + list(self.files) + self.index_links()
+        while pending:
+            path = pending.pop()
+            relative = os.path.relpath(os.path.abspath(path), self.sysroot)
+            if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+                logging.debug('Not capturing %s, it is outside of %s', path, self.sysroot)
+                continue
+            parts = [] if relative == os.curdir else relative.split(os.sep)
+            for depth in range(1, len(parts) + 1):
+                name = os.sep.join(parts[:depth])
+                member = members.get(name)
+                if member is None:
+                    full_path = os.path.join(self.sysroot, name)
+                    if os.path.islink(full_path):
+                        member = (tarfile.SYMTYPE, os.readlink(full_path))
+                    elif full_path in files:
+                        member = (tarfile.REGTYPE, files[full_path])
+                    elif os.path.isdir(full_path):
+                        member = (tarfile.DIRTYPE, None)
+                    else:
+                        # Only checked for existence, never read
+                        member = (tarfile.REGTYPE, b'')
+                    members[name] = member
+                if member[0] == tarfile.SYMTYPE:
+                    target = os.path.realpath(os.path.join(self.sysroot, name))
+                    pending.append(os.path.join(target, *parts[depth:]))
+                    break
+        return members
+
+    def write(self, path):
+        """
+        Write the captured tree to the tar archive path, compressed if path
+        ends in .tar.gz or .tgz. Members are stored below sys/.
+        """
+        mtime = time.time()
+        members = self.members()
+        with tarfile.open(path, 'w:gz' if path.endswith(('.tar.gz', '.tgz')) else 'w') as archive:
+            for name in sorted(members):
+                kind, value = members[name]
+                info = tarfile.TarInfo(os.path.join('sys', name))
+                info.type = kind
+                info.mtime = mtime
+                if kind == tarfile.DIRTYPE:
+                    info.mode = 0o755
+                    archive.addfile(info)
+                elif kind == tarfile.SYMTYPE:
+                    info.mode = 0o777
+                    info.linkname = value
+                    archive.addfile(info)
+                else:
+                    info.mode = 0o444
+                    info.size = len(value)
+                    archive.addfile(info, io.BytesIO(value))
+        logging.info('Captured %d sysfs paths to %s', len(members), path)
+
+
+capture = None
+
+
+def configure_capture(sysroot=None):
+    """
+    Record the sysfs paths touched from now on, below sysroot. Without a
+    sysroot, nothing is recorded.
+    """
+    global capture
+    capture = None if sysroot is None else Capture(sysroot)
+
+
+#
+# Read profiling
+#
+# While a profile is configured, the time taken by every sysfs read,
+# directory listing and path resolution is recorded along with the layer of
+# the node it was for, to find the disks, HBAs and attributes a slow run
+# spends its time on.
+#
+# Upper bounds, in seconds, of the latency histogram buckets
+PROFILE_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0)
+
+
+def profile_layer(path):
+    """
+    Return the name of the node class path belongs to, judging by the
+    nearest node directory on it, 'Host' for DMI attributes or 'sysfs' for
+    anything else
+    """
+    parts = path.rstrip(os.sep).split(os.sep)
+    for index in range(len(parts) - 1, -1, -1):
+        part = parts[index]
+        if index and parts[index - 1] == 'block' and part.startswith('sd'):
+            return 'BlockDevice'
+        if _HOST_NAME.match(part):
+            return 'Hba'
+        for pattern, cls in _NODE_NAMES:
+            if pattern.match(part):
+                return cls.__name__
+        if part == 'dmi':
+            return 'Host'
+    return 'sysfs'
+
+
+class ReadProfile(object):
+    """
+    Latency of every sysfs operation of a run, as (layer, operation,
+    directory, path, seconds). Operations are attribute names for reads,
+    "<list PATTERN>" for directory listings and "<realpath>" for path
+    resolution.
+    """
+    def __init__(self):
+        self.samples = []
+        self.started = time.monotonic()
+
+    def add(self, directory, operation, path, seconds):
+        self.samples.append((profile_layer(directory), operation, directory, path, seconds))
+
+    def layers(self):
+        """
+        Return [layer, operations, seconds] for every layer, slowest first
+
+        :rtype: list
+        """
+        layers = {}
+        for layer, _, _, _, seconds in self.samples:
+            totals = layers.setdefault(layer, [layer, 0, 0.0])
+            totals[1] += 1
+            totals[2] += seconds
+        return sorted(layers.values(), key=lambda totals: -totals[2])
+
+    def operations(self):
+        """
+        Return the sorted latencies of every (layer, operation), slowest in
+        total first
+
+        :rtype: list
+        """
+        latencies = {}
+        for layer, operation, _, _, seconds in self.samples:
+            latencies.setdefault((layer, operation), []).append(seconds)
+        for values in latencies.values():
+            values.sort()
+        return sorted(latencies.items(), key=lambda item: -sum(item[1]))
+
+    def nodes(self, count):
+        """
+        Return [layer, directory, operations, seconds] for the count
+        directories that took longest in total
+
+        :rtype: list
+        """
+        directories = {}
+        for layer, _, directory, _, seconds in self.samples:
+            totals = directories.setdefault(directory, [layer, directory, 0, 0.0])
+            totals[2] += 1
+            totals[3] += seconds
+        return sorted(directories.values(), key=lambda totals: -totals[3])[:count]
+
+    def slowest(self, count):
+        """
+        Return the count slowest samples, slowest first
+
+        :rtype: list
+        """
+        return sorted(self.samples, key=lambda sample: -sample[4])[:count]
+
+
+def percentile(values, fraction):
+    """
+    Return the value below which fraction of the sorted values fall
+    """
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def milliseconds(seconds):
+    return '{:.3f}'.format(seconds * 1000)
+
+
+def write_profile(out, profile, count=20):
+    """
+    Write the time spent per layer, latency percentiles and histograms per
+    attribute, and the count slowest directories and files of profile to out
+    """
+    total = sum(sample[4] for sample in profile.samples)
+    bucket_names = ['<{:g}'.format(bound * 1000) for bound in PROFILE_BUCKETS] + [
+        '>={:g}'.format(PROFILE_BUCKETS[-1] * 1000)]
+    operations = []
+    for (layer, operation), values in profile.operations():
+        buckets = [0] * (len(PROFILE_BUCKETS) + 1)
+        bucket = 0
+        for value in values:
+            while bucket < len(PROFILE_BUCKETS) and value >= PROFILE_BUCKETS[bucket]:
+                bucket += 1
+            buckets[bucket] += 1
+        operations.append([layer, operation, len(values)] + [
+            milliseconds(value) for value in (percentile(values, 0.5), percentile(values, 0.9),
+                                              percentile(values, 0.99), values[-1], sum(values))] + buckets)
+    tables = [
+        'Profile: {} sysfs operations taking {} ms, in a run of {} ms'.format(
+            len(profile.samples), milliseconds(total), milliseconds(time.monotonic() - profile.started)),
+        format_table('Time per layer', ['Layer', 'Operations', 'Total (ms)', 'Share'],
+                     [(layer, number, milliseconds(seconds), '{:.1f}%'.format(100 * seconds / total if total else 0))
+                      for layer, number, seconds in profile.layers()]),
+        format_table('Latency per attribute (ms)',
+                     ['Layer', 'Attribute', 'Count', 'p50', 'p90', 'p99', 'Max', 'Total'] + bucket_names, operations),
+        format_table('Slowest nodes', ['Total (ms)', 'Operations', 'Layer', 'Directory'],
+                     [(milliseconds(seconds), number, layer, directory)
+                      for layer, directory, number, seconds in profile.nodes(count)]),
+        format_table('Slowest files and listings', ['Time (ms)', 'Layer', 'Path'],
+                     [(milliseconds(seconds), layer, path) for layer, _, _, path, seconds in profile.slowest(count)]),
+    ]
+    out.write('\n\n'.join(tables) + '\n')
+
+
+profile = None
+
+
+def configure_profile(enabled=False):
+    """
+    Record the latency of every sysfs operation from now on, or stop
+    """
+    global profile
+    profile = ReadProfile() if enabled else None
+
+
+#
+# Value normalization
+#
+# Values are parsed straight from the bytes read, by a parser picked per
+# attribute name. Attributes without a dedicated parser are treated as text.
+_LINKRATE = re.compile(br'\s*(\d+(?:\.\d+)?)\s*Gbit\s*$')
+_SAS_ADDRESS = re.compile(br'\s*0x([0-9a-fA-F]{1,16})\s*$')
+
+
+def parse_text(raw):
+    """
+    Decode raw and collapse runs of whitespace. Punctuation is kept.
+    """
+    return ' '.join(raw.decode('utf-8', 'replace').split())
+
+
+def parse_int(raw):
+    """
+    Parse a decimal or 0x prefixed hexadecimal integer. Values that are not
+    numbers, such as an eh_deadline of "off", are returned as text.
+    """
+    try:
+        return int(raw)
+    except ValueError:
+        pass
+    try:
+        return int(raw, 0)
+    except ValueError:
+        return parse_text(raw)
+
+
+def parse_sas_address(raw):
+    """
+    Return a SAS address as 0x followed by 16 lower case hex digits
+    """
+    match = _SAS_ADDRESS.match(raw)
+    if match is None:
+        return parse_text(raw)
+    return '0x{:016x}'.format(int(match.group(1), 16))
+
+
+def parse_linkrate(raw):
+    """
+    Return a link rate such as "6.0 Gbit". States like "Unknown" or
+    "Phy disabled" are returned as text.
+    """
+    match = _LINKRATE.match(raw)
+    if match is None:
+        return parse_text(raw)
+    return match.group(1).decode('ascii') + ' Gbit'
+
+
+def parse_counters(raw):
+    """
+    Parse a whitespace separated vector of counters, e.g. a block device stat
+    """
+    try:
+        return [int(value) for value in raw.split()]
+    except ValueError:
+        return parse_text(raw)
+
+
+def parse_bytes(raw):
+    """
+    Binary attributes such as VPD pages are returned untouched
+    """
+    return raw
+
+
+PARSERS = {}
+PARSERS.update(dict.fromkeys((
+    # Hba
+    'can_queue', 'cmd_per_lun', 'eh_deadline', 'fw_queue_depth', 'host_busy', 'ioc_reset_count', 'io_delay',
+    'prot_capabilities', 'prot_guard_type', 'reply_queue_count', 'sg_prot_tablesize', 'sg_tablesize',
+    'unchecked_isa_dma', 'unique_id', 'use_blk_mq',
+    # Phy
+    'enable', 'invalid_dword_count', 'loss_of_dword_sync_count', 'phy_identifier', 'phy_reset_problem_count',
+    'running_disparity_error_count',
+    # Port
+    'num_phys',
+    # Expander
+    'component_id', 'component_revision_id', 'level',
+    # EndDevice
+    'bay_identifier', 'i_t_nexus_loss_timeout', 'initiator_response_timeout', 'ready_led_meaning',
+    'scsi_target_id', 'tlr_enabled', 'tlr_supported',
+    # Device
+    'device_blocked', 'device_busy', 'eh_timeout', 'evt_capacity_change_reported', 'evt_inquiry_change_reported',
+    'evt_lun_change_reported', 'evt_media_change', 'evt_mode_parameter_change_reported',
+    'evt_soft_threshold_reached', 'iocounterbits', 'iodone_cnt', 'ioerr_cnt', 'iorequest_cnt', 'queue_depth',
+    'queue_ramp_up_period', 'scsi_level', 'timeout', 'type',
+    # BlockDevice
+    'alignment_offset', 'discard_alignment', 'ext_range', 'range', 'removable', 'ro', 'size'), parse_int))
+PARSERS.update(dict.fromkeys(('enclosure_identifier', 'host_sas_address', 'sas_address'), parse_sas_address))
+PARSERS.update(dict.fromkeys(('maximum_linkrate', 'maximum_linkrate_hw', 'minimum_linkrate', 'minimum_linkrate_hw',
+                              'negotiated_linkrate'), parse_linkrate))
+PARSERS.update(dict.fromkeys(('stat',), parse_counters))
+PARSERS.update(dict.fromkeys(('inquiry', 'vpd_pg80', 'vpd_pg83'), parse_bytes))
+
+
+def decode_vpd_pg80(page):
+    """
+    Return the product serial number held in a Unit Serial Number VPD page,
+    TIMED_OUT if reading the page was given up on, or None if page is not one.
+
+    :type page: bytes
+    :rtype: str
+    """
+    if page is TIMED_OUT:
+        return TIMED_OUT
+    if not isinstance(page, bytes) or len(page) < 4 or page[1] != 0x80:
+        return None
+    length = int.from_bytes(page[2:4], 'big')
+    return page[4:4 + length].decode('ascii', 'replace').strip(' \t\0') or None
+
+
+# Device Identification VPD page fields, see SPC-5 7.7.6
+DESIGNATOR_ASSOCIATIONS = ('lun', 'target_port', 'target_device')
+DESIGNATOR_TYPES = {
+    0x0: 'vendor',
+    0x1: 't10',
+    0x2: 'eui64',
+    0x3: 'naa',
+    0x4: 'relative_port',
+    0x5: 'target_port_group',
+    0x6: 'logical_unit_group',
+    0x7: 'md5',
+    0x8: 'scsi_name',
+    0x9: 'protocol_specific',
+    0xa: 'uuid',
+}
+DESIGNATOR_PROTOCOLS = {
+    0x0: 'fcp', 0x1: 'spi', 0x2: 'ssa', 0x3: 'sbp', 0x4: 'srp', 0x5: 'iscsi', 0x6: 'sas', 0x7: 'adt',
+    0x8: 'ata', 0x9: 'uas', 0xa: 'sop', 0xb: 'pcie',
+}
+_CODE_SET_ASCII, _CODE_SET_UTF8 = 0x2, 0x3
+
+
+def designator_value(kind, code_set, data):
+    """
+    Return the value of a designator of a Device Identification VPD page:
+    identifiers as the kernel writes them to wwid (naa., eui., t10.),
+    port and group numbers as integers, text as text and anything else as
+    hex
+
+    :param kind: The designator type's name, see DESIGNATOR_TYPES
+    :type data: bytes
+    """
+    if kind in ('relative_port', 'target_port_group', 'logical_unit_group') and len(data) == 4:
+        return int.from_bytes(data[2:4], 'big')
+    if kind == 'naa':
+        return 'naa.' + data.hex()
+    if kind == 'eui64':
+        return 'eui.' + data.hex()
+    if kind == 'uuid' and len(data) == 18:
+        value = data[2:].hex()
+        return '-'.join((value[:8], value[8:12], value[12:16], value[16:20], value[20:]))
+    if code_set in (_CODE_SET_ASCII, _CODE_SET_UTF8):
+        text = data.decode('utf-8' if code_set == _CODE_SET_UTF8 else 'ascii', 'replace').rstrip('\0').strip()
+        return 't10.' + text if kind == 't10' else text
+    return data.hex()
+
+
+def decode_vpd_pg83(page):
+    """
+    Return the designators held in a Device Identification VPD page,
+    TIMED_OUT if reading the page was given up on, or None if page is not
+    one. Each is a dict of what it designates (the
+    logical unit, the target port or the target device), its type, the
+    protocol it is specific to if any, and its value.
+
+    :type page: bytes
+    :rtype: list
+    """
+    if page is TIMED_OUT:
+        return TIMED_OUT
+    if not isinstance(page, bytes) or len(page) < 4 or page[1] != 0x83:
+        return None
+    end = min(len(page), 4 + int.from_bytes(page[2:4], 'big'))
+    designators = []
+    offset = 4
+    while offset + 4 <= end:
+        header = page[offset:offset + 4]
+        data = page[offset + 4:offset + 4 + header[3]]
+        offset += 4 + header[3]
+        if offset > end:
+            break
+        association = (header[1] >> 4) & 0x3
+        kind = DESIGNATOR_TYPES.get(header[1] & 0xf, 'reserved')
+        # The protocol identifier is valid for target port and device designators with PIV set
+        protocol = None
+        if header[1] & 0x80 and association in (1, 2):
+            protocol = DESIGNATOR_PROTOCOLS.get(header[0] >> 4, header[0] >> 4)
+        designators.append({
+            'association': DESIGNATOR_ASSOCIATIONS[association] if association < 3 else 'reserved',
+            'type': kind,
+            'protocol': protocol,
+            'value': designator_value(kind, header[0] & 0xf, data),
+        })
+    return designators
+
+
+def linkrate_gbit(value):
+    """
+    Return a link rate such as "6.0 Gbit" as a number of Gbit/s, or None for
+    states like "Unknown"
+    """
+    if isinstance(value, str) and value.endswith(' Gbit'):
+        return float(value[:-5])
+    return None
+
+
+def json_default(value):
+    """
+    Serialize values json cannot handle natively. Binary attributes are
+    written as hex strings.
+    """
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+#
+# Listing cache
+#
+# The walk lists every directory of the topology and resolves the canonical
+# path of every node, whose symlinks share long prefixes with hundreds of
+# siblings. While a cache is configured, each directory is listed once with
+# os.scandir() and canonical paths are resolved one component at a time,
+# memoized by prefix, using the file types the listings already returned.
+#
+# Symlinks followed while resolving one path before giving up, as the kernel does
+MAX_SYMLINKS = 40
+
+
+class SysfsCache(object):
+    """
+    Directory listings and canonical paths seen by a run. Listings are not
+    refreshed, so long-running modes clear() the cache before each walk.
+    """
+    def __init__(self):
+        self.listings = {}
+        self.paths = {}
+
+    def clear(self):
+        self.listings = {}
+        self.paths = {}
+
+    def entries(self, path):
+        """
+        Return whether each entry of directory path is a symlink, by name, an
+        empty dict if it cannot be listed
+
+        :rtype: dict
+        """
+        listing = self.listings.get(path)
+        if listing is None:
+            try:
+                with os.scandir(path) as entries:
+                    listing = dict((entry.name, entry.is_symlink()) for entry in entries)
+            except OSError:
+                listing = {}
+            self.listings[path] = listing
+        return listing
+
+    def glob(self, path, pattern):
+        """
+        Return the sorted paths below path matching pattern, whose wildcards
+        may only be in its last component, as glob.glob() would
+        """
+        directory, pattern = os.path.split(pattern)
+        directory = os.path.join(path, directory) if directory else path
+        names = self.entries(directory)
+        if not glob.has_magic(pattern):
+            return [os.path.join(directory, pattern)] if pattern in names else []
+        return [os.path.join(directory, name) for name in sorted(fnmatch.filter(names, pattern))]
+
+    def exists(self, path):
+        path = self.realpath(path)
+        directory, name = os.path.split(path)
+        return not name or name in self.entries(directory)
+
+    def realpath(self, path, depth=0):
+        """
+        Return the canonical form of path, as os.path.realpath() would
+        """
+        path = os.path.abspath(path)
+        resolved = self.paths.get(path)
+        if resolved is None:
+            directory, name = os.path.split(path)
+            if not name:
+                return path
+            directory = self.realpath(directory, depth)
+            resolved = os.path.join(directory, name)
+            if self.entries(directory).get(name):
+                if depth >= MAX_SYMLINKS:
+                    return os.path.realpath(path)
+                try:
+                    target = os.readlink(resolved)
+                except OSError:
+                    return os.path.realpath(path)
+                resolved = self.realpath(os.path.join(directory, target), depth + 1)
+            self.paths[path] = resolved
+        return resolved
+
+
+sysfs_cache = None
+
+
+def configure_sysfs_cache(enabled=False):
+    """
+    Cache directory listings and canonical paths from now on, or stop
+    """
+    global sysfs_cache
+    sysfs_cache = SysfsCache() if enabled else None
 
 
 #
 # Helper functions
 #
 def get_canonical_path(path):
-    return os.path.realpath(os.path.abspath(path))
-    
+    if capture is not None:
+        capture.add_path(path)
+    started = time.perf_counter()
+    if sysfs_cache is not None:
+        canonical = sysfs_cache.realpath(path)
+    else:
+        canonical = os.path.realpath(os.path.abspath(path))
+    if profile is not None:
+        profile.add(canonical, '<realpath>', path, time.perf_counter() - started)
+    return canonical
+
+
+def list_sysfs(path, pattern):
+    """
+    Return the sorted paths of the entries below directory path that match
+    the glob pattern
+
+    :rtype: list
+    """
+    started = time.perf_counter()
+    if sysfs_cache is not None:
+        paths = sysfs_cache.glob(path, pattern)
+    else:
+        paths = sorted(glob.glob(os.path.join(path, pattern)))
+    if profile is not None:
+        profile.add(path, '<list {}>'.format(pattern), os.path.join(path, pattern), time.perf_counter() - started)
+    if capture is not None:
+        capture.add_path(path)
+        capture.add_paths(paths)
+    return paths
+
+
+def sysfs_exists(path):
+    exists = os.path.exists(path) if sysfs_cache is None else sysfs_cache.exists(path)
+    if exists and capture is not None:
+        capture.add_path(path)
+    return exists
+
+
+_buffers = threading.local()
+
+
+def read_file(path):
+    """
+    Return the contents of a sysfs attribute file as bytes.
+
+    The file is read with a single open/read/close into a buffer reused by
+    the calling thread. sysfs returns a whole attribute on the first read, so
+    a short read is taken as the end of the file rather than spending another
+    read() to see EOF.
+    """
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None:
+        buf = _buffers.buf = bytearray(4096)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.readv(fd, [buf])
+        while size == len(buf):
+            # Larger than the buffer, e.g. a binary attribute. Grow and carry on.
+            buf.extend(bytes(len(buf)))
+            with memoryview(buf) as view:
+                count = os.readv(fd, [view[size:]])
+            if not count:
+                break
+            size += count
+    finally:
+        os.close(fd)
+    data = bytes(buf[:size])
+    if capture is not None:
+        capture.add_file(path, data)
+    return data
+
 
 def get_sysfs_data(devicepath, item):
     itempath = os.path.join(devicepath, item)
     logging.debug('Reading %s', itempath)
+    started = time.perf_counter()
     try:
-        itemfile = open(itempath, mode='r')
-        itemdata = itemfile.read()
-        itemfile.close()
-        itemdata = re.sub(r'[^\w\s]+','', itemdata)
-        itemdata = re.sub(r'\s{2,}',' ', itemdata).strip()
-        return itemdata
+        if read_deadlines is None:
+            itemdata = read_file(itempath)
+        else:
+            itemdata = read_deadlines.call(item, read_file, itempath)
+            if itemdata is TIMED_OUT:
+                logging.warning('Timed out reading %s from %s', item, devicepath)
+                return TIMED_OUT
+        return PARSERS.get(item, parse_text)(itemdata)
     except Exception as e:
         logging.warning('Unable to read %s from %s. %s', item, devicepath, e)
         return None
+    finally:
+        # Failed and timed out reads are often the slowest
+        if profile is not None:
+            profile.add(devicepath, item, itempath, time.perf_counter() - started)
+
+
+def read_sysfs_attributes(devicepath, items=None, observe=None):
+    """
+    Read the attribute files of devicepath in one pass. The directory is
+    listed once, and only regular files that are present (and named in items,
+    if given) are opened.
+
+    :param devicepath: Attribute directory to read
+    :type devicepath: str
+    :param items: Attribute file names to read, None for every regular file
+    :type items: tuple
+    :param observe: Called with devicepath, the attribute name and the
+        seconds it took after every read
+    :return: Attribute name to value, as returned by get_sysfs_data()
+    :rtype: dict
+    """
+    if items is not None and not items:
+        return {}
+    started = time.perf_counter()
+    try:
+        entries = os.scandir(devicepath)
+    except OSError as e:
+        logging.warning('Unable to list %s. %s', devicepath, e)
+        return {}
+    finally:
+        if profile is not None:
+            profile.add(devicepath, '<list>', devicepath, time.perf_counter() - started)
+    if capture is not None:
+        capture.add_path(devicepath)
+    snapshot = {}
+    with entries:
+        for entry in entries:
+            if items is not None and entry.name not in items:
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            if observe is None:
+                snapshot[entry.name] = get_sysfs_data(devicepath, entry.name)
+            else:
+                started = time.monotonic()
+                snapshot[entry.name] = get_sysfs_data(devicepath, entry.name)
+                observe(devicepath, entry.name, time.monotonic() - started)
+    return snapshot
 
 
 #
 # Collect Classes
 #
-def collect_hbas():
+def collect_hbas(sysroot=DEFAULT_SYSROOT, ttl=None):
     """
     Return a list of HBA devices found by this host
+
+    :param sysroot: Where sysfs is mounted
+    :type sysroot: str
+    :param ttl: Seconds the HBAs and the nodes below them keep what they read
+    :type ttl: float
     :rtype: list
     """
+    if fast_discovery:
+        return discover_hbas(sysroot, ttl)
     hbas = []
-    for hba_path in sorted(glob.glob('/sys/bus/scsi/devices/host*')):
-        hba = Hba(path=hba_path)
+    for hba_path in list_sysfs(sysroot, 'bus/scsi/devices/host*'):
+        hba = Hba(path=hba_path, sysroot=sysroot, ttl=ttl)
         hbas.append(hba)
 
     return hbas
@@ -991,13 +2181,13 @@ def collect_phys(hba):
     """
     Return a list of Phys controlled by hba
 
-    :param hba: An Hba class representing a SAS/SATA HBA
+    :param hba: An Hba class representing a SAS/SATA HBA, or an Expander
     :type hba: Hba
     :rtype: list
     """
     phys = []
-    for phy_path in sorted(glob.glob(os.path.join(hba.device_path, 'phy-*'))):
-        phy = Phy(path=phy_path)
+    for phy_path in list_sysfs(hba.device_path, 'phy-*'):
+        phy = Phy(path=phy_path, sysroot=hba.sysroot, ttl=hba.ttl)
         phys.append(phy)
 
     return phys
@@ -1012,13 +2202,29 @@ def collect_ports(phy):
     :rtype: list
     """
     ports = []
-    for port_path in sorted(glob.glob(os.path.join(phy.device_path, 'port'))):
-        port = Port(path=port_path)
+    for port_path in list_sysfs(phy.device_path, 'port'):
+        port = Port(path=port_path, sysroot=phy.sysroot, ttl=phy.ttl)
         ports.append(port)
 
     return ports
 
 
+def collect_expanders(port):
+    """
+    Return a list of SAS expanders connected to port
+
+    :param port: A Port class representing a SAS/SATA port
+    :type port: Port
+    :rtype: list
+    """
+    expanders = []
+    for expander_path in port.expanders:
+        expander = Expander(path=expander_path, sysroot=port.sysroot, ttl=port.ttl)
+        expanders.append(expander)
+
+    return expanders
+
+
 def collect_end_devices(port):
     """
     Return a list of SAS/SATA end devices connected to port
@@ -1028,8 +2234,8 @@ def collect_end_devices(port):
     :rtype: list
     """
     end_devices = []
-    for end_device_path in sorted(glob.glob(os.path.join(port.device_path, 'end_device-*'))):
-        end_device = EndDevice(path=end_device_path)
+    for end_device_path in list_sysfs(port.device_path, 'end_device-*'):
+        end_device = EndDevice(path=end_device_path, sysroot=port.sysroot, ttl=port.ttl)
         end_devices.append(end_device)
 
     return end_devices
@@ -1044,8 +2250,8 @@ def collect_targets(end_device):
     :rtype: list
     """
     targets = []
-    for target_path in sorted(glob.glob(os.path.join(end_device.device_path, 'target[0-9]*'))):
-        target = Target(path=target_path)
+    for target_path in list_sysfs(end_device.device_path, 'target[0-9]*'):
+        target = Target(path=target_path, sysroot=end_device.sysroot, ttl=end_device.ttl)
         targets.append(target)
 
     return targets
@@ -1060,8 +2266,8 @@ def collect_target_devices(target):
     :rtype: list
     """
     devices = []
-    for target_device_path in sorted(glob.glob(os.path.join(target.device_path, '[0-9]*'))):
-        device = Device(path=target_device_path)
+    for target_device_path in list_sysfs(target.device_path, '[0-9]*'):
+        device = Device(path=target_device_path, sysroot=target.sysroot, ttl=target.ttl)
         devices.append(device)
 
     return devices
@@ -1076,126 +2282,2961 @@ def collect_block_devices(device):
     :rtype: list
     """
     block_devices = []
-    for block_device_path in sorted(glob.glob(os.path.join(device.device_path, 'block/sd*'))):
-        device = BlockDevice(path=block_device_path)
+    for block_device_path in list_sysfs(device.device_path, 'block/sd*'):
+        device = BlockDevice(path=block_device_path, sysroot=device.sysroot, ttl=device.ttl)
         block_devices.append(device)
 
     return block_devices
 
 
-def collect_host_data():
-    host = Host()
+def collect_host_data(sysroot=DEFAULT_SYSROOT, ttl=None):
+    host = Host(sysroot=sysroot, ttl=ttl)
     return host
 
 
 #
-# Main function walks sysfs, fetching data about the SCSI bus
+# Static field cache
 #
-def main():
-    logging.basicConfig(
-        format='%(levelname)s: %(message)s',
-        level=logging.ERROR
-    )
-    logging.info('Collecting device information')
+DEFAULT_STATIC_CACHE = '/var/cache/diskinfo/static.json'
+STATIC_CACHE_VERSION = 1
 
-    # Use new functions to iterate through classes instead of the kludge of
-    # previous functions.
 
-    #
-    # Hba x -> Phy x -> Port x -> [Expander -> Phy -> Port ->] EndDevice x -> Target x -> Device x -> BlockDevice
-    #
-    tree = {
-        'blockdevcount': 0,
-        'devicecount': 0,
-        'hostcount': 0,
-        'hosts': {},
-        'luncount': 0,
-        'phycount': 0,
-        'portcount': 0,
-        'system': None,
-        'targetcount': 0
-    }
-    host = collect_host_data()
-    tree['system'] = host.dump()
-
-    # Collect Hbas
-    hba_devices = collect_hbas()
-    if hba_devices:
-        tree['hostcount'] = len(hba_devices)
-    for hba in hba_devices:
-        tree['hosts'][hba.name] = hba.dump()
-        # Note: If there are no PHYs, this is a SATA HBA, slip to Targets
-
-        # Collect Phys
-        phys = collect_phys(hba)
-        if phys:
-            tree['phycount'] += len(phys)
-            for phy in phys:
-                tree['hosts'][hba.name][phy.name] = phy.dump()
-
-                # Collect Ports
-                ports = collect_ports(phy)
-                if ports:
-                    tree['portcount'] += len(ports)
-                for port in ports:
-                    tree['hosts'][hba.name][phy.name][port.name] = port.dump()
-
-                    # Collect EndDevices
-                    # TODO: Check for expanders here, which will also have Phy and Port children.
-                    end_devices = collect_end_devices(port)
-                    if end_devices:
-                        tree['devicecount'] += len(end_devices)
-                    for end_device in end_devices:
-                        tree['hosts'][hba.name][phy.name][port.name][end_device.name] = end_device.dump()
-
-                        # Collect Targets
-                        targets = collect_targets(end_device)
-                        if targets:
-                            tree['targetcount'] += len(targets)
-                        for target in targets:
-                            tree['hosts'][hba.name][phy.name][port.name][end_device.name][target.name] = target.dump()
-
-                            # Collect Devices
-                            devices = collect_target_devices(target)
-                            if devices:
-                                tree['luncount'] += len(devices)
-                            for device in devices:
-                                tree['hosts'][hba.name][phy.name][port.name][end_device.name][target.name][device.name] = device.dump()
-
-                                # Collect BlockDevices
-                                block_devices = collect_block_devices(device)
-                                if block_devices:
-                                    tree['blockdevcount'] += len(block_devices)
-                                for block_device in block_devices:
-                                    tree['hosts'][hba.name][phy.name][port.name][end_device.name][target.name][device.name][block_device.name] = block_device.dump()
+class StaticCache(object):
+    """
+    On-disk cache of the static fields of every node, so that frequent runs
+    only need to read the dynamic ones. Entries for nodes that were not seen
+    by the latest run are dropped when the cache is saved.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.seen = {}
+        try:
+            with open(path) as cachefile:
+                cached = json.load(cachefile)
+            if cached.get('version') == STATIC_CACHE_VERSION:
+                self.entries = cached['entries']
+        except (IOError, OSError, ValueError, KeyError, AttributeError) as e:
+            logging.info('Not using static cache %s. %s', path, e)
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is not None:
+            self.seen[key] = data
+        return data
+
+    def put(self, key, data):
+        self.seen[key] = data
+
+    def save(self):
+        """
+        Atomically replace the cache file with the entries seen by this run
+        """
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path) or '.'):
+                os.makedirs(os.path.dirname(self.path))
+            with open(tmp_path, 'w') as cachefile:
+                json.dump({'version': STATIC_CACHE_VERSION, 'entries': self.seen}, cachefile, default=json_default)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.warning('Unable to write static cache %s. %s', self.path, e)
 
-        else:
-            # Collect Targets
-            targets = collect_targets(hba)
-            if targets:
-                tree['targetcount'] += len(targets)
-            for target in targets:
-                tree['hosts'][hba.name][target.name] = target.dump()
-
-                # Collect Devices
-                devices = collect_target_devices(target)
-                if devices:
-                    tree['luncount'] += len(devices)
-                for device in devices:
-                    tree['hosts'][hba.name][target.name][device.name] = device.dump()
-
-                    # Collect BlockDevices
-                    block_devices = collect_block_devices(device)
-                    if block_devices:
-                        tree['blockdevcount'] += len(block_devices)
-                    for block_device in block_devices:
-                        tree['hosts'][hba.name][target.name][device.name][block_device.name] = block_device.dump()
-
-    logging.info('Finished collecting device information')
-    print('##########')
-    print(json.dumps(tree, indent=2, sort_keys=True))
-    print('##########')
+
+def static_cache_keys(nodes):
+    """
+    Return the static cache key of every (ancestry, node) in nodes. The key is
+    the node's device path, plus the major:minor of the disk for Devices and
+    BlockDevices, so a different disk appearing at the same path misses.
+
+    :rtype: list
+    """
+    devs = {}
+    for ancestry, node in nodes:
+        if isinstance(node, BlockDevice):
+            devs[ancestry] = node.dev
+            devs.setdefault(ancestry[:-1], node.dev)
+    keys = []
+    for ancestry, node in nodes:
+        dev = devs.get(ancestry) if isinstance(node, (Device, BlockDevice)) else None
+        keys.append(node.device_path if dev is None else '{}@{}'.format(node.device_path, dev))
+    return keys
+
+
+def apply_static_cache(static_cache, nodes, dumps, counters_only):
+    """
+    Store the static fields of freshly dumped nodes in static_cache or, with
+    counters_only, complete the dynamic-only dumps with their static fields
+    from the cache, reading them from sysfs for nodes the cache misses.
+
+    :param nodes: List of (ancestry, node)
+    :param dumps: The dump of every node, updated in place
+    """
+    for key, (_, node), data in zip(static_cache_keys(nodes), nodes, dumps):
+        if counters_only:
+            static = static_cache.get(key)
+            if static is None:
+                static = node.dump(node.static_fields())
+                static_cache.put(key, static)
+            data.update(static)
+        else:
+            static_cache.put(key, dict((field, data[field]) for field in node.static_fields()))
+
+
+#
+# Topology walk
+#
+COUNT_KEYS = {
+    'Hba': 'hostcount',
+    'Phy': 'phycount',
+    'Port': 'portcount',
+    'Expander': 'expandercount',
+    'EndDevice': 'devicecount',
+    'Target': 'targetcount',
+    'Device': 'luncount',
+    'BlockDevice': 'blockdevcount',
+}
+
+
+def collect_children(node):
+    """
+    Return the nodes directly below node in the topology
+
+    :rtype: list
+    """
+    if isinstance(node, Hba):
+        # Note: If there are no PHYs, this is a SATA HBA, skip to Targets
+        return collect_phys(node) or collect_targets(node)
+    if isinstance(node, Phy):
+        return collect_ports(node)
+    if isinstance(node, Port):
+        return collect_expanders(node) + collect_end_devices(node)
+    if isinstance(node, Expander):
+        return collect_phys(node)
+    if isinstance(node, EndDevice):
+        return collect_targets(node)
+    if isinstance(node, Target):
+        return collect_target_devices(node)
+    if isinstance(node, Device):
+        return collect_block_devices(node)
+    return []
+
+
+def walk_node(node, ancestry, visited=None, accept=None):
+    """
+    Yield (ancestry, node) for node and every node below it, depth first with
+    parents before their children. ancestry is the tuple of node names from
+    the HBA down to, and including, the node itself.
+
+    Hba x -> Phy x -> Port x -> [Expander -> Phy x -> Port x ->]* EndDevice x -> Target x -> Device x -> BlockDevice
+
+    Expanders are descended into to any depth. Every node is walked once, by
+    canonical device path: all phys of a wide port link to the same port,
+    which is walked below the first of them only.
+
+    :param ancestry: Names of the nodes leading to node, including node
+    :type ancestry: tuple
+    :param visited: Device paths of the nodes walked so far, updated in place
+    :type visited: set
+    :param accept: Called with every node, which is skipped along with all
+        nodes below it unless it returns true
+    :rtype: generator
+    """
+    if visited is None:
+        visited = set()
+    visited.add(node.device_path)
+    if accept is not None and not accept(node):
+        return
+    yield ancestry, node
+    # Nodes found by discover_hbas() come with the nodes below them
+    for child in node.children if node.children_known else collect_children(node):
+        if child.device_path in visited:
+            continue
+        for item in walk_node(child, ancestry + (child.name,), visited, accept):
+            yield item
+
+
+def walk_hba(hba):
+    """
+    Yield (ancestry, node) for hba and every node below it
+
+    :param hba: An Hba class representing a SAS/SATA HBA
+    :type hba: Hba
+    :rtype: generator
+    """
+    return walk_node(hba, (hba.name,))
+
+
+def dump_node(node, fields=None):
+    return node.dump(fields)
+
+
+def dump_dynamic(node):
+    return node.dump(node.DYNAMIC_FIELDS)
+
+
+def dump_nodes(nodes, pool=None, dynamic_only=False):
+    """
+    Return the dump() of every (ancestry, node) in nodes, in order
+
+    :param pool: Executor to spread the dumps over, None to dump serially
+    :param dynamic_only: Dump only each node's DYNAMIC_FIELDS
+    :type dynamic_only: bool
+    :rtype: list
+    """
+    dump = dump_dynamic if dynamic_only else dump_node
+    if pool is None:
+        return [dump(node) for _, node in nodes]
+    return list(pool.map(dump, [node for _, node in nodes]))
+
+
+def new_tree():
+    return {
+        'blockdevcount': 0,
+        'devicecount': 0,
+        'expandercount': 0,
+        'hostcount': 0,
+        'hosts': {},
+        'luncount': 0,
+        'phycount': 0,
+        'portcount': 0,
+        'system': None,
+        'targetcount': 0
+    }
+
+
+def insert_node(tree, ancestry, kind, data):
+    """
+    Place a node's dump in tree at ancestry and count it
+
+    :param kind: The node's class
+    """
+    parent = tree['hosts']
+    for name in ancestry[:-1]:
+        parent = parent[name]
+    parent[ancestry[-1]] = data
+    tree[COUNT_KEYS[kind.__name__]] += 1
+
+
+def build_tree(system, records):
+    """
+    Return the output tree of the system's Record and the (ancestry, Record)
+    of every node, parents before their children
+
+    :rtype: dict
+    """
+    tree = new_tree()
+    tree['system'] = system.as_dict()
+    for ancestry, record in records:
+        insert_node(tree, ancestry, record.kind, record.as_dict())
+    return tree
+
+
+def walk_hbas(hba_devices, pool=None):
+    """
+    Return (ancestry, node) for every node below hba_devices in walk order
+
+    :param pool: Executor to walk the HBAs on in parallel, None to walk serially
+    :rtype: list
+    """
+    if pool is None:
+        return [item for hba in hba_devices for item in walk_hba(hba)]
+    return [item for walk in pool.map(lambda hba: list(walk_hba(hba)), hba_devices) for item in walk]
+
+
+def record_nodes(nodes, pool=None):
+    """
+    Return the record() of every (ancestry, node) in nodes, in order
+
+    :param pool: Executor to spread the reads over, None to read serially
+    :rtype: list
+    """
+    if pool is None:
+        return [node.record() for _, node in nodes]
+    return list(pool.map(SysfsNode.record, [node for _, node in nodes]))
+
+
+def collect(jobs=1, static_cache=None, counters_only=False, sysroot=DEFAULT_SYSROOT, health=None):
+    """
+    Walk sysfs and return the device tree along with the walked nodes.
+
+    With jobs > 1 the per-HBA walks and every node's dump() are spread over a
+    pool of that many threads. Results are reassembled in walk order, so the
+    tree is identical to a serial run.
+
+    :param jobs: Number of worker threads to collect with
+    :type jobs: int
+    :param static_cache: Cache to store the static fields of every node in
+    :type static_cache: StaticCache
+    :param counters_only: Read only dynamic fields and take static fields
+        from static_cache, reading them only for nodes missing from it
+    :type counters_only: bool
+    :param sysroot: Where sysfs is mounted
+    :type sysroot: str
+    :param health: Collector of the health of the block devices, added to their fields
+    :type health: HealthCollector
+    :return: The tree, and a list of (ancestry, node) in walk order
+    :rtype: tuple
+    """
+    tree = new_tree()
+    host = collect_host_data(sysroot)
+    hba_devices = collect_hbas(sysroot)
+
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            system = pool.submit(dump_dynamic if counters_only else dump_node, host)
+            nodes = walk_hbas(hba_devices, pool)
+            dumps = dump_nodes(nodes, pool, counters_only)
+            tree['system'] = system.result()
+    else:
+        tree['system'] = dump_dynamic(host) if counters_only else host.dump()
+        nodes = walk_hbas(hba_devices)
+        dumps = dump_nodes(nodes, dynamic_only=counters_only)
+
+    if static_cache is not None:
+        apply_static_cache(static_cache, [((), host)] + nodes, [tree['system']] + dumps, counters_only)
+        static_cache.save()
+
+    collected = ((ancestry, node, data) for (ancestry, node), data in zip(nodes, dumps))
+    for ancestry, node, data in with_health(collected, health):
+        insert_node(tree, ancestry, node.__class__, data)
+
+    return tree, nodes
+
+
+def collect_tree(jobs=1, sysroot=DEFAULT_SYSROOT):
+    """
+    Walk sysfs and return the device tree as a dict
+
+    :param jobs: Number of worker threads to collect with
+    :type jobs: int
+    :param sysroot: Where sysfs is mounted
+    :type sysroot: str
+    :rtype: dict
+    """
+    return collect(jobs, sysroot=sysroot)[0]
+
+
+#
+# Streaming output
+#
+LAYER_NAMES = {
+    'Hba': 'hba',
+    'Phy': 'phy',
+    'Port': 'port',
+    'Expander': 'expander',
+    'EndDevice': 'end_device',
+    'Target': 'target',
+    'Device': 'device',
+    'BlockDevice': 'block_device',
+}
+
+
+def iter_collected(hba_devices, jobs=1, layer_fields=None, selection=None):
+    """
+    Yield (ancestry, node, dump) for every node below hba_devices in walk
+    order, as soon as each is available.
+
+    With jobs > 1, dumps run ahead of the consumer on a pool of that many
+    threads, at most jobs * 4 nodes ahead so memory stays flat.
+
+    :param layer_fields: Fields to dump by node class name. If given, nodes
+        of classes missing from it are dumped without any fields.
+    :type layer_fields: dict
+    :param selection: Walk only the nodes it selects and dump its fields,
+        in place of layer_fields
+    :type selection: Selection
+    :rtype: generator
+    """
+    def fields_of(node):
+        return None if layer_fields is None else layer_fields.get(node.__class__.__name__, ())
+
+    if selection is None:
+        walk = (item for hba in hba_devices for item in walk_hba(hba))
+    else:
+        walk = selection.walk(hba_devices)
+        layer_fields = selection.layer_fields
+    if jobs <= 1:
+        for ancestry, node in walk:
+            yield ancestry, node, node.dump(fields_of(node))
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for ancestry, node in walk:
+            pending.append((ancestry, node, pool.submit(dump_node, node, fields_of(node))))
+            if len(pending) >= jobs * 4:
+                ancestry, node, future = pending.popleft()
+                yield ancestry, node, future.result()
+        while pending:
+            ancestry, node, future = pending.popleft()
+            yield ancestry, node, future.result()
+
+
+def with_health(collected, health):
+    """
+    Yield (ancestry, node, dump) from collected in the same order, adding the
+    health of every block device to its dump. Each disk is queried as soon
+    as it is walked, so queries run while the walk goes on, and nodes are
+    held back only until the health of the disks before them is known. The
+    health cache is saved once collected is exhausted.
+
+    :param health: Collector to query the disks with, None to add nothing
+    :type health: HealthCollector
+    :rtype: generator
+    """
+    if health is None:
+        for item in collected:
+            yield item
+        return
+    pending = deque()
+    device = None
+    try:
+        for ancestry, node, data in collected:
+            future = None
+            if isinstance(node, Device):
+                device = node
+            elif isinstance(node, BlockDevice):
+                future = health.submit(node, device)
+            pending.append((ancestry, node, data, future))
+            while pending and (pending[0][3] is None or pending[0][3].done()):
+                yield finish_health(*pending.popleft())
+        while pending:
+            yield finish_health(*pending.popleft())
+    finally:
+        health.close()
+
+
+def finish_health(ancestry, node, data, future):
+    if future is not None:
+        data['health'] = future.result()
+    return ancestry, node, data
+
+
+def write_json_stream(out, jobs=1, sysroot=DEFAULT_SYSROOT, selection=None, health=None):
+    """
+    Write the device tree to out as JSON while it is being walked. The
+    document holds the same data as the default output, but the counts come
+    last, after "hosts", and only a few nodes are held in memory at a time.
+
+    :param out: File object to write to
+    :param selection: Fields and filters to walk with, None for everything
+    :type selection: Selection
+    :param health: Collector of the health of the block devices, added to their fields
+    :type health: HealthCollector
+    """
+    encode = json.JSONEncoder(sort_keys=True, default=json_default).encode
+    out.write('{"system": ' + encode(collect_host_data(sysroot).dump()) + ', "hosts": {')
+    counts = dict.fromkeys(COUNT_KEYS.values(), 0)
+    # Objects left open, and whether the next member is the first of its object
+    depth = 0
+    first = True
+    for ancestry, node, data in with_health(iter_collected(collect_hbas(sysroot), jobs, selection=selection), health):
+        while depth >= len(ancestry):
+            out.write('}')
+            depth -= 1
+            first = False
+        # The node's own fields, leaving its object open for its children
+        out.write(('' if first else ', ') + encode(ancestry[-1]) + ': ' + encode(data)[:-1])
+        first = not data
+        depth += 1
+        counts[COUNT_KEYS[node.__class__.__name__]] += 1
+    out.write('}' * depth + '}')
+    for key in sorted(counts):
+        out.write(', {}: {}'.format(encode(key), counts[key]))
+    out.write('}\n')
+
+
+def write_ndjson(out, jobs=1, sysroot=DEFAULT_SYSROOT, selection=None, health=None):
+    """
+    Write one JSON record per line to out for every block device, holding
+    the fields of the block device and of each of its ancestors, keyed by
+    layer, and the names of all of them in "path".
+
+    :param out: File object to write to
+    :param selection: Fields and filters to walk with, None for everything
+    :type selection: Selection
+    :param health: Collector of the health of the block devices, added to their fields
+    :type health: HealthCollector
+    """
+    encode = json.JSONEncoder(sort_keys=True, default=json_default).encode
+    hostname = collect_host_data(sysroot).hostname
+    collected = with_health(iter_collected(collect_hbas(sysroot), jobs, selection=selection), health)
+    for record in iter_records(collected, hostname):
+        out.write(encode(record) + '\n')
+
+
+def iter_records(collected, hostname, leaves=(BlockDevice,)):
+    """
+    Yield a record for every node of a leaves class in collected, holding
+    the node's fields and those of each of its ancestors keyed by layer, the
+    hostname, and the names of all of them in "path"
+
+    :param collected: (ancestry, node, dump) in walk order, parents first
+    :rtype: generator
+    """
+    ancestors = []
+    for ancestry, node, data in collected:
+        del ancestors[len(ancestry) - 1:]
+        data['name'] = node.name
+        ancestors.append((LAYER_NAMES[node.__class__.__name__], data))
+        if isinstance(node, leaves):
+            record = dict(ancestors)
+            record['hostname'] = hostname
+            record['path'] = list(ancestry)
+            yield record
+
+
+#
+# Field selection and filters
+#
+# --fields and --filter name fields as [layer.]field. A field without a layer
+# is taken from the deepest layer that has it: "state" is the SCSI device's
+# state, not the HBA's. Filters are applied while walking: nodes of a
+# filtered layer are read for the filtered fields only, and the nodes below
+# those that fail are never walked. Only the requested fields of the nodes
+# that remain are read.
+#
+# Node classes from the HBA down
+LAYER_CLASSES = (Hba, Phy, Port, Expander, EndDevice, Target, Device, BlockDevice)
+_FILTER = re.compile(r'\s*([\w.]+)\s*(!=|=)(.*)$')
+
+
+def resolve_field(name):
+    """
+    Return the node class and field named by [layer.]field
+
+    :rtype: tuple
+    """
+    layer, _, field = name.rpartition('.')
+    if layer:
+        classes = [cls for cls in LAYER_CLASSES if LAYER_NAMES[cls.__name__] == layer]
+        if not classes:
+            raise ValueError('unknown layer {!r}, expected one of {}'.format(
+                layer, ', '.join(LAYER_NAMES[cls.__name__] for cls in LAYER_CLASSES)))
+        if field not in classes[0].FIELDS + classes[0].OPTIONAL_FIELDS:
+            raise ValueError('{} has no field {!r}'.format(layer, field))
+        return classes[0], field
+    for cls in reversed(LAYER_CLASSES):
+        if field in cls.FIELDS + cls.OPTIONAL_FIELDS:
+            return cls, field
+    raise ValueError('no layer has a field {!r}'.format(field))
+
+
+def filter_value(value):
+    """
+    Return a field's value as compared by filters: text, with None empty
+
+    :rtype: str
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        return value.hex()
+    return str(value)
+
+
+class Selection(object):
+    """
+    The fields to output and the filters to walk the topology with
+
+    :param fields: [layer.]field names to output, None for all fields
+    :type fields: list
+    :param filters: Filters as [layer.]field=value or [layer.]field!=value,
+        or layer=name to match node names
+    :type filters: list
+    """
+    def __init__(self, fields=None, filters=()):
+        self.layer_fields = None
+        if fields is not None:
+            self.layer_fields = {}
+            for name in fields:
+                cls, field = resolve_field(name)
+                layer_fields = self.layer_fields.setdefault(cls.__name__, [])
+                if field not in layer_fields:
+                    layer_fields.append(field)
+        # (field, negated, value) by node class name, a field of None
+        # matching the node's name
+        self.filters = {}
+        for expression in filters:
+            match = _FILTER.match(expression)
+            if match is None:
+                raise ValueError('invalid filter {!r}, expected [LAYER.]FIELD=VALUE or '
+                                 '[LAYER.]FIELD!=VALUE'.format(expression))
+            name, operator, value = match.groups()
+            classes = [cls for cls in LAYER_CLASSES if LAYER_NAMES[cls.__name__] == name]
+            cls, field = (classes[0], None) if classes else resolve_field(name)
+            self.filters.setdefault(cls.__name__, []).append((field, operator == '!=', value))
+
+    def accept(self, node):
+        """
+        Return whether node passes the filters of its layer, reading only
+        the fields they compare
+        """
+        filters = self.filters.get(node.__class__.__name__)
+        if not filters:
+            return True
+        node.prefetch([field for field, _, _ in filters if field is not None])
+        for field, negated, value in filters:
+            actual = node.name if field is None else getattr(node, field)
+            if (filter_value(actual) == value) == negated:
+                return False
+        return True
+
+    def walk(self, hba_devices):
+        """
+        Yield (ancestry, node) for every node below hba_devices, in walk
+        order, that is on the path to or below a node of every filtered
+        layer that passed its filters. Nodes are held back until one below
+        them shows that they are.
+
+        :rtype: generator
+        """
+        accept = self.accept if self.filters else None
+        filtered = set(self.filters)
+        # [ancestry, node, already yielded] of the node and its ancestors
+        path = []
+        for hba in hba_devices:
+            for ancestry, node in walk_node(hba, (hba.name,), accept=accept):
+                del path[len(ancestry) - 1:]
+                path.append([ancestry, node, False])
+                if not filtered.issubset(entry[1].__class__.__name__ for entry in path):
+                    continue
+                for entry in path:
+                    if not entry[2]:
+                        entry[2] = True
+                        yield entry[0], entry[1]
+
+
+def collect_selected(selection, jobs=1, sysroot=DEFAULT_SYSROOT, health=None):
+    """
+    Walk sysfs for the nodes and fields of selection and return the device
+    tree
+
+    :type selection: Selection
+    :param health: Collector of the health of the block devices, added to their fields
+    :type health: HealthCollector
+    :rtype: dict
+    """
+    tree = new_tree()
+    tree['system'] = collect_host_data(sysroot).dump()
+    for ancestry, node, data in with_health(iter_collected(collect_hbas(sysroot), jobs, selection=selection), health):
+        insert_node(tree, ancestry, node.__class__, data)
+    return tree
+
+
+#
+# Bottom-up discovery
+#
+# Rather than walking down from every HBA, listing each phy, port and target
+# on the way, the topology can be found from the disks up: /sys/block is
+# listed once, the canonical path of each disk is resolved once, and the
+# nodes above the disk are taken from the directories on that path. Only the
+# nodes that lead to a disk are created.
+#
+# Node classes by the name of their sysfs directory, below the HBA
+_NODE_NAMES = (
+    (re.compile(r'phy-[\d:]+$'), Phy),
+    (re.compile(r'port-[\d:]+$'), Port),
+    (re.compile(r'expander-[\d:]+$'), Expander),
+    (re.compile(r'end_device-[\d:]+$'), EndDevice),
+    (re.compile(r'target\d+:\d+:\d+$'), Target),
+    (re.compile(r'\d+:\d+:\d+:\d+$'), Device),
+)
+_HOST_NAME = re.compile(r'host\d+$')
+# Order of the nodes below a node, as collect_children() returns them
+_CHILD_ORDER = (Phy, Port, Expander, EndDevice, Target, Device, BlockDevice)
+
+# Whether collect_hbas() finds the topology bottom-up
+fast_discovery = False
+
+
+def configure_discovery(fast=False):
+    """
+    Make collect_hbas() find the topology bottom-up from now on, with
+    discover_hbas(), or walk it down from every HBA
+    """
+    global fast_discovery
+    fast_discovery = fast
+
+
+def path_nodes(path, sysroot=DEFAULT_SYSROOT, ttl=None, known=None):
+    """
+    Return the nodes on the canonical sysfs path of a node, HBA first, by
+    parsing the path. The phy above a port is the first of the port's phys,
+    as in the walk. Parsing stops at the first directory that is not a node.
+
+    :param path: Canonical sysfs path of a node
+    :type path: str
+    :param known: Nodes on the paths parsed so far, by path, updated in place.
+        Nodes found in it are reused rather than created again.
+    :type known: dict
+    :rtype: list
+    """
+    if known is None:
+        known = {}
+    parts = path.split(os.sep)
+    for start, part in enumerate(parts):
+        if _HOST_NAME.match(part):
+            break
+    else:
+        return []
+    current = os.sep.join(parts[:start + 1])
+    if current not in known:
+        known[current] = (Hba(path=current, canonical=True, sysroot=sysroot, ttl=ttl),)
+    nodes = list(known[current])
+    for previous, part in zip(parts[start:], parts[start + 1:]):
+        current = os.path.join(current, part)
+        if current in known:
+            nodes = list(known[current])
+            continue
+        if previous == 'block' and isinstance(nodes[-1], Device):
+            nodes.append(BlockDevice(path=current, canonical=True, sysroot=sysroot, ttl=ttl))
+            known[current] = tuple(nodes)
+            continue
+        if part == 'block':
+            continue
+        for pattern, cls in _NODE_NAMES:
+            if pattern.match(part):
+                break
+        else:
+            break
+        if cls is Port:
+            # The port's phys are links to its siblings
+            phys = list_sysfs(current, 'phy-*')
+            if phys:
+                phy_path = os.path.join(os.path.dirname(current), os.path.basename(phys[0]))
+                nodes.append(Phy(path=phy_path, canonical=True, sysroot=sysroot, ttl=ttl))
+        nodes.append(cls(path=current, canonical=True, sysroot=sysroot, ttl=ttl))
+        known[current] = tuple(nodes)
+    return nodes
+
+
+def discover_hbas(sysroot=DEFAULT_SYSROOT, ttl=None):
+    """
+    Return the HBAs that have disks, each with the nodes leading to its
+    disks set as its children, and theirs, found bottom-up from /sys/block.
+    Walking them yields the disks and their ancestry exactly as walking
+    the HBAs of collect_hbas() would, and every node is in the same order,
+    but phys, ports, end devices and targets without a disk, and SCSI
+    devices other than disks, are left out.
+
+    :param sysroot: Where sysfs is mounted
+    :type sysroot: str
+    :param ttl: Seconds the HBAs and the nodes below them keep what they read
+    :type ttl: float
+    :rtype: list
+    """
+    known = {}
+    hbas = {}
+    # Node and its children by child path, by device path
+    below = {}
+    for block_path in list_sysfs(sysroot, 'block/sd*'):
+        nodes = path_nodes(get_canonical_path(block_path), sysroot, ttl, known)
+        if not nodes or not isinstance(nodes[-1], BlockDevice):
+            logging.info('Skipping %s, which is not below a SCSI host', block_path)
+            continue
+        hbas.setdefault(nodes[0].device_path, nodes[0])
+        for parent, child in zip(nodes, nodes[1:]):
+            below.setdefault(parent.device_path, (parent, {}))[1][child.device_path] = child
+        below.setdefault(nodes[-1].device_path, (nodes[-1], {}))
+
+    for path, (node, children) in below.items():
+        children = list(children.values())
+        if isinstance(node, Hba) and any(isinstance(child, Target) for child in children):
+            # As in collect_children(), targets directly below an HBA are only walked if it has no phys
+            if any(isinstance(child, Phy) for child in children) or list_sysfs(path, 'phy-*'):
+                children = [child for child in children if not isinstance(child, Target)]
+        node.children = sorted(children, key=lambda child: (_CHILD_ORDER.index(child.__class__), child.device_path))
+    return sorted(hbas.values(), key=lambda hba: hba.name)
+
+
+#
+# Disk lookup
+#
+# Index keys, with the layer and fields each is taken from
+INDEX_KEYS = {
+    'serial': ('Device', ('serial',)),
+    'wwid': ('Device', ('wwid',)),
+    'sas_address': ('EndDevice', ('sas_address',)),
+    'bay': ('EndDevice', ('enclosure_identifier', 'bay_identifier')),
+    'name': ('BlockDevice', ('name',)),
+    'dev': ('BlockDevice', ('dev',)),
+}
+
+
+def index_value(key, value):
+    """
+    Return value normalized for index key, so that e.g. SAS addresses match
+    whatever their case or leading zeroes. value is a tuple for "bay".
+    """
+    if key == 'bay':
+        enclosure, bay = value
+        enclosure, bay = index_value('sas_address', enclosure), index_value('serial', bay)
+        if enclosure is None or bay is None:
+            return None
+        return '{}:{}'.format(enclosure, bay)
+    if value is None or value is TIMED_OUT:
+        return None
+    value = str(value).strip()
+    if key == 'sas_address':
+        value = value.lower()
+        return parse_sas_address((value if value.startswith('0x') else '0x' + value).encode('ascii', 'replace'))
+    if key == 'name' and value.startswith('/dev/'):
+        return value[len('/dev/'):]
+    return value or None
+
+
+class DiskIndex(object):
+    """
+    Map serial numbers, WWIDs, SAS addresses, enclosure bays
+    ("ENCLOSURE:BAY"), block device names and major:minor numbers to the
+    nodes they belong to, along with each node's ancestry.
+    """
+    def __init__(self):
+        self.keys = dict((key, {}) for key in INDEX_KEYS)
+
+    @classmethod
+    def build(cls, nodes, dumps=None):
+        """
+        Return an index of the (ancestry, node) in nodes, as returned by
+        collect(). Fields missing from dumps are read from the nodes.
+        """
+        index = cls()
+        for number, (ancestry, node) in enumerate(nodes):
+            index.add(ancestry, node, None if dumps is None else dumps[number])
+        return index
+
+    def add(self, ancestry, node, data=None):
+        """
+        :param ancestry: The node's ancestry, None if it is not known
+        :param data: The node's dump, if already made
+        :type data: dict
+        """
+        kind = node.__class__.__name__
+        for key, (layer, fields) in INDEX_KEYS.items():
+            if layer != kind:
+                continue
+            values = tuple(data[field] if data is not None and field in data else getattr(node, field)
+                           for field in fields)
+            value = index_value(key, values if len(values) > 1 else values[0])
+            if value is not None:
+                self.keys[key].setdefault(value, []).append((ancestry, node))
+
+    def lookup(self, key, value):
+        """
+        Return (ancestry, node) for every node indexed under value for key,
+        e.g. more than one for a disk seen through two HBAs
+
+        :rtype: list
+        """
+        if key == 'bay':
+            value = tuple(value.rsplit(':', 1)) if ':' in value else (None, value)
+        return list(self.keys[key].get(index_value(key, value), ()))
+
+
+def locate(path, sysroot=DEFAULT_SYSROOT):
+    """
+    Return (ancestry, node) for the node at path and for each of its
+    ancestors, HBA first, as walk_hba() would yield them, without walking any
+    other part of the topology. The phy above a port is the first of the
+    port's phys, as in the walk.
+
+    :param path: sysfs path of a node
+    :type path: str
+    :rtype: list
+    """
+    nodes = path_nodes(get_canonical_path(path), sysroot)
+    located = []
+    ancestry = ()
+    for node in nodes:
+        ancestry += (node.name,)
+        located.append((ancestry, node))
+    return located
+
+
+def find_nodes(key, value, jobs=1, sysroot=DEFAULT_SYSROOT):
+    """
+    Return, for every node matching value for index key, the node and its
+    ancestors as returned by locate(). Block devices are found through
+    their /sys/block and /sys/dev/block links. Otherwise only the fields
+    behind key are read, from every SCSI device or end device.
+
+    :rtype: list
+    """
+    if key in ('name', 'dev'):
+        link = os.path.join(sysroot, 'block' if key == 'name' else 'dev/block', index_value(key, value) or '')
+        if not sysfs_exists(link):
+            return []
+        return [locate(link, sysroot)]
+
+    layer, fields = INDEX_KEYS[key]
+    candidates = [Device(path=path, sysroot=sysroot)
+                  for path in list_sysfs(sysroot, 'bus/scsi/devices/[0-9]*:[0-9]*:[0-9]*:[0-9]*')]
+    if layer == 'EndDevice':
+        end_devices = {}
+        for device in candidates:
+            end_device_path = device.device_path
+            while end_device_path != os.sep and not os.path.basename(end_device_path).startswith('end_device-'):
+                end_device_path = os.path.dirname(end_device_path)
+            if end_device_path != os.sep:
+                end_devices.setdefault(end_device_path, EndDevice(path=end_device_path, sysroot=sysroot))
+        candidates = [end_devices[path] for path in sorted(end_devices)]
+
+    def dump_index_fields(node):
+        return node.dump(fields)
+
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            dumps = list(pool.map(dump_index_fields, candidates))
+    else:
+        dumps = [dump_index_fields(node) for node in candidates]
+    index = DiskIndex()
+    for node, data in zip(candidates, dumps):
+        index.add(None, node, data)
+    return [locate(node.device_path, sysroot) for _, node in index.lookup(key, value)]
+
+
+def write_lookup(out, key, value, jobs=1, sysroot=DEFAULT_SYSROOT):
+    """
+    Write a --format ndjson record to out for every block device at or
+    below a node matching value for index key, or for the node itself if it
+    has none
+
+    :return: Whether anything matched
+    :rtype: bool
+    """
+    encode = json.JSONEncoder(sort_keys=True, default=json_default).encode
+    hostname = None
+    matched = False
+    for located in find_nodes(key, value, jobs, sysroot):
+        if hostname is None:
+            hostname = collect_host_data(sysroot).hostname
+        ancestry, node = located[-1]
+        nodes = located[:-1] + list(walk_node(node, ancestry))
+        collected = [item + (data,) for item, data in zip(nodes, dump_nodes(nodes))]
+        leaves = (BlockDevice,) if any(isinstance(item, BlockDevice) for _, item in nodes) else (node.__class__,)
+        for record in iter_records(collected, hostname, leaves):
+            out.write(encode(record) + '\n')
+            matched = True
+    return matched
+
+
+#
+# Snapshot diff
+#
+# A snapshot is the --format ndjson output of an earlier run. Disks are
+# matched between the snapshot and the current state by identity through
+# hash indexes, so a comparison costs in proportion to the number of disks.
+#
+# Fields compared, by node class name
+DIFF_FIELDS = {
+    'Phy': ('invalid_dword_count', 'loss_of_dword_sync_count', 'negotiated_linkrate', 'phy_reset_problem_count',
+            'running_disparity_error_count'),
+    'EndDevice': ('bay_identifier', 'enclosure_identifier', 'sas_address'),
+    'Device': ('ioerr_cnt', 'serial', 'state', 'wwid'),
+}
+# Counters that only grow when something is wrong, by layer
+DIFF_COUNTERS = (
+    ('phy', 'invalid_dword_count'),
+    ('phy', 'running_disparity_error_count'),
+    ('phy', 'loss_of_dword_sync_count'),
+    ('phy', 'phy_reset_problem_count'),
+    ('device', 'ioerr_cnt'),
+)
+
+
+def disk_identity(record):
+    """
+    Return the identity of the disk behind an ndjson record: its WWID, or
+    its serial number, and the SAS address of its end device, which tells
+    apart the two paths to a dual ported disk. Neither depends on where the
+    disk is plugged in.
+
+    :rtype: tuple
+    """
+    device = record.get('device') or {}
+    end_device = record.get('end_device') or {}
+    name = device.get('wwid') or device.get('serial')
+    sas_address = end_device.get('sas_address')
+    if name is None and sas_address is None:
+        return None
+    return name, sas_address
+
+
+def disk_location(record):
+    """
+    Return where the disk behind an ndjson record is attached
+
+    :rtype: dict
+    """
+    end_device = record.get('end_device') or {}
+    location = dict((layer, (record.get(layer) or {}).get('name')) for layer in ('hba', 'expander', 'phy', 'port'))
+    location['enclosure_identifier'] = end_device.get('enclosure_identifier')
+    location['bay_identifier'] = end_device.get('bay_identifier')
+    return location
+
+
+def index_records(records):
+    """
+    Return the ndjson records by disk_identity(). Records without one are
+    left out.
+
+    :rtype: dict
+    """
+    index = {}
+    for record in records:
+        identity = disk_identity(record)
+        if identity is None:
+            logging.warning('Not comparing %s, it has no WWID, serial number or SAS address',
+                            '/'.join(record.get('path', ())))
+            continue
+        index[identity] = record
+    return index
+
+
+def diff_records(old, new):
+    """
+    Yield a change for every disk in the ndjson records old or new that
+    vanished, appeared, moved to another bay, phy or port, left the running
+    state, dropped its negotiated link rate or gained phy or I/O errors
+
+    :param old: Records of the snapshot
+    :param new: Records of the current state
+    :rtype: generator
+    """
+    before = index_records(old)
+    after = index_records(new)
+
+    def change(kind, record, **details):
+        device = record.get('device') or {}
+        details.update({
+            'change': kind,
+            'path': record.get('path'),
+            'serial': device.get('serial'),
+            'wwid': device.get('wwid'),
+            'sas_address': (record.get('end_device') or {}).get('sas_address'),
+        })
+        return details
+
+    for identity, old_record in before.items():
+        record = after.get(identity)
+        if record is None:
+            yield change('vanished', old_record)
+            continue
+        old_location, location = disk_location(old_record), disk_location(record)
+        if old_location != location:
+            yield change('moved', record, before=old_location, after=location)
+        old_state = (old_record.get('device') or {}).get('state')
+        state = (record.get('device') or {}).get('state')
+        if state != old_state and state != 'running':
+            yield change('state', record, before=old_state, after=state)
+        old_linkrate = (old_record.get('phy') or {}).get('negotiated_linkrate')
+        linkrate = (record.get('phy') or {}).get('negotiated_linkrate')
+        old_gbit, gbit = linkrate_gbit(old_linkrate), linkrate_gbit(linkrate)
+        if old_gbit is not None and (gbit is None or gbit < old_gbit):
+            yield change('linkrate', record, before=old_linkrate, after=linkrate)
+        for layer, field in DIFF_COUNTERS:
+            old_count = (old_record.get(layer) or {}).get(field)
+            count = (record.get(layer) or {}).get(field)
+            if isinstance(old_count, int) and isinstance(count, int) and count > old_count:
+                yield change('errors', record, field='{}.{}'.format(layer, field), before=old_count, after=count)
+    for identity, record in after.items():
+        if identity not in before:
+            yield change('appeared', record)
+
+
+def read_snapshot(path):
+    """
+    Return the records of the --format ndjson output, or of the binary
+    snapshot, saved at path
+
+    :rtype: list
+    """
+    if is_snapshot(path):
+        with SnapshotReader(path) as snapshot:
+            return list(snapshot.iter_records())
+    with open(path) as snapshot:
+        return [json.loads(line) for line in snapshot if line.strip()]
+
+
+def write_diff(out, old, jobs=1, sysroot=DEFAULT_SYSROOT):
+    """
+    Compare the current state with the snapshot records old and write every
+    change to out as a JSON record per line. Only the fields compared are
+    read.
+
+    :return: Number of changes
+    :rtype: int
+    """
+    new = iter_records(iter_collected(collect_hbas(sysroot), jobs, DIFF_FIELDS), None)
+    encode = json.JSONEncoder(sort_keys=True, default=json_default).encode
+    changes = 0
+    for change in diff_records(old, new):
+        out.write(encode(change) + '\n')
+        changes += 1
+    return changes
+
+
+#
+# Binary snapshots
+#
+# A compact, columnar form of the output tree for archiving many runs. After
+# a fixed header and the schema, which describes where everything is, come
+# the sections of data, each a little endian array of the narrowest integer
+# type its values fit:
+#
+#  - the string table: every distinct string (node, layer and field names,
+#    text values, JSON of odd values) once, as offsets into UTF-8 data
+#  - the node table: each node's class, parent node, name and row, parents
+#    first
+#  - per node class, one column per field, holding that field of every node
+#    of the class in rows: integers as they are, strings as string table
+#    indexes, hex strings (binary attributes) as indexes into the distinct
+#    bytes of the column and lists of integers (the block stat) flattened,
+#    with offsets
+#
+# Readers map the file and use the arrays in place.
+#
+SNAPSHOT_MAGIC = b'DISKINFO'
+SNAPSHOT_VERSION = 1
+# Magic, version, schema length
+SNAPSHOT_HEADER = struct.Struct('<8sII')
+# Schema entries. A section: typecode, offset into the data and length of an
+# array. A table: name, number of rows and columns. A column: field name,
+# index into COLUMN_TYPES and number of sections.
+SNAPSHOT_SECTION = struct.Struct('<cII')
+SNAPSHOT_COUNT = struct.Struct('<I')
+SNAPSHOT_TABLE = struct.Struct('<III')
+SNAPSHOT_COLUMN = struct.Struct('<IBB')
+COLUMN_TYPES = ('int', 'str', 'hex', 'ints', 'json')
+# Sections of each column type. markers is left out if no value is null or
+# missing.
+COLUMN_SECTIONS = {
+    'int': ('values', 'markers'),
+    'str': ('values',),
+    'hex': ('values', 'offsets', 'data'),
+    'ints': ('values', 'offsets', 'markers'),
+    'json': ('values',),
+}
+# Node classes of the node table, by index
+SNAPSHOT_KINDS = ('Hba', 'Phy', 'Port', 'Expander', 'EndDevice', 'Target', 'Device', 'BlockDevice')
+# Stands for fields a node does not have
+MISSING = object()
+# Markers of null and missing values in integer and list columns
+_NULL_MARK, _MISSING_MARK = 1, 2
+# Markers of null and missing values in index columns, which store indexes plus 2
+_NULL_INDEX, _MISSING_INDEX = 0, 1
+_HEX = re.compile(r'(?:[0-9a-f]{2})*$')
+# Array typecodes from narrowest to widest, with the range of each
+_SIGNED_TYPES = tuple((typecode, -1 << (8 * size - 1), (1 << (8 * size - 1)) - 1)
+                      for typecode, size in (('b', 1), ('h', 2), ('i', 4), ('q', 8)))
+_UNSIGNED_TYPES = tuple((typecode, 0, (1 << (8 * size)) - 1)
+                        for typecode, size in (('B', 1), ('H', 2), ('I', 4), ('Q', 8)))
+
+
+def tree_node_kind(name, parent_kind):
+    """
+    Return the class name of the node called name in an output tree, below
+    a node of class parent_kind, or None for an HBA
+
+    :rtype: str
+    """
+    if parent_kind is None:
+        return 'Hba'
+    if parent_kind == 'Device':
+        return 'BlockDevice'
+    for pattern, cls in _NODE_NAMES:
+        if pattern.match(name):
+            return cls.__name__
+    raise ValueError('Unknown node {!r} below a {} node'.format(name, parent_kind))
+
+
+def iter_tree_nodes(tree):
+    """
+    Yield (ancestry, class name, fields) for every node of an output tree,
+    parents before their children and siblings by name
+
+    :type tree: dict
+    :rtype: generator
+    """
+    pending = [((name,), data, None) for name, data in sorted(tree['hosts'].items(), reverse=True)]
+    while pending:
+        ancestry, data, parent_kind = pending.pop()
+        kind = tree_node_kind(ancestry[-1], parent_kind)
+        fields = {}
+        children = []
+        for key, value in data.items():
+            # Block devices have no children, a dict below one is a field such as health
+            if isinstance(value, dict) and kind != 'BlockDevice':
+                children.append((key, value))
+            else:
+                fields[key] = value
+        yield ancestry, kind, fields
+        pending.extend((ancestry + (key,), value, kind) for key, value in sorted(children, reverse=True))
+
+
+def iter_node_records(nodes, hostname):
+    """
+    Yield the --format ndjson record of every block device among nodes
+
+    :param nodes: (ancestry, class name, fields) in walk order, parents first
+    :rtype: generator
+    """
+    ancestors = []
+    for ancestry, kind, data in nodes:
+        del ancestors[len(ancestry) - 1:]
+        ancestors.append((LAYER_NAMES[kind], dict(data, name=ancestry[-1])))
+        if kind == 'BlockDevice':
+            record = dict(ancestors)
+            record['hostname'] = hostname
+            record['path'] = list(ancestry)
+            yield record
+
+
+def column_type(values):
+    """
+    Return how a column of values is stored: 'int', 'hex', 'str', 'ints'
+    (lists of integers) or 'json' for anything else. None and missing values
+    fit any column.
+
+    :rtype: str
+    """
+    def is_int(value):
+        return (isinstance(value, int) and not isinstance(value, bool) and
+                _SIGNED_TYPES[-1][1] <= value <= _SIGNED_TYPES[-1][2])
+
+    present = [value for value in values if value is not None and value is not MISSING]
+    if all(is_int(value) for value in present):
+        return 'int'
+    if all(isinstance(value, str) for value in present):
+        return 'hex' if all(_HEX.match(value) for value in present) else 'str'
+    if all(isinstance(value, list) and all(is_int(item) for item in value) for value in present):
+        return 'ints'
+    return 'json'
+
+
+def narrow_array(values, signed=False):
+    """
+    Return values as an array of the narrowest type that holds them all
+
+    :rtype: array
+    """
+    values = values if isinstance(values, (list, array)) else list(values)
+    low, high = (min(values), max(values)) if len(values) else (0, 0)
+    for typecode, minimum, maximum in _SIGNED_TYPES if signed else _UNSIGNED_TYPES:
+        if minimum <= low and high <= maximum:
+            return array(typecode, values)
+    raise OverflowError('Values out of range')
+
+
+class SnapshotWriter(object):
+    """
+    Builds a binary snapshot from an output tree
+    """
+    def __init__(self):
+        self.strings = {}
+        # Class index, parent index, name string and row of every node
+        self.nodes = []
+        # Field dicts of the system and of the nodes, by class name
+        self.rows = {'system': []}
+        self.data = bytearray()
+
+    def intern(self, value):
+        """
+        Return the string table index of value, adding it if it is new
+
+        :rtype: int
+        """
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def add_tree(self, tree):
+        """
+        Add the nodes of an output tree, as printed by the default output or
+        returned by collect()
+
+        :type tree: dict
+        """
+        if self.nodes or self.rows['system']:
+            raise ValueError('A snapshot holds a single tree')
+        if tree.get('system') is not None:
+            self.rows['system'].append(dict(tree['system']))
+        # Node table indexes by ancestry
+        indexes = {}
+        for ancestry, kind, fields in iter_tree_nodes(tree):
+            rows = self.rows.setdefault(kind, [])
+            indexes[ancestry] = len(self.nodes)
+            self.nodes.append((SNAPSHOT_KINDS.index(kind), indexes.get(ancestry[:-1], -1),
+                               self.intern(ancestry[-1]), len(rows)))
+            rows.append(dict((key, value.hex() if isinstance(value, bytes) else value)
+                             for key, value in fields.items()))
+
+    def section(self, values, signed=False):
+        """
+        Append values to the data sections as a narrow array
+
+        :return: The array's typecode, offset and length
+        :rtype: tuple
+        """
+        values = narrow_array(values, signed)
+        self.data.extend(b'\0' * (-len(self.data) % values.itemsize))
+        offset = len(self.data)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        self.data.extend(values.tobytes())
+        return values.typecode.encode('ascii'), offset, len(values)
+
+    def column(self, rows, field):
+        """
+        Append the column of field in rows to the data sections
+
+        :return: The column's type and sections by name
+        :rtype: dict
+        """
+        values = [row.get(field, MISSING) for row in rows]
+        kind = column_type(values)
+        column = {'type': kind}
+        if kind in ('str', 'hex', 'json'):
+            # Hex strings index the distinct values of their own column
+            blobs = {}
+            if kind == 'hex':
+                index = lambda value: blobs.setdefault(value, len(blobs))
+            elif kind == 'str':
+                index = self.intern
+            else:
+                index = lambda value: self.intern(json.dumps(value, sort_keys=True, default=json_default))
+            column['values'] = self.section(
+                _MISSING_INDEX if value is MISSING else _NULL_INDEX if value is None else 2 + index(value)
+                for value in values)
+            if kind == 'hex':
+                offsets = [0]
+                for value in blobs:
+                    offsets.append(offsets[-1] + len(value) // 2)
+                column['offsets'] = self.section(offsets)
+                column['data'] = self.section(bytes.fromhex(''.join(blobs)))
+            return column
+        markers = [_MISSING_MARK if value is MISSING else _NULL_MARK if value is None else 0 for value in values]
+        present = [value if not marker else None for value, marker in zip(values, markers)]
+        if kind == 'int':
+            column['values'] = self.section([value or 0 for value in present], signed=True)
+        else:
+            offsets = [0]
+            items = []
+            for value in present:
+                items.extend(value or ())
+                offsets.append(len(items))
+            column['offsets'] = self.section(offsets)
+            column['values'] = self.section(items, signed=True)
+        if any(markers):
+            column['markers'] = self.section(markers)
+        return column
+
+    def write(self, out):
+        """
+        Write the snapshot to the binary file object out
+        """
+        tables = []
+        for kind, rows in sorted(self.rows.items()):
+            columns = [(self.intern(field), self.column(rows, field))
+                       for field in sorted(set(key for row in rows for key in row))]
+            tables.append((self.intern(kind), len(rows), columns))
+        nodes = [self.section(column, signed=index == 1) for index, column in enumerate(zip(*self.nodes))]
+        # The string table goes last, once every string is interned
+        strings = [value.encode('utf-8', 'surrogateescape') for value in sorted(self.strings, key=self.strings.get)]
+        offsets = [0]
+        for value in strings:
+            offsets.append(offsets[-1] + len(value))
+        sections = [self.section(offsets), self.section(b''.join(strings))]
+
+        schema = bytearray()
+        for section in sections + (nodes or [self.section(())] * 4):
+            schema.extend(SNAPSHOT_SECTION.pack(*section))
+        schema.extend(SNAPSHOT_COUNT.pack(len(tables)))
+        for name, rows, columns in tables:
+            schema.extend(SNAPSHOT_TABLE.pack(name, rows, len(columns)))
+            for field, column in columns:
+                sections = [column[section] for section in COLUMN_SECTIONS[column['type']] if section in column]
+                schema.extend(SNAPSHOT_COLUMN.pack(field, COLUMN_TYPES.index(column['type']), len(sections)))
+                for section in sections:
+                    schema.extend(SNAPSHOT_SECTION.pack(*section))
+        schema.extend(b'\0' * (-(SNAPSHOT_HEADER.size + len(schema)) % 8))
+        out.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(schema)))
+        out.write(schema)
+        out.write(self.data)
+
+
+class SnapshotReader(object):
+    """
+    A binary snapshot, mapped into memory. Arrays are used in place; values
+    are only decoded when asked for.
+
+    :param path: Path of the snapshot file
+    :type path: str
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot:
+            self._map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        if len(self._view) < SNAPSHOT_HEADER.size:
+            raise ValueError('{} is not a diskinfo snapshot'.format(path))
+        magic, version, length = SNAPSHOT_HEADER.unpack_from(self._view)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('{} is not a diskinfo snapshot'.format(path))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('{} is a version {} snapshot, expected version {}'.format(
+                path, version, SNAPSHOT_VERSION))
+        self._base = SNAPSHOT_HEADER.size + length
+        self.kinds = SNAPSHOT_KINDS
+        try:
+            self._read_schema()
+        except (struct.error, IndexError) as e:
+            raise ValueError('{} is a damaged snapshot: {}'.format(path, e))
+
+    def _read_schema(self):
+        position = SNAPSHOT_HEADER.size
+
+        def unpack(layout):
+            nonlocal position
+            values = layout.unpack_from(self._view, position)
+            position += layout.size
+            return values
+
+        self._string_offsets = self.array(unpack(SNAPSHOT_SECTION))
+        self._string_data = self.array(unpack(SNAPSHOT_SECTION))
+        self._strings = [None] * (len(self._string_offsets) - 1)
+        self.node_kinds, self.node_parents, self.node_names, self.node_rows = (
+            self.array(unpack(SNAPSHOT_SECTION)) for _ in range(4))
+        # Type and sections of every column, by table and field name
+        self.tables = {}
+        for _ in range(unpack(SNAPSHOT_COUNT)[0]):
+            name, rows, count = unpack(SNAPSHOT_TABLE)
+            columns = {}
+            for _ in range(count):
+                field, column_type, sections = unpack(SNAPSHOT_COLUMN)
+                column_type = COLUMN_TYPES[column_type]
+                column = dict(zip(COLUMN_SECTIONS[column_type], [unpack(SNAPSHOT_SECTION) for _ in range(sections)]))
+                column['type'] = column_type
+                columns[self.string(field)] = column
+            self.tables[self.string(name)] = {'rows': rows, 'columns': columns}
+        if position > self._base:
+            raise IndexError('schema overruns its length')
+
+    def __len__(self):
+        return len(self.node_kinds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # The mapping goes away along with the last array using it
+        self._view = self._map = None
+
+    def array(self, section):
+        """
+        Return the array of a section, as given by its typecode, offset and
+        length in the schema, without copying it on little endian hosts
+
+        :rtype: memoryview
+        """
+        typecode, offset, count = section
+        typecode = typecode.decode('ascii')
+        size = array(typecode).itemsize
+        start = self._base + offset
+        view = self._view[start:start + count * size]
+        if len(view) != count * size:
+            raise ValueError('Truncated snapshot')
+        if sys.byteorder != 'little' and size > 1:
+            values = array(typecode, view.tobytes())
+            values.byteswap()
+            return memoryview(values)
+        return view.cast(typecode)
+
+    def string(self, index):
+        """
+        Return the string at index of the string table
+
+        :rtype: str
+        """
+        value = self._strings[index]
+        if value is None:
+            raw = self._string_data[self._string_offsets[index]:self._string_offsets[index + 1]]
+            value = self._strings[index] = bytes(raw).decode('utf-8', 'surrogateescape')
+        return value
+
+    def fields(self, kind):
+        """
+        Return the fields stored for the node class named kind
+
+        :rtype: list
+        """
+        table = self.tables.get(kind)
+        return sorted(table['columns']) if table else []
+
+    def column(self, kind, field):
+        """
+        Return the values of field for every node of the class named kind, or
+        of the system for 'system', by row. Nodes without the field hold
+        MISSING.
+
+        :rtype: list
+        """
+        table = self.tables[kind]
+        column = table['columns'][field]
+        values = self.array(column['values'])
+        if column['type'] in ('str', 'hex', 'json'):
+            if column['type'] == 'hex':
+                offsets, data = self.array(column['offsets']), self.array(column['data'])
+                decode = [data[start:end].hex() for start, end in zip(offsets, offsets[1:])].__getitem__
+            elif column['type'] == 'str':
+                decode = self.string
+            else:
+                decode = lambda index: json.loads(self.string(index))
+            return [decode(index - 2) if index > _MISSING_INDEX else None if index == _NULL_INDEX else MISSING
+                    for index in values]
+        if column['type'] == 'int':
+            result = values.tolist()
+        else:
+            offsets = self.array(column['offsets'])
+            result = [values[offsets[row]:offsets[row + 1]].tolist() for row in range(table['rows'])]
+        if 'markers' in column:
+            for row, marker in enumerate(self.array(column['markers'])):
+                if marker:
+                    result[row] = None if marker == _NULL_MARK else MISSING
+        return result
+
+    def rows(self, kind):
+        """
+        Return the field dicts of every node of the class named kind, or of
+        the system for 'system'
+
+        :rtype: list
+        """
+        table = self.tables.get(kind)
+        if table is None:
+            return []
+        rows = [{} for _ in range(table['rows'])]
+        for field in table['columns']:
+            for row, value in zip(rows, self.column(kind, field)):
+                if value is not MISSING:
+                    row[field] = value
+        return rows
+
+    def iter_nodes(self):
+        """
+        Yield (ancestry, class name, fields) for every node, parents before
+        their children
+
+        :rtype: generator
+        """
+        rows = dict((kind, self.rows(kind)) for kind in self.kinds)
+        ancestries = []
+        for kind, parent, name, row in zip(self.node_kinds, self.node_parents, self.node_names, self.node_rows):
+            ancestry = (ancestries[parent] if parent >= 0 else ()) + (self.string(name),)
+            ancestries.append(ancestry)
+            yield ancestry, self.kinds[kind], rows[self.kinds[kind]][row]
+
+    def to_tree(self):
+        """
+        Return the output tree the snapshot was made of
+
+        :rtype: dict
+        """
+        tree = new_tree()
+        system = self.rows('system')
+        tree['system'] = system[0] if system else None
+        nodes = []
+        for ancestry, kind, data in self.iter_nodes():
+            parent = nodes[self.node_parents[len(nodes)]] if len(ancestry) > 1 else tree['hosts']
+            parent[ancestry[-1]] = data
+            nodes.append(data)
+            tree[COUNT_KEYS[kind]] += 1
+        return tree
+
+    def iter_records(self):
+        """
+        Return the --format ndjson record of every block device
+
+        :rtype: generator
+        """
+        hostname = (self.rows('system') or [{}])[0].get('hostname')
+        return iter_node_records(self.iter_nodes(), hostname)
+
+
+def is_snapshot(path):
+    """
+    Return whether the file at path is a binary snapshot
+
+    :rtype: bool
+    """
+    with open(path, 'rb') as snapshot:
+        return snapshot.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def write_snapshot(out, tree):
+    """
+    Write tree as a binary snapshot to the binary file object out
+    """
+    writer = SnapshotWriter()
+    writer.add_tree(tree)
+    writer.write(out)
+
+
+def read_tree(path):
+    """
+    Return the output tree saved at path, either as a binary snapshot or as
+    JSON, with or without the banner lines of the default output
+
+    :rtype: dict
+    """
+    if is_snapshot(path):
+        with SnapshotReader(path) as snapshot:
+            return snapshot.to_tree()
+    with open(path) as saved:
+        return json.loads(''.join(line for line in saved if not line.startswith('#')))
+
+
+def convert_snapshot(source, destination):
+    """
+    Convert the output tree saved at source to a binary snapshot at
+    destination, or a binary snapshot back to JSON. '-' writes to stdout.
+    """
+    if is_snapshot(source):
+        data = (json.dumps(read_tree(source), indent=2, sort_keys=True) + '\n').encode('utf-8')
+    else:
+        out = io.BytesIO()
+        write_snapshot(out, read_tree(source))
+        data = out.getvalue()
+    if destination == '-':
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+    else:
+        with open(destination, 'wb') as out:
+            out.write(data)
+
+
+#
+# Fleet aggregation
+#
+# Snapshots of many hosts, in any of the formats above, are read on a pool of
+# processes. Each is reduced to a small summary of the host, its HBAs and its
+# disks before being sent back, and the summaries are merged into one index
+# of the fleet's disks. The latest snapshot of each host, by modification
+# time, gives the fleet's current state; older ones tell where disks were.
+#
+def find_snapshot_files(paths):
+    """
+    Return the files among paths and in the directories among them, and
+    their subdirectories, leaving out hidden files
+
+    :rtype: list
+    """
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for directory, subdirectories, names in os.walk(path):
+            subdirectories[:] = sorted(name for name in subdirectories if not name.startswith('.'))
+            files.extend(os.path.join(directory, name) for name in sorted(names) if not name.startswith('.'))
+    return files
+
+
+def read_host_snapshot(path):
+    """
+    Return the system fields, HBA fields by name and ndjson records of the
+    snapshot at path: a JSON tree, with or without banner lines, --format
+    ndjson output or a binary snapshot. ndjson holds neither the system nor
+    HBAs without disks.
+
+    :rtype: tuple
+    """
+    if is_snapshot(path):
+        with SnapshotReader(path) as snapshot:
+            system = (snapshot.rows('system') or [None])[0]
+            nodes = list(snapshot.iter_nodes())
+    else:
+        with open(path) as saved:
+            lines = [line for line in saved if not line.startswith('#') and line.strip()]
+        try:
+            tree = json.loads(''.join(lines))
+        except ValueError:
+            tree = None
+        if not isinstance(tree, dict) or 'hosts' not in tree:
+            records = [tree] if isinstance(tree, dict) else [json.loads(line) for line in lines]
+            hbas = dict((record['hba']['name'], record['hba']) for record in records if record.get('hba'))
+            return None, hbas, records
+        system = tree.get('system')
+        nodes = list(iter_tree_nodes(tree))
+    hbas = dict((ancestry[0], fields) for ancestry, kind, fields in nodes if kind == 'Hba')
+    return system, hbas, list(iter_node_records(nodes, (system or {}).get('hostname')))
+
+
+def summarize_host(path):
+    """
+    Return the summary of the host snapshot at path that the fleet index is
+    built of, or of the error reading it
+
+    :rtype: dict
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+        system, hbas, records = read_host_snapshot(path)
+    except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+        return {'path': path, 'error': str(e)}
+    system = system or {}
+    hostname = system.get('hostname') or next((record.get('hostname') for record in records), None)
+    disks = []
+    for record in records:
+        device = record.get('device') or {}
+        disks.append({
+            'serial': device.get('serial'),
+            'wwid': device.get('wwid'),
+            'sas_address': (record.get('end_device') or {}).get('sas_address'),
+            'path': '/'.join(record.get('path', ())),
+            'model': device.get('model'),
+            'state': device.get('state'),
+            'linkrate': (record.get('phy') or {}).get('negotiated_linkrate'),
+        })
+    return {
+        'path': path,
+        'mtime': mtime,
+        'host': hostname or system.get('product_uuid') or system.get('board_serial') or path,
+        'hbas': [(fields.get('board_name'), fields.get('version_fw')) for fields in hbas.values()],
+        'disks': disks,
+    }
+
+
+class FleetIndex(object):
+    """
+    Disks of the fleet, indexed by serial number and WWID, built from host
+    summaries in the order the snapshots were taken
+    """
+    def __init__(self):
+        # Latest summary by host
+        self.hosts = {}
+        # Snapshots that could not be read, by path
+        self.errors = {}
+        # (time, host) of every snapshot that saw a disk, by disk_key()
+        self.sightings = {}
+        self.snapshots = 0
+
+    @staticmethod
+    def disk_key(disk):
+        return disk['wwid'] or disk['serial']
+
+    def add(self, summary):
+        if 'error' in summary:
+            self.errors[summary['path']] = summary['error']
+            return
+        self.snapshots += 1
+        self.hosts[summary['host']] = summary
+        for disk in summary['disks']:
+            key = self.disk_key(disk)
+            if key is not None:
+                self.sightings.setdefault(key, []).append((summary['mtime'], summary['host']))
+
+    def disks(self):
+        """
+        Yield (host, disk) for every disk in the latest snapshot of each host
+
+        :rtype: generator
+        """
+        for host, summary in sorted(self.hosts.items()):
+            for disk in summary['disks']:
+                yield host, disk
+
+    def index(self, field):
+        """
+        Return the current (host, disk) of the fleet by serial or wwid
+
+        :rtype: dict
+        """
+        index = {}
+        for host, disk in self.disks():
+            if disk[field] is not None:
+                index.setdefault(disk[field], []).append((host, disk))
+        return index
+
+    def duplicate_serials(self):
+        """
+        Yield (serial, WWIDs, hosts) for every serial number currently
+        reported by disks with different WWIDs, or on several hosts. The
+        paths of a dual ported disk share its WWID and are not duplicates.
+
+        :rtype: generator
+        """
+        for serial, disks in sorted(self.index('serial').items()):
+            wwids = sorted(set(str(disk['wwid']) for _, disk in disks))
+            hosts = sorted(set(host for host, _ in disks))
+            if len(wwids) > 1 or len(hosts) > 1:
+                yield serial, wwids, hosts
+
+    def moves(self):
+        """
+        Yield (disk, from host, to host, time) for every disk now on one host
+        that an earlier snapshot saw on another, as of the first snapshot of
+        the new host that saw it
+
+        :rtype: generator
+        """
+        current = {}
+        for host, disk in self.disks():
+            key = self.disk_key(disk)
+            if key is not None:
+                current.setdefault(key, {})[host] = disk
+        for key, hosts in sorted(current.items()):
+            if len(hosts) != 1:
+                continue
+            host, disk = next(iter(hosts.items()))
+            previous = None
+            for when, seen in sorted(self.sightings[key]):
+                if seen != host:
+                    previous = seen
+                elif previous is not None:
+                    yield disk, previous, host, when
+                    previous = None
+
+    def linkrates(self):
+        """
+        Return the number of disks by negotiated link rate
+
+        :rtype: dict
+        """
+        counts = {}
+        for _, disk in self.disks():
+            counts[disk['linkrate']] = counts.get(disk['linkrate'], 0) + 1
+        return counts
+
+    def hba_firmware(self):
+        """
+        Return the number of HBAs and of hosts by HBA model and firmware
+        version
+
+        :rtype: dict
+        """
+        counts = {}
+        hosts = {}
+        for host, summary in self.hosts.items():
+            for hba in summary['hbas']:
+                counts[hba] = counts.get(hba, 0) + 1
+                hosts.setdefault(hba, set()).add(host)
+        return dict((hba, (count, len(hosts[hba]))) for hba, count in counts.items())
+
+    def not_running(self):
+        """
+        Yield (host, disk) for every disk currently not in the running state
+
+        :rtype: generator
+        """
+        for host, disk in self.disks():
+            if disk['state'] != 'running':
+                yield host, disk
+
+
+def aggregate(paths, jobs=1):
+    """
+    Return the FleetIndex of the host snapshots at paths, files or
+    directories of them
+
+    :param jobs: Number of processes to read snapshots on
+    :type jobs: int
+    :rtype: FleetIndex
+    """
+    files = find_snapshot_files(paths)
+    if jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            summaries = list(pool.map(summarize_host, files, chunksize=max(1, len(files) // (jobs * 4))))
+    else:
+        summaries = [summarize_host(path) for path in files]
+    fleet = FleetIndex()
+    for summary in sorted(summaries, key=lambda summary: (summary.get('mtime', 0), summary['path'])):
+        fleet.add(summary)
+    return fleet
+
+
+def format_table(title, header, rows):
+    """
+    Return rows as a text table under title, with columns as wide as their
+    widest value
+
+    :rtype: str
+    """
+    rows = [['-' if value is None else str(value) for value in row] for row in rows]
+    widths = [max(len(value) for value in column) for column in zip(header, *rows)]
+    lines = [title]
+    for row in [header] + rows:
+        lines.append('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    return '\n'.join(lines)
+
+
+def write_fleet_report(out, fleet):
+    """
+    Write summary tables of the fleet to out
+    """
+    for path, error in sorted(fleet.errors.items()):
+        logging.error('Unable to read snapshot %s. %s', path, error)
+    disks = sum(len(summary['disks']) for summary in fleet.hosts.values())
+    tables = [
+        'Fleet: {} snapshots of {} hosts, {} disks, {} unreadable snapshots'.format(
+            fleet.snapshots, len(fleet.hosts), disks, len(fleet.errors)),
+        format_table('Link rates', ['Link rate', 'Disks'],
+                     sorted(fleet.linkrates().items(), key=lambda item: (linkrate_gbit(item[0]) or 0, str(item[0])))),
+        format_table('HBA firmware', ['Model', 'Firmware', 'HBAs', 'Hosts'],
+                     [hba + counts for hba, counts in
+                      sorted(fleet.hba_firmware().items(), key=lambda item: [str(value) for value in item[0]])]),
+        format_table('Not running', ['Host', 'Path', 'Serial', 'State'],
+                     [(host, disk['path'], disk['serial'], disk['state']) for host, disk in fleet.not_running()]),
+        format_table('Duplicate serials', ['Serial', 'WWIDs', 'Hosts'],
+                     [(serial, ' '.join(wwids), ' '.join(hosts))
+                      for serial, wwids, hosts in fleet.duplicate_serials()]),
+        format_table('Moved disks', ['Serial', 'WWID', 'From', 'To', 'Seen'],
+                     [(disk['serial'], disk['wwid'], before, after,
+                       time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(when)))
+                      for disk, before, after, when in fleet.moves()]),
+    ]
+    out.write('\n\n'.join(tables) + '\n')
+
+
+#
+# Daemon mode
+#
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_SETTLE = 0.2
+
+
+def parse_uevent(message):
+    """
+    Parse a kernel uevent netlink message
+
+    :param message: Raw message, "action@devpath" followed by NUL separated KEY=VALUE pairs
+    :type message: bytes
+    :return: The event's properties, including ACTION and DEVPATH
+    :rtype: dict
+    """
+    fields = message.split(b'\0')
+    event = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition(b'=')
+        if sep:
+            event[key.decode('ascii', 'replace')] = value.decode('utf-8', 'replace')
+    if 'ACTION' not in event or 'DEVPATH' not in event:
+        action, _, devpath = fields[0].partition(b'@')
+        event.setdefault('ACTION', action.decode('ascii', 'replace'))
+        event.setdefault('DEVPATH', devpath.decode('utf-8', 'replace'))
+    return event
+
+
+class Daemon(object):
+    """
+    Keep the device tree in memory and serve it over a UNIX socket.
+
+    Kernel uevents are read from a NETLINK_KOBJECT_UEVENT socket. For each
+    event, only the subtree of the nearest collected node above the event's
+    device path is walked and read again, so a refresh costs in proportion
+    to what changed rather than to the number of disks.
+
+    Only a Record is kept per node. The tree is built from the records when
+    a client asks for it after a change.
+    """
+    def __init__(self, socket_path, jobs=1, sysroot=DEFAULT_SYSROOT):
+        self.socket_path = socket_path
+        self.jobs = jobs
+        self.sysroot = sysroot
+        self.system = None
+        # Records by ancestry, in walk order, and ancestry by canonical device path
+        self.records = {}
+        self.paths = {}
+        self._payload = None
+
+    def collect(self):
+        """
+        Walk all of sysfs and replace the in-memory tree
+        """
+        logging.info('Collecting device information')
+        if read_deadlines is not None:
+            read_deadlines.restart()
+        if sysfs_cache is not None:
+            sysfs_cache.clear()
+        hba_devices = collect_hbas(self.sysroot)
+        if self.jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                nodes = walk_hbas(hba_devices, pool)
+                records = record_nodes(nodes, pool)
+        else:
+            nodes = walk_hbas(hba_devices)
+            records = record_nodes(nodes)
+        self.system = collect_host_data(self.sysroot).record()
+        self.records = dict((ancestry, record) for (ancestry, _), record in zip(nodes, records))
+        self.paths = dict((record.path, ancestry) for ancestry, record in self.records.items())
+        self._payload = None
+
+    def refresh(self, syspath):
+        """
+        Walk and dump again the subtree of the nearest collected node that
+        still exists at or above syspath. Events for paths outside of the
+        collected topology are ignored, unless they concern a SCSI host, in
+        which case everything is collected again.
+
+        :param syspath: sysfs path of the device an event was raised for
+        :type syspath: str
+        """
+        path = syspath
+        while path not in self.paths or not os.path.isdir(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                if re.search(r'/host\d+(/|$)', syspath):
+                    self.collect()
+                return
+            path = parent
+
+        if read_deadlines is not None:
+            read_deadlines.restart()
+        if sysfs_cache is not None:
+            sysfs_cache.clear()
+        ancestry = self.paths[path]
+        old = self.records[ancestry]
+        node = old.kind(path=old.path, sysroot=self.sysroot)
+
+        # Drop the old subtree's records
+        depth = len(ancestry)
+        for key in [key for key in self.records if key[:depth] == ancestry]:
+            stale = self.records.pop(key)
+            self.paths.pop(stale.path, None)
+
+        # Nodes still in the tree, such as a wide port below a sibling phy,
+        # stay where they are
+        nodes = list(walk_node(node, ancestry, set(self.paths)))
+        if self.jobs > 1 and len(nodes) > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                records = record_nodes(nodes, pool)
+        else:
+            records = record_nodes(nodes)
+        for (key, _), record in zip(nodes, records):
+            self.records[key] = record
+            self.paths[record.path] = key
+        self._payload = None
+        logging.info('Refreshed %s, %d nodes', '/'.join(ancestry), len(nodes))
+
+    def payload(self):
+        if self._payload is None:
+            tree = build_tree(self.system, self.records.items())
+            self._payload = json.dumps(tree, sort_keys=True, default=json_default).encode('utf-8')
+        return self._payload
+
+    def serve_forever(self):
+        """
+        Collect the tree, then answer every connection to the UNIX socket with
+        the current tree as JSON while applying uevents as they arrive.
+        """
+        uevents = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        uevents.bind((0, 1))
+        uevents.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(16)
+
+        self.collect()
+        selector = selectors.DefaultSelector()
+        selector.register(uevents, selectors.EVENT_READ)
+        selector.register(server, selectors.EVENT_READ)
+        pending = set()
+        try:
+            while True:
+                # Events come in bursts, e.g. one per sysfs class for a new
+                # disk. Wait for the burst to settle before walking.
+                ready = selector.select(UEVENT_SETTLE if pending else None)
+                if not ready:
+                    for syspath in sorted(pending):
+                        if not any(syspath.startswith(other + '/') for other in pending):
+                            self.refresh(syspath)
+                    pending.clear()
+                    continue
+                for key, _ in ready:
+                    if key.fileobj is uevents:
+                        event = parse_uevent(uevents.recv(65536))
+                        logging.debug('uevent %s %s', event['ACTION'], event['DEVPATH'])
+                        pending.add(os.path.join(self.sysroot, event['DEVPATH'].lstrip('/')))
+                    else:
+                        client, _ = server.accept()
+                        try:
+                            client.sendall(self.payload())
+                        except OSError as e:
+                            logging.warning('Unable to send tree to client. %s', e)
+                        finally:
+                            client.close()
+        finally:
+            selector.close()
+            server.close()
+            uevents.close()
+            os.unlink(self.socket_path)
+
+
+#
+# Metrics export
+#
+# Counters and states in the Prometheus text exposition format, for the
+# node_exporter textfile collector or scraping over HTTP. Only the fields
+# behind the metrics are read, and samples are written out family by family
+# as they are formatted rather than built up as one document.
+#
+# (metric, field or stat index, scale, type, help)
+PHY_METRICS = (
+    ('diskinfo_phy_invalid_dword_total', 'invalid_dword_count', 1, 'counter',
+     'Invalid dwords received by the phy'),
+    ('diskinfo_phy_running_disparity_error_total', 'running_disparity_error_count', 1, 'counter',
+     'Running disparity errors seen by the phy'),
+    ('diskinfo_phy_loss_of_dword_sync_total', 'loss_of_dword_sync_count', 1, 'counter',
+     'Times the phy lost dword synchronization'),
+    ('diskinfo_phy_reset_problem_total', 'phy_reset_problem_count', 1, 'counter',
+     'Phy resets that failed'),
+    ('diskinfo_phy_negotiated_linkrate_gbits', 'negotiated_linkrate', 1, 'gauge',
+     'Negotiated link rate of the phy in Gbit/s'),
+)
+DEVICE_METRICS = (
+    ('diskinfo_device_iorequest_total', 'iorequest_cnt', 1, 'counter',
+     'I/O requests issued to the SCSI device'),
+    ('diskinfo_device_iodone_total', 'iodone_cnt', 1, 'counter',
+     'I/O requests completed by the SCSI device'),
+    ('diskinfo_device_ioerr_total', 'ioerr_cnt', 1, 'counter',
+     'I/O requests to the SCSI device that completed with an error'),
+    ('diskinfo_device_running', 'state', 1, 'gauge',
+     'Whether the SCSI device state is running'),
+)
+# Fields of /sys/block/<dev>/stat, see Documentation/block/stat.rst
+BLOCK_METRICS = (
+    ('diskinfo_block_read_ios_total', 0, 1, 'counter', 'Read I/Os completed'),
+    ('diskinfo_block_read_merges_total', 1, 1, 'counter', 'Read I/Os merged with queued I/O'),
+    ('diskinfo_block_read_sectors_total', 2, 1, 'counter', '512 byte sectors read'),
+    ('diskinfo_block_read_time_seconds_total', 3, 0.001, 'counter', 'Time spent waiting for reads'),
+    ('diskinfo_block_write_ios_total', 4, 1, 'counter', 'Write I/Os completed'),
+    ('diskinfo_block_write_merges_total', 5, 1, 'counter', 'Write I/Os merged with queued I/O'),
+    ('diskinfo_block_write_sectors_total', 6, 1, 'counter', '512 byte sectors written'),
+    ('diskinfo_block_write_time_seconds_total', 7, 0.001, 'counter', 'Time spent waiting for writes'),
+    ('diskinfo_block_in_flight', 8, 1, 'gauge', 'I/Os currently in flight'),
+    ('diskinfo_block_io_time_seconds_total', 9, 0.001, 'counter', 'Time the device had I/O in flight'),
+    ('diskinfo_block_weighted_io_time_seconds_total', 10, 0.001, 'counter',
+     'Time spent in the queue by all I/Os'),
+    ('diskinfo_block_discard_ios_total', 11, 1, 'counter', 'Discard I/Os completed'),
+    ('diskinfo_block_discard_merges_total', 12, 1, 'counter', 'Discard I/Os merged with queued I/O'),
+    ('diskinfo_block_discard_sectors_total', 13, 1, 'counter', '512 byte sectors discarded'),
+    ('diskinfo_block_discard_time_seconds_total', 14, 0.001, 'counter', 'Time spent waiting for discards'),
+    ('diskinfo_block_flush_ios_total', 15, 1, 'counter', 'Flush requests completed'),
+    ('diskinfo_block_flush_time_seconds_total', 16, 0.001, 'counter', 'Time spent waiting for flushes'),
+)
+METRIC_FIELDS = {
+    'Phy': ('invalid_dword_count', 'running_disparity_error_count', 'loss_of_dword_sync_count',
+            'phy_reset_problem_count', 'negotiated_linkrate'),
+    'EndDevice': ('sas_address', 'bay_identifier'),
+    'Device': ('iorequest_cnt', 'iodone_cnt', 'ioerr_cnt', 'state', 'wwid', 'serial'),
+    'BlockDevice': ('stat',),
+}
+
+
+def metric_label(value):
+    if value is None:
+        return ''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metric_value(field, value):
+    if field == 'negotiated_linkrate':
+        return linkrate_gbit(value)
+    if field == 'state':
+        return None if value is None or value is TIMED_OUT else int(value == 'running')
+    return value if isinstance(value, int) else None
+
+
+def collect_metric_rows(jobs=1, sysroot=DEFAULT_SYSROOT):
+    """
+    Walk sysfs reading only the fields exported as metrics
+
+    :return: Lists of (labels, dump) for phys, SCSI devices and block
+        devices, labels being a rendered Prometheus label set
+    :rtype: tuple
+    """
+    def dump_metric_fields(node):
+        return node.dump(METRIC_FIELDS.get(node.__class__.__name__, ()))
+
+    hba_devices = collect_hbas(sysroot)
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            nodes = walk_hbas(hba_devices, pool)
+            dumps = list(pool.map(dump_metric_fields, [node for _, node in nodes]))
+    else:
+        nodes = walk_hbas(hba_devices)
+        dumps = [dump_metric_fields(node) for _, node in nodes]
+
+    phys, devices, block_devices = [], [], []
+    labels = {(): ()}
+    for (ancestry, node), data in zip(nodes, dumps):
+        kind = node.__class__.__name__
+        own = ()
+        if kind == 'Hba':
+            own = (('hba', node.name),)
+        elif kind == 'Phy':
+            own = (('phy', node.name),)
+        elif kind == 'Port':
+            own = (('port', node.name),)
+        elif kind == 'Expander':
+            own = (('expander', node.name),)
+        elif kind == 'EndDevice':
+            own = (('end_device', node.name), ('sas_address', data['sas_address']),
+                   ('bay', data['bay_identifier']))
+        elif kind == 'Device':
+            own = (('lun', node.name), ('wwid', data['wwid']), ('serial', data['serial']))
+        elif kind == 'BlockDevice':
+            own = (('device', node.name),)
+        # Behind an expander, the phy and port labels are those of the
+        # expander's own phy and port rather than the HBA's
+        names = set(name for name, _ in own)
+        node_labels = labels[ancestry] = tuple(
+            label for label in labels[ancestry[:-1]] if label[0] not in names) + own
+        rendered = ','.join('{}="{}"'.format(name, metric_label(value)) for name, value in node_labels)
+        if kind == 'Phy':
+            phys.append((rendered, data))
+        elif kind == 'Device':
+            devices.append((rendered, data))
+        elif kind == 'BlockDevice':
+            block_devices.append((rendered, data))
+    return phys, devices, block_devices
+
+
+def iter_metrics(jobs=1, sysroot=DEFAULT_SYSROOT):
+    """
+    Yield the Prometheus text exposition of all metrics, a few lines at a time
+
+    :rtype: generator
+    """
+    phys, devices, block_devices = collect_metric_rows(jobs, sysroot)
+    for rows, table in ((phys, PHY_METRICS), (devices, DEVICE_METRICS)):
+        for metric, field, scale, metric_type, description in table:
+            lines = ['# HELP {} {}\n# TYPE {} {}\n'.format(metric, description, metric, metric_type)]
+            for labels, data in rows:
+                value = metric_value(field, data[field])
+                if value is not None:
+                    lines.append('{}{{{}}} {}\n'.format(metric, labels, value * scale))
+            yield ''.join(lines)
+    for metric, index, scale, metric_type, description in BLOCK_METRICS:
+        lines = ['# HELP {} {}\n# TYPE {} {}\n'.format(metric, description, metric, metric_type)]
+        for labels, data in block_devices:
+            stat = data['stat']
+            if isinstance(stat, list) and index < len(stat):
+                lines.append('{}{{{}}} {}\n'.format(metric, labels, stat[index] * scale))
+        yield ''.join(lines)
+
+
+def write_metrics_textfile(path, jobs=1, sysroot=DEFAULT_SYSROOT):
+    """
+    Atomically replace path with the current metrics, for the node_exporter
+    textfile collector
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as metricsfile:
+        for chunk in iter_metrics(jobs, sysroot):
+            metricsfile.write(chunk)
+    os.rename(tmp_path, path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    jobs = 1
+    sysroot = DEFAULT_SYSROOT
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.end_headers()
+        if sysfs_cache is not None:
+            sysfs_cache.clear()
+        for chunk in iter_metrics(self.jobs, self.sysroot):
+            self.wfile.write(chunk.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        logging.info('%s %s', self.address_string(), format % args)
+
+
+def serve_metrics(address, jobs=1, sysroot=DEFAULT_SYSROOT):
+    """
+    Serve metrics over HTTP on address, "[HOST:]PORT", collecting on each scrape
+    """
+    host, _, port = address.rpartition(':')
+    handler = type('MetricsHandler', (MetricsHandler,), {'jobs': jobs, 'sysroot': sysroot})
+    server = HTTPServer((host, int(port)), handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+#
+# Rate sampling
+#
+# iostat style rates from successive samples of every disk's block device
+# stat and SCSI device I/O counters. Samples go into flat, preallocated
+# arrays used as ring buffers, and counter files are kept open and re-read
+# with pread(), so a sample costs one syscall per file and no per-disk
+# objects.
+#
+# Counters kept per disk and sample: the first 11 fields of the block stat
+# file, then the SCSI device's iorequest_cnt, iodone_cnt and ioerr_cnt.
+STAT_FIELDS = 11
+DEVICE_COUNTERS = ('iorequest_cnt', 'iodone_cnt', 'ioerr_cnt')
+SAMPLE_WIDTH = STAT_FIELDS + len(DEVICE_COUNTERS)
+# Columns computed by StatSampler.rates()
+RATE_COLUMNS = ('r/s', 'w/s', 'rkB/s', 'wkB/s', 'r_await', 'w_await', 'aqu-sz', 'inflight', '%util',
+                'req/s', 'done/s', 'err/s')
+
+
+class CounterRing(object):
+    """
+    Ring buffer of the last depth samples of width counters for each of
+    series series, stored in one flat array. Missing counters are -1.
+    """
+    def __init__(self, series, width, depth):
+        self.series = series
+        self.width = width
+        self.depth = depth
+        self.values = array('q', bytes(8 * series * width * depth))
+        self.times = array('d', bytes(8 * depth))
+        self.head = -1
+        self.filled = 0
+
+    def advance(self, timestamp):
+        """
+        Start a new sample taken at timestamp, overwriting the oldest
+        """
+        self.head = (self.head + 1) % self.depth
+        self.filled = min(self.filled + 1, self.depth)
+        self.times[self.head] = timestamp
+
+    def offset(self, series, back=0):
+        """
+        Return the index in values of the first counter of series, back
+        samples before the latest
+        """
+        slot = (self.head - back) % self.depth
+        return (slot * self.series + series) * self.width
+
+
+def counter_delta(values, new, old, index):
+    """
+    Return how much counter index grew between the samples at offsets old
+    and new of values. Counters that are missing, or went backwards because
+    the device was reset, count as no change.
+    """
+    if values[new + index] < 0 or values[old + index] < 0:
+        return 0
+    return max(values[new + index] - values[old + index], 0)
+
+
+def read_counter_file(fd):
+    """
+    Re-read an open sysfs counter file from its start
+    """
+    try:
+        return os.pread(fd, 4096, 0)
+    except OSError:
+        return None
+
+
+class StatSampler(object):
+    def __init__(self, disks, depth=60):
+        """
+        :param disks: (BlockDevice, Device) pairs to sample
+        :type disks: list
+        :param depth: Number of samples kept per disk
+        :type depth: int
+        """
+        self.names = [block_device.name for block_device, _ in disks]
+        self.ring = CounterRing(len(disks), SAMPLE_WIDTH, depth)
+        self.rates = array('d', bytes(8 * len(disks) * len(RATE_COLUMNS)))
+        self.stat_fds = []
+        self.device_fds = []
+        for block_device, device in disks:
+            self.stat_fds.append(self._open(os.path.join(block_device.data_path, 'stat')))
+            self.device_fds.append(tuple(self._open(os.path.join(device.data_path, counter))
+                                         for counter in DEVICE_COUNTERS))
+
+    @staticmethod
+    def _open(path):
+        try:
+            return os.open(path, os.O_RDONLY)
+        except OSError as e:
+            logging.warning('Unable to open %s. %s', path, e)
+            return None
+
+    def close(self):
+        for fd in self.stat_fds + [fd for fds in self.device_fds for fd in fds]:
+            if fd is not None:
+                os.close(fd)
+
+    def sample(self):
+        """
+        Read the counters of every disk into the next slot of the ring
+        """
+        ring = self.ring
+        values = ring.values
+        ring.advance(time.monotonic())
+        for series, (stat_fd, device_fds) in enumerate(zip(self.stat_fds, self.device_fds)):
+            offset = ring.offset(series)
+            raw = read_counter_file(stat_fd) if stat_fd is not None else None
+            fields = raw.split() if raw else ()
+            for index in range(STAT_FIELDS):
+                values[offset + index] = int(fields[index]) if index < len(fields) else -1
+            for index, fd in enumerate(device_fds, STAT_FIELDS):
+                raw = read_counter_file(fd) if fd is not None else None
+                try:
+                    values[offset + index] = int(raw, 0)
+                except (TypeError, ValueError):
+                    values[offset + index] = -1
+
+    def compute_rates(self):
+        """
+        Fill rates with the RATE_COLUMNS of every disk over the latest interval
+
+        :return: False if fewer than two samples have been taken
+        :rtype: bool
+        """
+        ring = self.ring
+        if ring.filled < 2:
+            return False
+        values = ring.values
+        rates = self.rates
+        columns = len(RATE_COLUMNS)
+        interval = ring.times[ring.head] - ring.times[(ring.head - 1) % ring.depth]
+        for series in range(ring.series):
+            new = ring.offset(series)
+            old = ring.offset(series, 1)
+            reads = counter_delta(values, new, old, 0)
+            writes = counter_delta(values, new, old, 4)
+            out = series * columns
+            rates[out] = reads / interval
+            rates[out + 1] = writes / interval
+            # Sectors are 512 bytes, ticks are milliseconds
+            rates[out + 2] = counter_delta(values, new, old, 2) / 2.0 / interval
+            rates[out + 3] = counter_delta(values, new, old, 6) / 2.0 / interval
+            rates[out + 4] = float(counter_delta(values, new, old, 3)) / reads if reads else 0.0
+            rates[out + 5] = float(counter_delta(values, new, old, 7)) / writes if writes else 0.0
+            rates[out + 6] = counter_delta(values, new, old, 10) / 1000.0 / interval
+            rates[out + 7] = max(values[new + 8], 0)
+            rates[out + 8] = min(counter_delta(values, new, old, 9) / 10.0 / interval, 100.0)
+            rates[out + 9] = counter_delta(values, new, old, STAT_FIELDS) / interval
+            rates[out + 10] = counter_delta(values, new, old, STAT_FIELDS + 1) / interval
+            rates[out + 11] = counter_delta(values, new, old, STAT_FIELDS + 2) / interval
+        return True
+
+    def format_rates(self):
+        """
+        Return the latest rates as an iostat style table
+        """
+        columns = len(RATE_COLUMNS)
+        width = max([len('Device')] + [len(name) for name in self.names])
+        lines = ['{:<{}} '.format('Device', width) + ' '.join('{:>9}'.format(column) for column in RATE_COLUMNS)]
+        for series, name in enumerate(self.names):
+            row = self.rates[series * columns:(series + 1) * columns]
+            lines.append('{:<{}} '.format(name, width) + ' '.join('{:>9.2f}'.format(value) for value in row))
+        return '\n'.join(lines)
+
+
+def collect_disks(sysroot=DEFAULT_SYSROOT):
+    """
+    Return a (BlockDevice, Device) pair for every disk, without reading any
+    attributes
+
+    :rtype: list
+    """
+    disks = []
+    for hba in collect_hbas(sysroot):
+        device = None
+        for _, node in walk_hba(hba):
+            if isinstance(node, Device):
+                device = node
+            elif isinstance(node, BlockDevice):
+                disks.append((node, device))
+    return disks
+
+
+def sample_rates(interval, count=None, depth=60, sysroot=DEFAULT_SYSROOT):
+    """
+    Print iostat style rates for every disk each interval seconds
+
+    :param count: Number of reports to print, None to run until interrupted
+    :type count: int
+    """
+    sampler = StatSampler(collect_disks(sysroot), depth)
+    try:
+        sampler.sample()
+        next_sample = time.monotonic()
+        reports = 0
+        while count is None or reports < count:
+            next_sample += interval
+            time.sleep(max(next_sample - time.monotonic(), 0))
+            sampler.sample()
+            sampler.compute_rates()
+            print(time.strftime('%Y-%m-%dT%H:%M:%S'))
+            print(sampler.format_rates())
+            print('')
+            sys.stdout.flush()
+            reports += 1
+    finally:
+        sampler.close()
+
+
+#
+# Disk health
+#
+DEFAULT_HEALTH_COMMAND = 'smartctl --json --all --nocheck {nocheck} {device}'
+DEFAULT_HEALTH_CACHE = '/var/cache/diskinfo/health.json'
+DEFAULT_HEALTH_MAX_AGE = 3600
+DEFAULT_HEALTH_PER_HBA = 2
+DEFAULT_HEALTH_TIMEOUT = 60
+HEALTH_CACHE_VERSION = 1
+# Exit status of the health command for a disk it left in standby, as given to smartctl --nocheck
+HEALTH_STANDBY_STATUS = 111
+
+
+class HealthCache(object):
+    """
+    On-disk store of the health command's results by disk. Each entry holds
+    the time the disk was checked, so it can be reused while young enough.
+    The file is marked as a health cache, so a static cache file given as
+    --health-cache, or a health cache given as --cache, is not used. Entries
+    for disks that were not seen by the latest run are dropped when the cache
+    is saved.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.seen = {}
+        try:
+            with open(path) as cachefile:
+                cached = json.load(cachefile)
+            if cached.get('version') == HEALTH_CACHE_VERSION and isinstance(cached['health'], dict):
+                self.entries = cached['health']
+        except (IOError, OSError, ValueError, KeyError, AttributeError) as e:
+            logging.info('Not using health cache %s. %s', path, e)
+
+    def get(self, key):
+        """
+        Return the cached result for key, None if there is none or it is
+        malformed, e.g. written by another version
+        """
+        entry = self.entries.get(key)
+        if not isinstance(entry, dict) or not isinstance(entry.get('checked', 0), (int, float)):
+            return None
+        self.seen[key] = entry
+        return entry
+
+    def put(self, key, result):
+        self.seen[key] = result
+
+    def save(self):
+        """
+        Atomically replace the cache file with the entries seen by this run
+        """
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.path) or '.'):
+                os.makedirs(os.path.dirname(self.path))
+            with open(tmp_path, 'w') as cachefile:
+                json.dump({'version': HEALTH_CACHE_VERSION, 'health': self.seen}, cachefile, default=json_default)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logging.warning('Unable to write health cache %s. %s', self.path, e)
+
+
+def completed(value):
+    """
+    Return a future that is already done, with value as its result
+
+    :rtype: Future
+    """
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class HealthCollector(object):
+    """
+    Run an external health query, smartctl by default, for disks as they are
+    walked and cache the results on disk. The command is a format string
+    where {device} is the device node, {name} the block device name and
+    {nocheck} the smartctl power mode check, "standby,111" unless forced.
+    Queries for disks on the same HBA are limited to per_hba at a time, disks
+    on different HBAs are queried in parallel. Results younger than max_age
+    seconds are taken from the cache, and disks that are suspended or in
+    standby are not woken up unless forced.
+    """
+    def __init__(self, command=DEFAULT_HEALTH_COMMAND, max_age=DEFAULT_HEALTH_MAX_AGE, cache_path=DEFAULT_HEALTH_CACHE,
+                 per_hba=DEFAULT_HEALTH_PER_HBA, force=False, timeout=DEFAULT_HEALTH_TIMEOUT):
+        self.command = command
+        self.max_age = max_age
+        self.cache = HealthCache(cache_path)
+        self.per_hba = per_hba
+        self.force = force
+        self.timeout = timeout
+        self.pools = {}
+
+    def query(self, name):
+        """
+        Run the health command for the block device name
+
+        :return: The time of the query, the exit status of the command, its
+                 output parsed as JSON if possible and its error output
+        :rtype: dict
+        """
+        argv = [arg.format(device='/dev/' + name, name=name, nocheck='never' if self.force else
+                           'standby,{}'.format(HEALTH_STANDBY_STATUS)) for arg in shlex.split(self.command)]
+        logging.debug('Running %s', argv)
+        result = {'checked': int(time.time()), 'status': None, 'output': None, 'error': None}
+        try:
+            done = subprocess.run(argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                  timeout=self.timeout, universal_newlines=True)
+        except subprocess.TimeoutExpired:
+            result['error'] = 'Timed out after {} seconds'.format(self.timeout)
+            return result
+        except (IOError, OSError) as e:
+            result['error'] = str(e)
+            return result
+        result['status'] = done.returncode
+        result['error'] = done.stderr.strip() or None
+        try:
+            result['output'] = json.loads(done.stdout)
+        except ValueError:
+            result['output'] = done.stdout.strip() or None
+        return result
+
+    def report(self, result, cached=False, standby=False):
+        checked = result.get('checked', 0)
+        return {'checked': checked, 'status': result.get('status'), 'output': result.get('output'),
+                'error': result.get('error'), 'age': max(int(time.time()) - checked, 0), 'cached': cached,
+                'standby': standby}
+
+    def check(self, name, key, cached):
+        """
+        Query the disk name and cache the result under key, or report the
+        cached result if the disk is in standby
+        """
+        result = self.query(name)
+        if result['status'] == HEALTH_STANDBY_STATUS and not self.force:
+            logging.info('Not querying the health of %s, it is in standby', name)
+            return cached and self.report(cached, cached=True, standby=True)
+        if result['status'] is None:
+            logging.warning('Unable to query the health of %s. %s', name, result['error'])
+        else:
+            self.cache.put(key, result)
+        return self.report(result)
+
+    def submit(self, block, device):
+        """
+        Start collecting the health of a disk, on the pool of its HBA unless
+        the cache has it or it is suspended. The result is the health to add
+        to the block device, None for a suspended disk that was never queried.
+
+        :param block: The disk's block device
+        :type block: BlockDevice
+        :param device: The SCSI device the block device belongs to, if any
+        :type device: Device
+        :rtype: Future
+        """
+        wwid = None if device is None else get_sysfs_data(device.device_path, 'wwid')
+        key = wwid if wwid and wwid != TIMED_OUT else block.device_path
+        cached = self.cache.get(key)
+        if cached is not None and time.time() - cached.get('checked', 0) <= self.max_age:
+            return completed(self.report(cached, cached=True))
+        if not self.force and device is not None:
+            if get_sysfs_data(device.device_path, 'power/runtime_status') == 'suspended':
+                logging.info('Not querying the health of %s, it is suspended', block.name)
+                return completed(cached and self.report(cached, cached=True, standby=True))
+        hba = next((part for part in block.device_path.split('/') if _HOST_NAME.match(part)), None)
+        if hba not in self.pools:
+            self.pools[hba] = ThreadPoolExecutor(max_workers=self.per_hba)
+        return self.pools[hba].submit(self.check, block.name, key, cached)
+
+    def close(self):
+        """
+        Wait for the queries still running and save the cache
+        """
+        for pool in self.pools.values():
+            pool.shutdown()
+        self.pools = {}
+        self.cache.save()
+
+
+def positive(kind):
+    """
+    Return an argparse type converting an argument with kind and rejecting
+    values that are not finite and greater than zero
+    """
+    def convert(value):
+        try:
+            number = kind(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid {} value: {!r}'.format(kind.__name__, value))
+        # Also rejects nan
+        if not 0 < number < float('inf'):
+            raise argparse.ArgumentTypeError('must be a finite number greater than 0, not {!r}'.format(value))
+        return number
+    return convert
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Output SAS/SATA disk topology and host identifiers as JSON.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of threads used to read sysfs, or of processes used by --aggregate '
+                             '(default: %(default)s)')
+    parser.add_argument('--format', choices=('json', 'stream', 'ndjson', 'binary'), default='json',
+                        help='json: the whole tree between banner lines (default). stream: the same tree '
+                             'written out while it is walked. ndjson: one record per block device. '
+                             'binary: the tree as a compact binary snapshot')
+    parser.add_argument('--fields', metavar='[LAYER.]FIELD,...',
+                        help='Output only these fields, e.g. serial,bay_identifier,phy.negotiated_linkrate. '
+                             'A field without a layer is taken from the deepest layer that has it. Other '
+                             'attributes are not read')
+    parser.add_argument('--filter', action='append', default=[], metavar='[LAYER.]FIELD[!]=VALUE',
+                        help='Output only disks, and what leads to them, whose nodes match, e.g. hba=host3, '
+                             'state!=running or "device_type=end device". Nodes that do not match are not '
+                             'walked below. May be repeated, all must match')
+    parser.add_argument('--fast-discovery', action='store_true',
+                        help='Find the disks from /sys/block and only the nodes that lead to them, rather than '
+                             'walking down from every HBA. Phys, ports and targets without a disk, and SCSI '
+                             'devices other than disks, are left out')
+    parser.add_argument('--no-listing-cache', action='store_true',
+                        help='List sysfs directories and resolve symlinks again every time they are needed, '
+                             'rather than once per run')
+    parser.add_argument('--profile', nargs='?', type=int, const=20, metavar='N',
+                        help='Time every sysfs read, directory listing and path resolution, and write to '
+                             'stderr the time per layer, latency percentiles and histograms per attribute, and '
+                             'the N slowest nodes and files (default N: %(const)s)')
+    parser.add_argument('--slow-read', type=float, default=DEFAULT_SLOW_READ * 1000, metavar='MS',
+                        help='Count attribute reads of a disk, SCSI device or end device that take MS or longer '
+                             'in its slow_reads field (default: %(default)g)')
+    parser.add_argument('--read-timeout', type=float, metavar='SECONDS',
+                        help='Give up on any single sysfs read after SECONDS and report it as timed out')
+    parser.add_argument('--attr-timeout', action='append', default=[], metavar='ATTRIBUTE=SECONDS',
+                        help='Override --read-timeout for one attribute, e.g. inquiry=2. May be repeated')
+    parser.add_argument('--deadline', type=float, metavar='SECONDS',
+                        help='Total time the run may spend reading sysfs. Reads left when it expires '
+                             'are reported as timed out')
+    parser.add_argument('--cache', metavar='PATH',
+                        help='Store the static fields of every node in PATH for --counters-only runs')
+    parser.add_argument('--counters-only', action='store_true',
+                        help='Read only fields that change, such as states and counters, and take the '
+                             'others from --cache (default: {})'.format(DEFAULT_STATIC_CACHE))
+    parser.add_argument('--textfile', metavar='PATH',
+                        help='Write Prometheus metrics to PATH, e.g. for the node_exporter textfile collector')
+    parser.add_argument('--listen', metavar='[HOST:]PORT',
+                        help='Serve Prometheus metrics over HTTP, collecting them on every scrape')
+    parser.add_argument('--sample', type=positive(float), metavar='SECONDS',
+                        help='Print iostat style rates for every disk each SECONDS')
+    parser.add_argument('--count', type=positive(int), metavar='N',
+                        help='Stop --sample after N reports')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, refresh the tree from kernel uevents and serve it on --socket')
+    parser.add_argument('--socket', default='/run/diskinfo.sock', metavar='PATH',
+                        help='UNIX socket the daemon serves the tree on (default: %(default)s)')
+    parser.add_argument('--serial', help='Print the disk with this serial number, and where it is')
+    parser.add_argument('--wwid', help='Print the disk with this WWID, and where it is')
+    parser.add_argument('--sas-address', metavar='ADDRESS',
+                        help='Print the disk with this SAS address, and where it is')
+    parser.add_argument('--bay', metavar='ENCLOSURE:BAY',
+                        help='Print the disk in this bay of the enclosure with this SAS address')
+    parser.add_argument('--disk', metavar='NAME|MAJOR:MINOR',
+                        help='Print this block device, e.g. sdq, /dev/sdq or 65:0, and where it is')
+    parser.add_argument('--diff', metavar='SNAPSHOT',
+                        help='Report disks that vanished, appeared, moved, left the running state, dropped '
+                             'their link rate or gained errors since SNAPSHOT, the output of --format ndjson '
+                             'or --format binary')
+    parser.add_argument('--aggregate', nargs='+', metavar='PATH',
+                        help='Summarize the snapshots of many hosts, in any output format, given as files or '
+                             'directories: link rates, HBA firmware, disks not running, duplicate serial '
+                             'numbers and disks that moved between hosts. Reads --jobs snapshots at a time, '
+                             'each in its own process')
+    parser.add_argument('--convert', nargs=2, metavar=('INPUT', 'OUTPUT'),
+                        help='Convert a saved JSON tree to a binary snapshot, or a binary snapshot back to '
+                             'JSON, without reading sysfs. OUTPUT may be - for stdout')
+    parser.add_argument('--sysroot', default=DEFAULT_SYSROOT, metavar='PATH',
+                        help='Where sysfs is mounted, e.g. the host\'s /sys bind mounted into a container or '
+                             'an extracted --capture (default: %(default)s)')
+    parser.add_argument('--capture', metavar='PATH',
+                        help='Also write every sysfs file read, and the directories and symlinks leading to '
+                             'them, to the tar archive PATH. Extract it and pass its sys directory to '
+                             '--sysroot to replay the run')
+    parser.add_argument('--health', action='store_true',
+                        help='Also query the health of every disk with --health-command and add it to the '
+                             'block device as "health". Results are cached in --health-cache')
+    parser.add_argument('--health-command', default=DEFAULT_HEALTH_COMMAND, metavar='COMMAND',
+                        help='Command that reports the health of one disk, where {device} is replaced by the '
+                             'device node, {name} by the block device name and {nocheck} by "standby,%d", or '
+                             '"never" with --health-force. Exit status %d means the disk is in standby '
+                             '(default: %%(default)s)' % (HEALTH_STANDBY_STATUS, HEALTH_STANDBY_STATUS))
+    parser.add_argument('--health-per-hba', type=int, default=DEFAULT_HEALTH_PER_HBA, metavar='N',
+                        help='Number of disks on the same HBA queried at a time (default: %(default)s)')
+    parser.add_argument('--health-max-age', type=float, default=DEFAULT_HEALTH_MAX_AGE, metavar='SECONDS',
+                        help='Reuse cached health younger than SECONDS rather than querying the disk again '
+                             '(default: %(default)g)')
+    parser.add_argument('--health-cache', default=DEFAULT_HEALTH_CACHE, metavar='PATH',
+                        help='Where the health of every disk is cached (default: %(default)s)')
+    parser.add_argument('--health-force', action='store_true',
+                        help='Query disks that are suspended or in standby too, waking them up')
+    parser.add_argument('--health-timeout', type=float, default=DEFAULT_HEALTH_TIMEOUT, metavar='SECONDS',
+                        help='Give up on the health command of a disk after SECONDS (default: %(default)g)')
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.capture and (args.daemon or args.listen):
+        parser.error('--capture cannot be used with --daemon or --listen')
+    if args.profile is not None and (args.daemon or args.listen):
+        parser.error('--profile cannot be used with --daemon or --listen')
+    if args.fast_discovery and args.daemon:
+        parser.error('--fast-discovery cannot be used with --daemon')
+    if args.health_per_hba < 1:
+        parser.error('--health-per-hba must be at least 1')
+    lookups = [(key, getattr(args, key)) for key in ('serial', 'wwid', 'sas_address', 'bay')
+               if getattr(args, key) is not None]
+    if args.disk is not None:
+        lookups.append(('dev' if re.match(r'\d+:\d+$', args.disk) else 'name', args.disk))
+    if len(lookups) > 1:
+        parser.error('only one of --serial, --wwid, --sas-address, --bay and --disk may be given')
+    if args.bay is not None and ':' not in args.bay:
+        parser.error('invalid --bay {!r}, expected ENCLOSURE:BAY'.format(args.bay))
+    args.lookup = lookups[0] if lookups else None
+    args.selection = None
+    if args.fields is not None or args.filter:
+        if (args.daemon or args.sample is not None or args.listen or args.textfile or args.diff or args.lookup or
+                args.aggregate or args.convert or args.cache or args.counters_only):
+            parser.error('--fields and --filter only apply to the tree and to --format stream, ndjson and binary')
+        fields = None if args.fields is None else [field.strip() for field in args.fields.split(',') if field.strip()]
+        try:
+            args.selection = Selection(fields, args.filter)
+        except ValueError as e:
+            parser.error(str(e))
+    attribute_timeouts = {}
+    for value in args.attr_timeout:
+        item, _, seconds = value.partition('=')
+        try:
+            attribute_timeouts[item] = float(seconds)
+        except ValueError:
+            parser.error('invalid --attr-timeout {!r}, expected ATTRIBUTE=SECONDS'.format(value))
+    args.attr_timeout = attribute_timeouts
+    if args.health and (args.daemon or args.sample is not None or args.listen or args.textfile or args.diff or
+                        args.lookup or args.aggregate or args.convert):
+        parser.error('--health only applies to the tree and to --format stream, ndjson and binary')
+    return args
+
+
+def write_output(args):
+    """
+    Do what args ask for, writing the results to stdout
+
+    :return: The exit status
+    :rtype: int
+    """
+    status = 0
+    tree = None
+    health = None
+    if args.health:
+        health = HealthCollector(args.health_command, args.health_max_age, args.health_cache,
+                                 args.health_per_hba, args.health_force, args.health_timeout)
+    if args.aggregate:
+        fleet = aggregate(args.aggregate, jobs=args.jobs)
+        write_fleet_report(sys.stdout, fleet)
+        status = 0 if fleet.snapshots else 2
+    elif args.convert:
+        try:
+            convert_snapshot(*args.convert)
+        except BrokenPipeError:
+            raise
+        except (IOError, OSError, ValueError) as e:
+            logging.error('Unable to convert %s. %s', args.convert[0], e)
+            status = 2
+    elif args.daemon:
+        Daemon(args.socket, jobs=args.jobs, sysroot=args.sysroot).serve_forever()
+    elif args.sample is not None:
+        sample_rates(args.sample, args.count, sysroot=args.sysroot)
+    elif args.listen:
+        serve_metrics(args.listen, jobs=args.jobs, sysroot=args.sysroot)
+    elif args.textfile:
+        write_metrics_textfile(args.textfile, jobs=args.jobs, sysroot=args.sysroot)
+    elif args.diff:
+        try:
+            snapshot = read_snapshot(args.diff)
+        except (IOError, OSError, ValueError) as e:
+            logging.error('Unable to read snapshot %s. %s', args.diff, e)
+            status = 2
+        else:
+            status = 1 if write_diff(sys.stdout, snapshot, jobs=args.jobs, sysroot=args.sysroot) else 0
+    elif args.lookup:
+        if not write_lookup(sys.stdout, args.lookup[0], args.lookup[1], jobs=args.jobs, sysroot=args.sysroot):
+            logging.error('No disk found with %s %s', args.lookup[0], args.lookup[1])
+            status = 1
+    elif args.format == 'stream':
+        write_json_stream(sys.stdout, jobs=args.jobs, sysroot=args.sysroot, selection=args.selection, health=health)
+    elif args.format == 'ndjson':
+        write_ndjson(sys.stdout, jobs=args.jobs, sysroot=args.sysroot, selection=args.selection, health=health)
+    elif args.selection is not None:
+        tree = collect_selected(args.selection, jobs=args.jobs, sysroot=args.sysroot, health=health)
+    else:
+        static_cache = None
+        if args.cache or args.counters_only:
+            static_cache = StaticCache(args.cache or DEFAULT_STATIC_CACHE)
+        tree, _ = collect(jobs=args.jobs, static_cache=static_cache, counters_only=args.counters_only,
+                          sysroot=args.sysroot, health=health)
+
+    if tree is not None:
+        logging.info('Finished collecting device information')
+        if args.format == 'binary':
+            write_snapshot(sys.stdout.buffer, tree)
+            sys.stdout.flush()
+        else:
+            print('##########')
+            print(json.dumps(tree, indent=2, sort_keys=True, default=json_default))
+            print('##########')
+    return status
+
+
+#
+# Main function walks sysfs, fetching data about the SCSI bus
+#
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        format='%(levelname)s: %(message)s',
+        level=logging.ERROR
+    )
+    logging.info('Collecting device information')
+
+    configure_read_deadlines(args.read_timeout, args.attr_timeout, args.deadline)
+    configure_capture(args.sysroot if args.capture else None)
+    configure_discovery(args.fast_discovery)
+    configure_sysfs_cache(not args.no_listing_cache)
+    configure_profile(args.profile is not None)
+    configure_slow_reads(args.slow_read / 1000)
+    try:
+        status = write_output(args)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader went away early, e.g. head. Point stdout at /dev/null so
+        # that flushing it at exit does not fail again.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        status = BROKEN_PIPE_STATUS
+
+    if capture is not None:
+        capture.write(args.capture)
+    if profile is not None:
+        write_profile(sys.stderr, profile, args.profile)
+    return status
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import diskinfo
+from benchmark import SysfsBuilder
+
+
+def snapshot_bytes(tree):
+    out = io.BytesIO()
+    diskinfo.write_snapshot(out, tree)
+    return out.getvalue()
+
+
+class NarrowArrayTest(unittest.TestCase):
+    def test_unsigned(self):
+        self.assertEqual(diskinfo.narrow_array([0, 255]).typecode, 'B')
+        self.assertEqual(diskinfo.narrow_array([0, 256]).typecode, 'H')
+        self.assertEqual(diskinfo.narrow_array([1 << 32]).typecode, 'Q')
+        self.assertEqual(diskinfo.narrow_array([]).typecode, 'B')
+
+    def test_signed(self):
+        self.assertEqual(diskinfo.narrow_array([-128, 127], signed=True).typecode, 'b')
+        self.assertEqual(diskinfo.narrow_array([-129], signed=True).typecode, 'h')
+        self.assertEqual(diskinfo.narrow_array([-(1 << 31)], signed=True).typecode, 'i')
+        self.assertEqual(diskinfo.narrow_array([-(1 << 63), (1 << 63) - 1], signed=True).typecode, 'q')
+
+    def test_out_of_range(self):
+        self.assertRaises(OverflowError, diskinfo.narrow_array, [-1])
+        self.assertRaises(OverflowError, diskinfo.narrow_array, [1 << 63], signed=True)
+
+
+class ColumnTypeTest(unittest.TestCase):
+    def test_types(self):
+        self.assertEqual(diskinfo.column_type([1, -1, None, diskinfo.MISSING]), 'int')
+        self.assertEqual(diskinfo.column_type(['00ff', None]), 'hex')
+        self.assertEqual(diskinfo.column_type(['running', '00ff']), 'str')
+        self.assertEqual(diskinfo.column_type([[1, 2], None]), 'ints')
+        self.assertEqual(diskinfo.column_type([[{'type': 'naa'}]]), 'json')
+        # Booleans and integers past 64 bits are not stored as integers
+        self.assertEqual(diskinfo.column_type([True]), 'json')
+        self.assertEqual(diskinfo.column_type([1 << 63]), 'json')
+
+
+class SnapshotLayoutTest(unittest.TestCase):
+    def test_bytes(self):
+        tree = diskinfo.new_tree()
+        tree['system'] = {'hostname': 'vm'}
+        tree['hosts'] = {'host0': {'state': 'running', 'unique_id': -2}}
+        tree['hostcount'] = 1
+        header = bytes.fromhex(
+            '4449534b494e464f'  # magic
+            '01000000'  # version
+            '80000000')  # schema length
+        schema = bytes.fromhex(
+            '42' '07000000' '09000000'  # string offsets: uint8 at 7, 9 of them
+            '42' '10000000' '2d000000'  # string data: 45 bytes at 16
+            '42' '03000000' '01000000'  # node classes
+            '62' '04000000' '01000000'  # node parents, signed
+            '42' '05000000' '01000000'  # node names
+            '42' '06000000' '01000000'  # node rows
+            '02000000'  # tables
+            '04000000' '01000000' '02000000'  # Hba: 1 row, 2 columns
+            '01000000' '01' '01' '42' '00000000' '01000000'  # state: str, 1 section
+            '03000000' '00' '01' '62' '01000000' '01000000'  # unique_id: int, 1 section
+            '07000000' '01000000' '01000000'  # system: 1 row, 1 column
+            '05000000' '01' '01' '42' '02000000' '01000000'  # hostname: str, 1 section
+            '00')  # padding to 8 bytes
+        data = bytes.fromhex(
+            '04'  # state: string 2 plus 2
+            'fe'  # unique_id: -2
+            '08'  # hostname: string 6 plus 2
+            '00' 'ff' '00' '00'  # node: Hba, no parent, name string 0, row 0
+            '00050a111a1d25272d'  # string offsets
+        ) + b'host0staterunningunique_idHbahostnamevmsystem'
+        self.assertEqual(snapshot_bytes(tree), header + schema + data)
+
+
+class SnapshotRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def round_trip(self, tree, column_types=None):
+        path = os.path.join(self.root.name, 'snapshot')
+        with open(path, 'wb') as out:
+            out.write(snapshot_bytes(tree))
+        with diskinfo.SnapshotReader(path) as snapshot:
+            for (kind, field), expected in (column_types or {}).items():
+                self.assertEqual(snapshot.tables[kind]['columns'][field]['type'], expected)
+            return snapshot.to_tree()
+
+    def test_values(self):
+        tree = diskinfo.new_tree()
+        tree['system'] = {'hostname': 'vm', 'product_uuid': None}
+        phys = {}
+        values = [None, -1, 0, 1 << 40, -(1 << 63), (1 << 63) - 1]
+        for number, value in enumerate(values):
+            phys['phy-0:{}'.format(number)] = {
+                'invalid_dword_count': value,
+                'negotiated_linkrate': None if number % 2 else '12.0 Gbit',
+                'sas_address': '0x5000c50000000000',
+            }
+        # Fields a node does not have stay missing, integers past 64 bits are kept as JSON
+        phys['phy-0:6'] = {'enable': 1, 'running_disparity_error_count': 1 << 64}
+        tree['hosts'] = {'host0': dict(phys, state='running', unique_id=None)}
+        tree['hostcount'] = 1
+        tree['phycount'] = len(phys)
+        device = {
+            'inquiry': '000006021f000002', 'vpd_pg80': None, 'ioerr_cnt': -5,
+            'designators': [{'association': 'lun', 'protocol': None, 'type': 'naa', 'value': 'naa.5000c5'}],
+            'sda': {'stat': [1, 0, 1 << 40], 'health': {'status': None, 'output': {'passed': True}}},
+            'sdb': {'stat': None},
+        }
+        tree['hosts']['host0']['phy-0:0']['port-0:0'] = {
+            'end_device-0:0': {'target0:0:0': {'0:0:0:0': device}}}
+        tree.update(portcount=1, devicecount=1, targetcount=1, luncount=1, blockdevcount=2)
+        column_types = {
+            ('Phy', 'invalid_dword_count'): 'int', ('Phy', 'running_disparity_error_count'): 'json',
+            ('Phy', 'negotiated_linkrate'): 'str', ('Hba', 'unique_id'): 'int', ('Device', 'inquiry'): 'hex',
+            ('Device', 'designators'): 'json', ('BlockDevice', 'stat'): 'ints', ('BlockDevice', 'health'): 'json',
+        }
+        self.assertEqual(self.round_trip(tree, column_types), tree)
+
+    def test_collected_tree(self):
+        SysfsBuilder(self.root.name).build(hbas=2, phys=3, expanders=1, disks=2, direct=1)
+        tree = diskinfo.collect_tree(sysroot=os.path.join(self.root.name, 'sys'))
+        # Binary attributes are read back as the hex strings they are printed as
+        expected = json.loads(json.dumps(tree, default=diskinfo.json_default))
+        self.assertEqual(self.round_trip(tree), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
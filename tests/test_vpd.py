@@ -0,0 +1,145 @@
+import contextlib
+import io
+import json
+import tempfile
+import unittest
+
+import diskinfo
+from benchmark import SysfsBuilder
+
+
+def designator(kind, data, code_set=1, association=0, protocol=None):
+    """
+    Return a Device Identification VPD page designator, with the protocol
+    identifier valid (PIV set) if protocol is given
+    """
+    piv = 0x80 if protocol is not None else 0
+    return bytes([(protocol or 0) << 4 | code_set, piv | association << 4 | kind, 0, len(data)]) + data
+
+
+def pg83(*designators, length=None):
+    body = b''.join(designators)
+    return bytes([0, 0x83]) + (len(body) if length is None else length).to_bytes(2, 'big') + body
+
+
+class DecodeVpdPg80Test(unittest.TestCase):
+    def test_serial(self):
+        self.assertEqual(diskinfo.decode_vpd_pg80(b'\0\x80\0\x0a  ZC123456'), 'ZC123456')
+
+    def test_nul_padding(self):
+        self.assertEqual(diskinfo.decode_vpd_pg80(b'\0\x80\0\x0aZC123456\0\0'), 'ZC123456')
+
+    def test_length_past_end(self):
+        self.assertEqual(diskinfo.decode_vpd_pg80(b'\0\x80\0\xffZC12'), 'ZC12')
+
+    def test_not_a_serial_page(self):
+        self.assertIsNone(diskinfo.decode_vpd_pg80(b'\0\x83\0\x04ZC12'))
+        self.assertIsNone(diskinfo.decode_vpd_pg80(b'\0\x80'))
+        self.assertIsNone(diskinfo.decode_vpd_pg80(None))
+
+    def test_timed_out(self):
+        self.assertIs(diskinfo.decode_vpd_pg80(diskinfo.TIMED_OUT), diskinfo.TIMED_OUT)
+
+
+class DecodeVpdPg83Test(unittest.TestCase):
+    def decode_one(self, *args, **kwargs):
+        designators = diskinfo.decode_vpd_pg83(pg83(designator(*args, **kwargs)))
+        self.assertEqual(len(designators), 1)
+        return designators[0]
+
+    def test_vendor(self):
+        self.assertEqual(self.decode_one(0x0, b'\x01\x02\xff'),
+                         {'association': 'lun', 'type': 'vendor', 'protocol': None, 'value': '0102ff'})
+
+    def test_t10(self):
+        self.assertEqual(self.decode_one(0x1, b'ATA     ST4000NM0033 Z1Z0\0\0', code_set=2)['value'],
+                         't10.ATA     ST4000NM0033 Z1Z0')
+
+    def test_eui64(self):
+        self.assertEqual(self.decode_one(0x2, bytes.fromhex('0011223344556677'))['value'], 'eui.0011223344556677')
+
+    def test_naa(self):
+        self.assertEqual(self.decode_one(0x3, bytes.fromhex('5000c50012345678'))['value'], 'naa.5000c50012345678')
+
+    def test_relative_port(self):
+        self.assertEqual(self.decode_one(0x4, b'\0\0\0\x02', association=1, protocol=6),
+                         {'association': 'target_port', 'type': 'relative_port', 'protocol': 'sas', 'value': 2})
+
+    def test_port_and_unit_groups(self):
+        self.assertEqual(self.decode_one(0x5, b'\0\0\x01\x05', association=1)['value'], 0x105)
+        self.assertEqual(self.decode_one(0x6, b'\0\0\0\x07')['value'], 7)
+
+    def test_md5(self):
+        self.assertEqual(self.decode_one(0x7, bytes(range(16)))['value'], bytes(range(16)).hex())
+
+    def test_scsi_name(self):
+        self.assertEqual(self.decode_one(0x8, b'iqn.2001-04.com.example:disk1\0\0\0', code_set=3, association=2),
+                         {'association': 'target_device', 'type': 'scsi_name', 'protocol': None,
+                          'value': 'iqn.2001-04.com.example:disk1'})
+
+    def test_protocol_specific(self):
+        self.assertEqual(self.decode_one(0x9, b'\x0a\x0b', association=1, protocol=0xb)['protocol'], 'pcie')
+
+    def test_uuid(self):
+        data = b'\x10\0' + bytes.fromhex('123e4567e89b12d3a456426614174000')
+        self.assertEqual(self.decode_one(0xa, data)['value'], '123e4567-e89b-12d3-a456-426614174000')
+
+    def test_protocol_ignored_for_logical_unit(self):
+        self.assertIsNone(self.decode_one(0x3, bytes(8), protocol=6)['protocol'])
+
+    def test_reserved(self):
+        designator_ = self.decode_one(0xf, b'\x01', association=3)
+        self.assertEqual((designator_['association'], designator_['type']), ('reserved', 'reserved'))
+
+    def test_several(self):
+        page = pg83(designator(0x3, bytes.fromhex('5000c50012345678')),
+                    designator(0x4, b'\0\0\0\x01', association=1, protocol=6))
+        self.assertEqual([item['type'] for item in diskinfo.decode_vpd_pg83(page)], ['naa', 'relative_port'])
+
+    def test_truncated_designator(self):
+        # The second designator claims 8 bytes, only 2 follow
+        page = pg83(designator(0x3, bytes(8))) + bytes([1, 3, 0, 8, 0x50, 0])
+        page = page[:2] + (len(page) - 4).to_bytes(2, 'big') + page[4:]
+        self.assertEqual([item['type'] for item in diskinfo.decode_vpd_pg83(page)], ['naa'])
+
+    def test_page_length_past_end(self):
+        page = pg83(designator(0x3, bytes(8)), length=0xffff)
+        self.assertEqual([item['type'] for item in diskinfo.decode_vpd_pg83(page)], ['naa'])
+
+    def test_page_length_short(self):
+        # Designators past the page length are not part of the page
+        page = pg83(designator(0x3, bytes(8)), designator(0x3, bytes(8)), length=12)
+        self.assertEqual(len(diskinfo.decode_vpd_pg83(page)), 1)
+        self.assertEqual(diskinfo.decode_vpd_pg83(pg83(designator(0x3, bytes(8)), length=6)), [])
+
+    def test_not_an_identification_page(self):
+        self.assertIsNone(diskinfo.decode_vpd_pg83(b'\0\x80\0\0'))
+        self.assertIsNone(diskinfo.decode_vpd_pg83(b'\0\x83'))
+        self.assertIsNone(diskinfo.decode_vpd_pg83(None))
+
+    def test_timed_out(self):
+        self.assertIs(diskinfo.decode_vpd_pg83(diskinfo.TIMED_OUT), diskinfo.TIMED_OUT)
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        SysfsBuilder(self.root.name).build(hbas=1, phys=2, expanders=0, disks=0, direct=2)
+
+    def tearDown(self):
+        diskinfo.configure_read_deadlines()
+        self.root.cleanup()
+
+    def test_abandoned_reads_are_timed_out(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            diskinfo.main(['--sysroot', self.root.name + '/sys', '--deadline', '0', '--format', 'ndjson'])
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(records), 2)
+        for record in records:
+            self.assertEqual(record['device']['serial'], diskinfo.TIMED_OUT)
+            self.assertEqual(record['device']['designators'], diskinfo.TIMED_OUT)
+
+
+if __name__ == '__main__':
+    unittest.main()